@@ -0,0 +1,218 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+import numpy
+import psutil
+
+from sri_project.models.analyzers import TOKENIZERS
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.dpr import encode_query
+from sri_project.models.dpr_models import get_question_tokenizer
+from sri_project.models.reranker import Reranker
+from sri_project.utils import dataset_loader
+from sri_project.utils.utils import initialize_indexes, preload
+
+
+def measure(fn: Callable[[Any], Any], inputs: list, warmup: int = 10) -> dict:
+    """
+    Times a function over every input after a warmup, with `time.perf_counter`.
+
+    Args:
+        fn (Callable): The function to benchmark, called with one input at a time.
+        inputs (list): The inputs of the measured calls.
+        warmup (int, optional): The number of untimed calls made first. Defaults to 10.
+
+    Returns:
+        dict: The number of calls, mean and p50/p95/p99 latency in milliseconds, and calls per second.
+    """
+    for x in itertools.islice(itertools.cycle(inputs), warmup):
+        fn(x)
+
+    latencies = numpy.empty(len(inputs))
+    for i, x in enumerate(inputs):
+        start_time = time.perf_counter()
+        fn(x)
+        latencies[i] = time.perf_counter() - start_time
+
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "n": len(inputs),
+        "mean_ms": float(latencies.mean() * 1000),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "qps": float(len(inputs) / latencies.sum()),
+    }
+
+
+def memory_mb() -> dict:
+    """
+    Returns the current resident set size of the process and its peak so far.
+
+    The peak is the high-water mark of the whole process and never goes down, so it is not the peak of the stage
+    just measured; compare the current RSS before and after a stage for that.
+
+    Returns:
+        dict: The current RSS and the process peak RSS so far, in megabytes.
+    """
+    return {
+        "rss_mb": psutil.Process().memory_info().rss / 2**20,
+        # ru_maxrss is in kilobytes on Linux
+        "process_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def benchmark_corpus_size(
+    corpus: list[str], queries: list[str], k: int, warmup: int, store_dir: str | None, analyzer: str | None = None
+) -> dict:
+    """
+    Benchmarks every retrieval stage separately over one corpus.
+
+    Args:
+        corpus (list[str]): The corpus to index.
+        queries (list[str]): The queries to run.
+        k (int): The number of passages retrieved per query.
+        warmup (int): The number of untimed calls before each stage.
+        store_dir (str | None): The embedding store directory, None to encode the corpus in memory.
+        analyzer (str | None, optional): The BM25 tokenizer, see `bm25.init_bm25`. Defaults to NLTK.
+
+    Returns:
+        dict: The build time, the latency figures of every stage, the memory after each stage and how much the
+        current RSS grew during it.
+    """
+    start_time = time.perf_counter()
+    bm25, dpr_index = initialize_indexes(corpus, store_dir, analyzer=analyzer)
+    result: dict = {"corpus_size": len(corpus), "build_s": time.perf_counter() - start_time, "stages": {}}
+    result["memory_after_build"] = memory_mb()
+
+    question_tokenizer = get_question_tokenizer()
+    query_embeddings = {query: encode_query(query).numpy() for query in queries}
+    reranker = Reranker(bm25, dpr_index)
+
+    stages = {
+        "bm25_tokenize": bm25.analyzer,
+        "dpr_tokenize": lambda query: question_tokenizer(query, return_tensors="pt", truncation=True),
+        "bm25_retrieve": lambda query: bm25_retrieve(query, bm25, k),
+        "encode_query": encode_query,
+        "index_search": lambda query: dpr_index.search(query_embeddings[query], k),
+        "rerank": lambda query: reranker.rerank(query, k),
+    }
+    for name, fn in stages.items():
+        rss_before = psutil.Process().memory_info().rss / 2**20
+        stage = {**measure(fn, queries, warmup), **memory_mb()}
+        stage["rss_delta_mb"] = stage["rss_mb"] - rss_before
+        result["stages"][name] = stage
+
+    return result
+
+
+def git_commit() -> str | None:
+    """
+    Returns the commit of the working tree, so results of different commits can be told apart.
+
+    Returns:
+        str | None: The commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict):
+    """
+    Prints benchmark results as one table per corpus size.
+
+    Args:
+        results (dict): The results returned by `run_benchmark`.
+    """
+    for size in results["sizes"]:
+        print(f"Corpus size {size['corpus_size']} (index build {size['build_s']:.2f}s)")
+        print(
+            f"{'stage':<16}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'QPS':>10}{'RSS delta (MB)':>16}"
+            f"{'process peak RSS so far (MB)':>30}"
+        )
+        for name, stage in size["stages"].items():
+            print(
+                f"{name:<16}{stage['p50_ms']:>10.3f}{stage['p95_ms']:>10.3f}{stage['p99_ms']:>10.3f}"
+                f"{stage['qps']:>10.1f}{stage['rss_delta_mb']:>+16.1f}{stage['process_peak_rss_mb']:>30.1f}"
+            )
+        print()
+
+
+def run_benchmark(
+    sizes: list[int],
+    num_queries: int = 200,
+    k: int = 10,
+    warmup: int = 20,
+    store_dir: str | None = None,
+    analyzer: str | None = None,
+) -> dict:
+    """
+    Runs the retrieval benchmark at several corpus sizes.
+
+    Args:
+        sizes (list[int]): The corpus sizes to benchmark; 0 stands for the whole corpus.
+        num_queries (int, optional): The number of dataset queries timed per stage. Defaults to 200.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        warmup (int, optional): The number of untimed calls before each stage. Defaults to 20.
+        store_dir (str | None, optional): The embedding store directory, None to encode in memory.
+        analyzer (str | None, optional): The BM25 tokenizer, see `bm25.init_bm25`. Defaults to NLTK.
+
+    Returns:
+        dict: The environment and the results of every corpus size, ready to be dumped as JSON.
+    """
+    preload()
+    queries, corpus, _ = dataset_loader.load_dataset()
+    queries = queries[:num_queries]
+
+    import torch
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "params": {"num_queries": len(queries), "k": k, "warmup": warmup, "analyzer": analyzer or "nltk"},
+        "sizes": [
+            benchmark_corpus_size(corpus[: size or None], queries, k, warmup, store_dir, analyzer) for size in sizes
+        ],
+    }
+
+
+def main():
+    """
+    Command line entry point: `python -m sri_project.benchmark --sizes 1000 5000 0 --output bench.json`.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the retrieval pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 0], help="Corpus sizes, 0 = all.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries timed per stage.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed calls before each stage.")
+    parser.add_argument("--store-dir", default=None, help="Embedding store directory (default: encode in memory).")
+    parser.add_argument("--analyzer", choices=TOKENIZERS, default=None, help="BM25 tokenizer (default: nltk).")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.queries, args.k, args.warmup, args.store_dir, args.analyzer)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable
+from urllib.parse import urlencode, urlsplit
+
+import numpy
+
+from sri_project.server import MODELS, RetrievalService
+
+
+async def run_load(
+    search: Callable[[str], Awaitable], queries: list[str], rate: float, num_requests: int, seed: int = 0
+) -> dict:
+    """
+    Sends requests with Poisson arrivals at a fixed rate, whether or not earlier ones have completed.
+
+    An open loop keeps offering load when the service falls behind, so queueing shows up in the latencies
+    instead of silently lowering the request rate.
+
+    Args:
+        search (Callable[[str], Awaitable]): Sends one query.
+        queries (list[str]): The queries, sent in order and cycled through.
+        rate (float): The offered load in requests per second.
+        num_requests (int): The number of requests to send.
+        seed (int, optional): The seed of the arrival times. Defaults to 0.
+
+    Returns:
+        dict: The offered and achieved QPS, the number of errors and the mean and p50/p95/p99 latency in ms.
+    """
+    arrivals = numpy.cumsum(numpy.random.default_rng(seed).exponential(1 / rate, num_requests))
+    latencies: list[float] = []
+    errors = 0
+
+    async def send(query: str):
+        nonlocal errors
+        start_time = time.perf_counter()
+        try:
+            await search(query)
+        except Exception:
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    tasks = []
+    for i, arrival in enumerate(arrivals.tolist()):
+        await asyncio.sleep(max(0.0, arrival - (time.perf_counter() - start_time)))
+        tasks.append(asyncio.create_task(send(queries[i % len(queries)])))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start_time
+
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) * 1000 if latencies else (0.0, 0.0, 0.0)
+    return {
+        "offered_qps": rate,
+        "achieved_qps": len(latencies) / elapsed,
+        "requests": num_requests,
+        "errors": errors,
+        "mean_ms": float(numpy.mean(latencies) * 1000) if latencies else 0.0,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+def http_search(url: str, model: str, k: int) -> Callable[[str], Awaitable]:
+    """
+    Returns a function sending one query to a running server, over a new connection per request.
+
+    Args:
+        url (str): The base URL of the server, e.g. "http://127.0.0.1:8000".
+        model (str): The retrieval model.
+        k (int): The number of passages retrieved per query.
+
+    Returns:
+        Callable[[str], Awaitable]: Sends a query and returns the decoded JSON response.
+    """
+    address = urlsplit(url)
+
+    async def search(query: str) -> dict:
+        reader, writer = await asyncio.open_connection(address.hostname, address.port or 80)
+        try:
+            target = "/search?" + urlencode({"q": query, "model": model, "k": k})
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: {address.netloc}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            head, _, body = (await reader.read()).partition(b"\r\n\r\n")
+        finally:
+            writer.close()
+
+        status = head.split(b" ", 2)[1]
+        if status != b"200":
+            raise RuntimeError(f"HTTP {status.decode()}: {body.decode('utf-8', 'replace')}")
+        return json.loads(body)
+
+    return search
+
+
+async def load_test(
+    bm25,
+    dpr_index,
+    queries: list[str],
+    rates: list[float],
+    num_requests: int,
+    model: str = "DPR",
+    k: int = 10,
+    batch_sizes: tuple[int, ...] = (1, 32),
+    max_wait_ms: float = 5.0,
+) -> list[dict]:
+    """
+    Runs the load generator against in-process services at several batch sizes and offered loads.
+
+    A maximum batch size of 1 serves every query on its own, as the Gradio search does, and is the baseline of
+    the batched runs.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index.
+        queries (list[str]): The queries to send.
+        rates (list[float]): The offered loads in requests per second.
+        num_requests (int): The number of requests per run.
+        model (str, optional): The retrieval model. Defaults to "DPR".
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        batch_sizes (tuple[int, ...], optional): The maximum batch sizes to compare. Defaults to (1, 32).
+        max_wait_ms (float, optional): How long a query waits for others to share its batch. Defaults to 5.
+
+    Returns:
+        list[dict]: One row per batch size and rate with the load figures and the mean batch size.
+    """
+    report = []
+    for max_batch_size in batch_sizes:
+        for rate in rates:
+            service = RetrievalService(bm25, dpr_index, max_batch_size, max_wait_ms)
+            try:
+                # Untimed warmup, so model loading and first-call costs stay out of the figures
+                await asyncio.gather(*(service.search(query, model, k) for query in queries[:max_batch_size]))
+                row = await run_load(lambda query: service.search(query, model, k), queries, rate, num_requests)
+                stats = service.stats()["rerank" if model == "Reranking" else "dpr"]
+            finally:
+                await service.close()
+            report.append({"max_batch_size": max_batch_size, **row, "mean_batch_size": stats["mean_batch_size"]})
+    return report
+
+
+def print_report(report: list[dict]):
+    """
+    Prints a load test report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `load_test`, or `run_load` rows.
+    """
+    print(
+        f"{'batch':>6}{'offered':>9}{'achieved':>10}{'errors':>8}{'mean (ms)':>11}"
+        f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'mean batch':>12}"
+    )
+    for r in report:
+        print(
+            f"{r.get('max_batch_size', '-'):>6}{r['offered_qps']:>9.1f}{r['achieved_qps']:>10.1f}{r['errors']:>8}"
+            f"{r['mean_ms']:>11.2f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+            f"{r.get('mean_batch_size', 0.0):>12.2f}"
+        )
+
+
+def main():
+    """
+    Command line entry point: `python -m sri_project.load_test --rates 20 50 100`, or with `--url` against a
+    server started with `python -m sri_project.server`.
+    """
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the retrieval service.")
+    parser.add_argument("--url", default=None, help="Server to load; by default services are run in-process.")
+    parser.add_argument("--rates", type=float, nargs="+", default=[20, 50, 100], help="Offered loads (req/s).")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per run.")
+    parser.add_argument("--model", choices=MODELS, default="DPR", help="Retrieval model.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32], help="In-process batch sizes.")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="In-process maximum batch wait.")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    from sri_project.utils import dataset_loader
+    from sri_project.utils.utils import initialize_indexes, preload
+
+    queries = dataset_loader.queries
+
+    if args.url:
+        search = http_search(args.url, args.model, args.k)
+        report = [asyncio.run(run_load(search, queries, rate, args.requests)) for rate in args.rates]
+    else:
+        preload()
+        bm25, dpr_index = initialize_indexes(dataset_loader.corpus)
+        report = asyncio.run(
+            load_test(
+                bm25,
+                dpr_index,
+                queries,
+                args.rates,
+                args.requests,
+                args.model,
+                args.k,
+                tuple(args.batch_sizes),
+                args.max_wait_ms,
+            )
+        )
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
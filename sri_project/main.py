@@ -1,34 +1,104 @@
+import hashlib
+import json
+import os
 import sys
+from concurrent.futures import Future
+from contextlib import nullcontext
 from typing import Literal
 
 import gradio as gr
 
-from sri_project.utils.dataset_loader import corpus, grouped_data, queries
-from sri_project.utils.metrics import evaluate_performance
-from sri_project.utils.plot import plot_and_save_graph, plot_comparison
-from sri_project.utils.utils import initialize_indexes
+from sri_project.utils import dataset_loader, tracing
+from sri_project.utils.eval_log import EVAL_LOG_DIR, ResultTable, evaluate_to_log, evaluation_fingerprint, log_series
+from sri_project.utils.metrics import iter_retrievals, score_records
+from sri_project.utils.parallel_eval import evaluate_performance_parallel
+from sri_project.utils.plot import plot_and_save_graph, render_comparison
+from sri_project.utils.utils import get_retrieved_docs, initialize_indexes, initialize_sharded_indexes, preload
 
+# Precomputed results of the queries offered by the interface, by third model
+result_tables: dict[str, ResultTable] = {}
 
-def run_whole_evaluation(bm25, dpr_index):
+
+def run_whole_evaluation(
+    bm25,
+    dpr_index,
+    parallel: bool = False,
+    rerank_model: str = "Reranking",
+    resume: bool = True,
+    fingerprint: dict | None = None,
+):
     """
     Runs the whole evaluation process for the given BM25 and DPR index.
 
+    A sequential evaluation streams its per-query records to a checkpointed log under `EVAL_LOG_DIR` and resumes
+    it when interrupted, as long as the corpus and indexes still match the fingerprint it was written with.
+
     Args:
         bm25: The BM25 model used for evaluation.
         dpr_index: The DPR index used for evaluation.
+        parallel (bool): Shard the queries across one worker process per core.
+        rerank_model (str): The model of the third stage, "Reranking" or "Hybrid".
+        resume (bool): Continue the log of a previous sequential evaluation instead of starting over.
+        fingerprint (dict | None): The `evaluation_fingerprint` of the corpus and indexes. Without it, the log is
+            always started over.
 
     Returns:
         None
     """
     # Performance evaluation
-    (
-        times,
-        recall_values,
-        precision_values,
-        _,
-    ) = evaluate_performance(grouped_data, queries, bm25, dpr_index)
+    if parallel:
+        times, recall_values, precision_values, _, _ = evaluate_performance_parallel(
+            dataset_loader.qrels, dataset_loader.queries, bm25, dpr_index, rerank_model=rerank_model
+        )
+    else:
+        log_path = os.path.join(EVAL_LOG_DIR, f"{rerank_model.lower()}.jsonl")
+        evaluate_to_log(
+            dataset_loader.qrels,
+            dataset_loader.queries,
+            bm25,
+            dpr_index,
+            log_path,
+            rerank_model=rerank_model,
+            resume=resume,
+            fingerprint=fingerprint,
+        )
+        times, recall_values, precision_values = log_series(log_path, ("BM25", "DPR", rerank_model))
+
+    plot(times, recall_values, precision_values, rerank_model)
+
+
+def num_shards() -> int:
+    """
+    Returns the number of index shards given with `--shards N`, or 0 for single-process indexes.
+    """
+    if "--shards" not in sys.argv:
+        return 0
+    return int(sys.argv[sys.argv.index("--shards") + 1])
+
+
+def profile_path() -> str | None:
+    """
+    Returns the file given with `--profile FILE` to write the cProfile stats of the evaluation to, or None.
+    """
+    if "--profile" not in sys.argv:
+        return None
+    return sys.argv[sys.argv.index("--profile") + 1]
+
+
+def load_indexes(corpus) -> tuple:
+    """
+    Initializes the BM25 and DPR indexes of the corpus, sharded across worker processes with `--shards N`.
 
-    plot(times, recall_values, precision_values)
+    Args:
+        corpus (list): The documents to index.
+
+    Returns:
+        tuple: The BM25 index and the DPR index.
+    """
+    if num_shards():
+        shards = initialize_sharded_indexes(corpus, num_shards())
+        return shards.bm25, shards.dpr_index
+    return initialize_indexes(corpus)
 
 
 def main():
@@ -37,11 +107,22 @@ def main():
     sets up the Gradio interface, and launches it.
     """
 
+    # Load models, tokenizer data and dataset up front instead of on the first request
+    preload()
+
+    if "--trace" in sys.argv:
+        tracing.enable()
+
     # Indexes initialization
     global bm25, dpr_index
 
-    if {"--interactive", "-i"} & set(sys.argv):
-        bm25, dpr_index = initialize_indexes(corpus[:100])
+    if {"--interactive", "-i", "--precompute"} & set(sys.argv):
+        bm25, dpr_index = load_indexes(dataset_loader.corpus[:100])
+        # Evaluated once per set of indexes; later startups read the tables from disk
+        result_tables.update(precompute_result_tables(evaluation_fingerprint(dataset_loader.corpus[:100], bm25)))
+        if "--precompute" in sys.argv:
+            return
+
         # Initialize the Gradio interface
         interface = setup_interface()
 
@@ -50,11 +131,24 @@ def main():
     else:
 
         # Performance evaluation
-        bm25, dpr_index = initialize_indexes(corpus)
-        run_whole_evaluation(bm25, dpr_index)
+        bm25, dpr_index = load_indexes(dataset_loader.corpus)
+        with tracing.profile(profile_path()) if profile_path() else nullcontext():
+            run_whole_evaluation(
+                bm25,
+                dpr_index,
+                # Shard workers already search in parallel, and their connections cannot be shared with forked
+                # workers. Stages run by parallel workers are traced in the workers and not reported here.
+                parallel=bool({"--parallel", "-p"} & set(sys.argv)) and not num_shards(),
+                rerank_model="Hybrid" if "--hybrid" in sys.argv else "Reranking",
+                resume="--fresh" not in sys.argv,
+                fingerprint=evaluation_fingerprint(dataset_loader.corpus, bm25),
+            )
+
+        if tracing.is_enabled():
+            tracing.print_stats()
 
 
-def plot(times, recall_values, precision_values):
+def plot(times, recall_values, precision_values, rerank_model: str = "Reranking"):
     """
     Plots and saves the results of the comparison between BM25, DPR, and Reranking.
 
@@ -62,6 +156,7 @@ def plot(times, recall_values, precision_values):
         times (list): A list of time values for each query.
         recall_values (list): A list of recall values for each query.
         precision_values (list): A list of precision values for each query.
+        rerank_model (str): The name of the third model, "Reranking" or "Hybrid".
 
     Returns:
         list: A list of charts representing the comparison between BM25, DPR, and Reranking.
@@ -76,8 +171,9 @@ def plot(times, recall_values, precision_values):
             y3=times[2],
             xlabel="Consultas",
             ylabel="Tiempo (s)",
-            title="Comparación de Tiempo de Cómputo entre BM25, DPR y Reranking",
+            title=f"Comparación de Tiempo de Cómputo entre BM25, DPR y {rerank_model}",
             filename="time_comparation",
+            labels=("BM25", "DPR", rerank_model),
         ),
         plot_and_save_graph(
             x=list(range(len(recall_values[0]))),
@@ -86,8 +182,9 @@ def plot(times, recall_values, precision_values):
             y3=recall_values[2],
             xlabel="Consultas",
             ylabel="Recall",
-            title="Comparación de Recall entre BM25, DPR y Reranking",
+            title=f"Comparación de Recall entre BM25, DPR y {rerank_model}",
             filename="recall_comparation",
+            labels=("BM25", "DPR", rerank_model),
         ),
         plot_and_save_graph(
             x=list(range(len(precision_values[0]))),
@@ -96,69 +193,127 @@ def plot(times, recall_values, precision_values):
             y3=precision_values[2],
             xlabel="Consultas",
             ylabel="Precision",
-            title="Comparación de Precision entre BM25, DPR y Reranking",
+            title=f"Comparación de Precision entre BM25, DPR y {rerank_model}",
             filename="precision_comparation",
+            labels=("BM25", "DPR", rerank_model),
         ),
     ]
 
     return charts
 
 
-def search(query: str, model: Literal["BM25", "DPR", "Reranking"]):
+def precompute_result_tables(fingerprint: dict, queries_limit: int = 100) -> dict[str, ResultTable]:
     """
-    Perform a search query using the specified model.
+    Evaluates every query offered by the interface once with each model, into one result table per third model.
+
+    Tables are evaluation logs under `EVAL_LOG_DIR`, named after the number of queries and the fingerprint of the
+    corpus and indexes, so later startups with the same indexes read them from disk and an interrupted precompute
+    resumes, while any change to the passages, index configuration, encoders or BM25 builds new ones. The
+    comparison charts of every query are queued for rendering in the background.
 
     Args:
-        query (str): The search query.
-        model (Literal["BM25", "DPR", "Reranking"]): The model to use for the search.
+        fingerprint (dict): The `evaluation_fingerprint` of the corpus and indexes.
+        queries_limit (int): The number of queries offered by the interface.
 
     Returns:
-        Tuple: A tuple containing the following information:
-            - Retrieved documents for the selected model.
-            - Precision value for the selected model.
-            - Recall value for the selected model.
-            - Time taken for the selected model.
-            - Comparison chart of precision and recall for BM25 vs DPR, Reranking.
-            - Comparison chart of computation time and memory usage for BM25, DPR, and Reranking.
+        dict[str, ResultTable]: The tables, by third model ("Reranking" or "Hybrid").
     """
-    quer_idx = queries.index(query)
+    queries = dataset_loader.queries[:queries_limit]
+    digest = hashlib.blake2b(json.dumps(fingerprint, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+    tables = {}
+    for rerank_model in ("Reranking", "Hybrid"):
+        path = os.path.join(EVAL_LOG_DIR, f"demo-{rerank_model.lower()}-{len(queries)}q-{digest}.jsonl")
+        evaluate_to_log(
+            dataset_loader.qrels, queries, bm25, dpr_index, path, rerank_model=rerank_model, fingerprint=fingerprint
+        )
+        tables[rerank_model] = ResultTable(path)
+        for i in tables[rerank_model].query_indices():
+            comparison_charts(tables[rerank_model].get(i), rerank_model)
+    return tables
 
-    times, recall_values, precision_values, retrieved_docs = evaluate_performance(
-        grouped_data, queries, bm25, dpr_index, quer_idx
-    )
 
-    charts = [
-        plot_comparison(
+def comparison_charts(record: dict, rerank_model: str = "Reranking", k: int = 10) -> list[Future]:
+    """
+    Renders the comparison charts of an evaluation record in the background.
+
+    Args:
+        record (dict): A scored record with the three models.
+        rerank_model (str): The name of the third model, "Reranking" or "Hybrid".
+        k (int): The cutoff of the record metrics.
+
+    Returns:
+        list[Future]: The precision and recall chart and the time chart, resolving to their files.
+    """
+    labels = ("BM25", "DPR", rerank_model)
+    precision_values = [[record[label][f"precision@{k}"]] for label in labels]
+    recall_values = [[record[label][f"recall@{k}"]] for label in labels]
+    times = [[record[label]["time"]] for label in labels]
+
+    return [
+        render_comparison(
             precision_values,
             recall_values,
             "Recall",
             "Precision",
-            "Comparación: BM25 vs DPR, Reranking",
-            "img/precision_recall_comparison.png",
+            f"Comparación: BM25 vs DPR, {rerank_model}",
+            labels,
         ),
-        plot_comparison(
+        render_comparison(
             times,
             None,
             "Tiempo (s)",
             "Memoria (MB)",
-            "Comparación de Tiempo de Cómputo entre BM25, DPR y Reranking",
-            "img/tiempo__comparacion.png",
+            f"Comparación de Tiempo de Cómputo entre BM25, DPR y {rerank_model}",
+            labels,
         ),
     ]
-    idx = 0
-    if model == "DPR":
-        idx = 1
-    elif model == "Reranking":
-        idx = 2
-    return (
+
+
+def search(query: str, model: Literal["BM25", "DPR", "Reranking", "Hybrid"]):
+    """
+    Perform a search query using the specified model.
+
+    Precomputed queries are answered from the result tables. Any other query is retrieved live with the selected
+    model only, and then has no comparison charts.
+
+    Args:
+        query (str): The search query.
+        model (Literal["BM25", "DPR", "Reranking", "Hybrid"]): The model to use for the search.
+
+    Yields:
+        Tuple: A tuple containing the following information, first without the charts as soon as the results are
+        available and then again once the charts, rendered in the background, are ready:
+            - Retrieved documents for the selected model.
+            - Precision value for the selected model.
+            - Recall value for the selected model.
+            - Time taken for the selected model.
+            - Comparison chart of precision and recall for BM25 vs DPR, Reranking.
+            - Comparison chart of computation time and memory usage for BM25, DPR, and Reranking.
+    """
+    quer_idx = dataset_loader.queries.index(query)
+    rerank_model = "Hybrid" if model == "Hybrid" else "Reranking"
+    k = 10
+
+    table = result_tables.get(rerank_model)
+    record = table.get(quer_idx) if table is not None else None
+    charts = None
+    if record is None:
+        retrievals = iter_retrievals(dataset_loader.queries, bm25, dpr_index, [quer_idx], k, rerank_model, (model,))
+        record = next(score_records(retrievals, dataset_loader.qrels, k))
+    else:
+        charts = comparison_charts(record, rerank_model, k)
+
+    entry = record[model]
+    results = (
         # respuestas del modelo seleccionado
-        retrieved_docs[idx],
-        precision_values[idx][0],
-        recall_values[idx][0],
-        times[idx][0],
-        charts[0],
-        charts[1],
+        get_retrieved_docs(entry["ids"]),
+        entry[f"precision@{k}"],
+        entry[f"recall@{k}"],
+        entry["time"],
     )
+    yield (*results, None, None)
+    if charts is not None:
+        yield (*results, charts[0].result(), charts[1].result())
 
 
 def setup_interface(queries_limit: int = 100):
@@ -174,8 +329,8 @@ def setup_interface(queries_limit: int = 100):
     return gr.Interface(
         fn=search,
         inputs=[
-            gr.Dropdown(choices=queries[:queries_limit], label="Selecciona una Consulta"),
-            gr.Dropdown(choices=["BM25", "DPR", "Reranking"], label="Modelo de Recuperación"),
+            gr.Dropdown(choices=dataset_loader.queries[:queries_limit], label="Selecciona una Consulta"),
+            gr.Dropdown(choices=["BM25", "DPR", "Reranking", "Hybrid"], label="Modelo de Recuperación"),
         ],
         outputs=[
             gr.Textbox(label="Resultados"),
@@ -0,0 +1,231 @@
+import multiprocessing
+import os
+import re
+from functools import cache
+from typing import Callable
+
+NLTK_RESOURCES = ("punkt", "punkt_tab")
+
+TOKENIZERS = ("nltk", "regex", "hf")
+
+# Word characters runs and single punctuation marks, the tokens NLTK produces for most text
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Below this many texts, starting worker processes costs more than it saves
+PARALLEL_MIN_TEXTS = 5000
+
+# Set by the parent right before forking, so workers inherit the analyzer instead of pickling it
+_shared: dict = {}
+
+
+@cache
+def ensure_nltk_resources():
+    """
+    Downloads the NLTK tokenizer data files that are not installed yet. Runs once per process.
+    """
+    import nltk
+
+    for resource in NLTK_RESOURCES:
+        try:
+            nltk.data.find(f"tokenizers/{resource}")
+        except LookupError:
+            nltk.download(resource)
+
+
+def word_tokenize(text: str) -> list[str]:
+    """
+    Tokenizes a text with the NLTK word tokenizer, loading NLTK on first use.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list[str]: The tokens of the text.
+    """
+    ensure_nltk_resources()
+    from nltk.tokenize import word_tokenize as nltk_word_tokenize
+
+    return nltk_word_tokenize(text)
+
+
+def regex_tokenize(text: str) -> list[str]:
+    """
+    Tokenizes a text with a single precompiled regular expression.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list[str]: The runs of word characters and the punctuation marks of the text.
+    """
+    return TOKEN_PATTERN.findall(text)
+
+
+def hf_tokenize(text: str) -> list[str]:
+    """
+    Splits a text into words with the normalizer and pre-tokenizer of the DPR question tokenizer.
+
+    Both run in the Rust `tokenizers` library. Words are not split further into word pieces.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list[str]: The words of the text.
+    """
+    backend = _hf_backend()
+    if backend.normalizer is not None:
+        text = backend.normalizer.normalize_str(text)
+    return [word for word, _ in backend.pre_tokenizer.pre_tokenize_str(text)]
+
+
+@cache
+def _hf_backend():
+    from .dpr_models import get_question_tokenizer
+
+    return get_question_tokenizer().backend_tokenizer
+
+
+@cache
+def load_stopwords(language: str = "english") -> frozenset[str]:
+    """
+    Loads the NLTK stopword list of a language, downloading it on first use.
+
+    Args:
+        language (str, optional): The language of the list. Defaults to "english".
+
+    Returns:
+        frozenset[str]: The stopwords.
+    """
+    import nltk
+
+    try:
+        nltk.data.find("corpora/stopwords")
+    except LookupError:
+        nltk.download("stopwords")
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words(language))
+
+
+class Analyzer:
+    """
+    Turns texts into BM25 terms: lowercasing, tokenization and optional stopword removal and stemming.
+
+    The corpus and the queries of a BM25 index must go through the same analyzer.
+
+    Args:
+        tokenizer (str, optional): The tokenizer backend, one of "nltk" (NLTK word tokenizer), "regex" (one
+            precompiled regular expression) or "hf" (the pre-tokenizer of the DPR fast tokenizer).
+            Defaults to "nltk".
+        stem (bool, optional): Reduce every term to its Porter stem. Defaults to False.
+        stopwords (bool, optional): Drop the NLTK stopwords of the language. Defaults to False.
+        language (str, optional): The language of the stopword list. Defaults to "english".
+    """
+
+    def __init__(self, tokenizer: str = "nltk", stem: bool = False, stopwords: bool = False, language: str = "english"):
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown tokenizer {tokenizer!r}, expected one of {TOKENIZERS}")
+
+        self.tokenizer = tokenizer
+        self.stem = stem
+        self.stopwords = stopwords
+        self.language = language
+
+        self._tokenize: Callable[[str], list[str]] = {
+            "nltk": word_tokenize,
+            "regex": regex_tokenize,
+            "hf": hf_tokenize,
+        }[tokenizer]
+        self._stopwords = load_stopwords(language) if stopwords else frozenset()
+        self._stemmer = None
+        # Stems of the terms seen so far; the vocabulary is far smaller than the number of tokens
+        self._stems: dict[str, str] = {}
+        if stem:
+            from nltk.stem import PorterStemmer
+
+            self._stemmer = PorterStemmer()
+
+    def __call__(self, text: str) -> list[str]:
+        """
+        Analyzes one text.
+
+        Args:
+            text (str): The text to analyze.
+
+        Returns:
+            list[str]: The terms of the text.
+        """
+        tokens = self._tokenize(text.lower())
+        if self._stopwords:
+            tokens = [token for token in tokens if token not in self._stopwords]
+        if self._stemmer is not None:
+            stems = self._stems
+            tokens = [stems[token] if token in stems else self._stem(token) for token in tokens]
+        return tokens
+
+    def __repr__(self) -> str:
+        return (
+            f"Analyzer(tokenizer={self.tokenizer!r}, stem={self.stem}, stopwords={self.stopwords}, "
+            f"language={self.language!r})"
+        )
+
+    def _stem(self, token: str) -> str:
+        stem = self._stems[token] = self._stemmer.stem(token)
+        return stem
+
+    def analyze_batch(self, texts: list[str], workers: int | None = None) -> list[list[str]]:
+        """
+        Analyzes many texts, splitting large batches across forked worker processes.
+
+        Args:
+            texts (list[str]): The texts to analyze.
+            workers (int, optional): The number of worker processes. Defaults to the number of cores;
+                batches smaller than `PARALLEL_MIN_TEXTS` are always analyzed in this process.
+
+        Returns:
+            list[list[str]]: The terms of every text, in order.
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(texts) < PARALLEL_MIN_TEXTS:
+            return [self(text) for text in texts]
+
+        # Load the tokenizer data and stopwords before forking, so every worker inherits them
+        self("")
+
+        chunk_size = -(-len(texts) // (workers * 4))
+        chunks = [(start, start + chunk_size) for start in range(0, len(texts), chunk_size)]
+
+        _shared.update(analyzer=self, texts=texts)
+        try:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                results = pool.map(_analyze_chunk, chunks)
+        finally:
+            _shared.clear()
+        return [tokens for chunk in results for tokens in chunk]
+
+
+def _analyze_chunk(bounds: tuple[int, int]) -> list[list[str]]:
+    analyzer, texts = _shared["analyzer"], _shared["texts"]
+    return [analyzer(text) for text in texts[bounds[0] : bounds[1]]]
+
+
+def get_analyzer(analyzer: "Analyzer | str | None" = None) -> Analyzer:
+    """
+    Resolves an analyzer argument: an `Analyzer` is returned as is and a tokenizer name builds a plain
+    analyzer with that tokenizer.
+
+    Args:
+        analyzer (Analyzer | str | None, optional): The analyzer or tokenizer name. Defaults to the NLTK tokenizer.
+
+    Returns:
+        Analyzer: The analyzer.
+    """
+    if isinstance(analyzer, Analyzer):
+        return analyzer
+    return _default_analyzer(analyzer or "nltk")
+
+
+@cache
+def _default_analyzer(tokenizer: str) -> Analyzer:
+    return Analyzer(tokenizer)
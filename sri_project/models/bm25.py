@@ -1,43 +1,73 @@
-import nltk
-from nltk.tokenize import word_tokenize
-from rank_bm25 import BM25Okapi
+from sri_project.utils.tracing import span
 
-# Download NLTK data files (e.g., tokenizers)
-nltk.download("punkt")
-nltk.download("punkt_tab")
+from .analyzers import Analyzer, get_analyzer
+from .bm25_index import BM25Index
 
 
-def init_bm25(corpus: list[str]) -> BM25Okapi:
+def init_bm25(
+    corpus: list[str],
+    k1: float = 1.5,
+    b: float = 0.75,
+    analyzer: Analyzer | str | None = None,
+    workers: int | None = None,
+) -> BM25Index:
     """
     Initialize the BM25 model with the given corpus.
 
     Parameters:
     - corpus (list[str]): A list of documents representing the corpus.
+    - k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+    - b (float, optional): Document length normalization. Defaults to 0.75.
+    - analyzer (Analyzer | str, optional): The analyzer or tokenizer name ("nltk", "regex" or "hf") used for
+      the corpus and, later, the queries. Defaults to the NLTK word tokenizer.
+    - workers (int, optional): The number of processes tokenizing the corpus. Defaults to the number of cores.
 
     Returns:
-    - BM25Okapi: The initialized BM25 model.
+    - BM25Index: The initialized BM25 model.
 
     """
-    tokenized_corpus = [word_tokenize(doc.lower()) for doc in corpus]
-    return BM25Okapi(tokenized_corpus)
+    analyzer = get_analyzer(analyzer)
+    tokenized_corpus = analyzer.analyze_batch(corpus, workers)
+    return BM25Index(tokenized_corpus, k1=k1, b=b, analyzer=analyzer)
 
 
-def bm25_retrieve(query: str, bm25: BM25Okapi, top_k: int = 3) -> tuple[list[int], list[float]]:
+def bm25_retrieve(query: str, bm25: BM25Index, top_k: int = 3) -> tuple[list[int], list[float]]:
     """
     Retrieve the top-k indices of documents based on the BM25 scores for a given query.
 
     Args:
         query (str): The query string.
-        bm25 (BM25): The BM25 object used for scoring.
+        bm25 (BM25Index): The BM25 object used for scoring.
         top_k (int, optional): The number of top indices to retrieve. Defaults to 3.
 
     Returns:
         list[int]: The top-k indices of documents based on the BM25 scores.
     """
-    tokenized_query = word_tokenize(query.lower())
-    scores = bm25.get_scores(tokenized_query)
-    top_k_indices = sorted(zip(range(len(scores)), scores), key=lambda x: x[1], reverse=True)[:top_k]
+    with span("bm25"):
+        with span("bm25.tokenize"):
+            tokenized_query = (bm25.analyzer or get_analyzer())(query)
+        with span("bm25.score"):
+            top_k_indices, scores = bm25.top_k(tokenized_query, top_k)
+        return top_k_indices.tolist(), scores.tolist()
 
-    scores = [x[1] for x in top_k_indices]
-    top_k_indices = [x[0] for x in top_k_indices]
-    return top_k_indices, scores
+
+def bm25_retrieve_batch(
+    queries: list[str], bm25: BM25Index, top_k: int = 3
+) -> tuple[list[list[int]], list[list[float]]]:
+    """
+    Retrieve the top-k indices of documents for every query in a batch.
+
+    Args:
+        queries (list[str]): The query strings.
+        bm25 (BM25Index): The BM25 object used for scoring.
+        top_k (int, optional): The number of top indices to retrieve per query. Defaults to 3.
+
+    Returns:
+        tuple: The top-k document indices and their scores for every query.
+    """
+    analyzer = bm25.analyzer or get_analyzer()
+    with span("bm25.batch.tokenize"):
+        tokenized_queries = [analyzer(query) for query in queries]
+    with span("bm25.batch.score"):
+        results = bm25.top_k_batch(tokenized_queries, top_k)
+    return [indices.tolist() for indices, _ in results], [scores.tolist() for _, scores in results]
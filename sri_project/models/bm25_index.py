@@ -0,0 +1,462 @@
+import math
+import threading
+from collections import Counter
+from typing import Callable
+
+import numpy
+from numpy import ndarray
+
+
+class BM25Index:
+    """
+    Okapi BM25 index stored as an inverted index of posting lists in NumPy arrays.
+
+    The postings of term `t` live in `doc_ids[indptr[t] : indptr[t + 1]]` (ascending document ids) with their
+    term frequencies in `tfs`. IDF values and the per-document length normalization are precomputed, so a
+    query only touches the postings of its own terms. Scores match `rank_bm25.BM25Okapi` exactly.
+
+    Args:
+        tokenized_corpus (list[list[str]]): The tokens of every document in the corpus.
+        k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+        b (float, optional): Document length normalization. Defaults to 0.75.
+        epsilon (float, optional): Fraction of the average IDF used as floor for negative IDFs. Defaults to 0.25.
+        analyzer (Callable, optional): The analyzer the corpus was tokenized with, kept so that queries are
+            tokenized the same way.
+    """
+
+    def __init__(
+        self,
+        tokenized_corpus: list[list[str]],
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        analyzer: Callable[[str], list[str]] | None = None,
+    ):
+        self.analyzer = analyzer
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.vocab: dict[str, int] = {}
+        term_ids: list[int] = []
+        doc_ids: list[int] = []
+        tfs: list[int] = []
+        doc_lens = numpy.zeros(len(tokenized_corpus), dtype=numpy.int64)
+
+        for doc_id, tokens in enumerate(tokenized_corpus):
+            doc_lens[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        # Stable sort keeps the documents of every posting list in ascending order
+        term_ids_array = numpy.asarray(term_ids, dtype=numpy.int64)
+        order = numpy.argsort(term_ids_array, kind="stable")
+        df = numpy.bincount(term_ids_array, minlength=len(self.vocab))
+
+        self.indptr = numpy.zeros(len(self.vocab) + 1, dtype=numpy.int64)
+        numpy.cumsum(df, out=self.indptr[1:])
+        self.doc_ids = numpy.asarray(doc_ids, dtype=numpy.int32)[order]
+        self.tfs = numpy.asarray(tfs, dtype=numpy.min_scalar_type(max(tfs, default=0)))[order]
+
+        self.corpus_size = len(tokenized_corpus)
+        self.doc_lens = doc_lens
+        self.avgdl = doc_lens.sum() / self.corpus_size
+        self.norms = self.k1 * (1 - self.b + self.b * doc_lens / self.avgdl)
+        self.idf = self._compute_idf(df)
+
+    def _compute_idf(self, df: ndarray) -> ndarray:
+        return bm25_idf(df, self.corpus_size, self.epsilon)
+
+    def set_collection_statistics(self, avgdl: float, idf: ndarray):
+        """
+        Scores with the statistics of a larger collection this index holds a part of, e.g. a shard.
+
+        With the average document length and the IDFs of the whole collection, every document scores as it
+        would in an index over the whole collection.
+
+        Args:
+            avgdl (float): The average document length of the collection.
+            idf (numpy.ndarray): The collection IDF of every term of `vocab`, in term id order.
+        """
+        self.avgdl = avgdl
+        self.norms = self.k1 * (1 - self.b + self.b * self.doc_lens / self.avgdl)
+        self.idf = idf
+
+    def get_scores(self, tokenized_query: list[str]) -> ndarray:
+        """
+        Computes the BM25 score of every document for the given query.
+
+        Only the postings of the query terms are scored; documents without any query term score 0.
+
+        Args:
+            tokenized_query (list[str]): The query tokens.
+
+        Returns:
+            numpy.ndarray: The score of every document in the corpus.
+        """
+        term_ids = [self.vocab[term] for term in tokenized_query if term in self.vocab]
+        if not term_ids:
+            return numpy.zeros(self.corpus_size)
+
+        # Postings are concatenated in query order, so per-document sums accumulate in the same order as BM25Okapi
+        slices = [slice(self.indptr[t], self.indptr[t + 1]) for t in term_ids]
+        doc_ids = numpy.concatenate([self.doc_ids[s] for s in slices])
+        tfs = numpy.concatenate([self.tfs[s] for s in slices]).astype(numpy.float64)
+        idf = numpy.repeat(self.idf[term_ids], [s.stop - s.start for s in slices])
+
+        weights = idf * (tfs * (self.k1 + 1) / (tfs + self.norms[doc_ids]))
+        return numpy.bincount(doc_ids, weights=weights, minlength=self.corpus_size)
+
+    def top_k(self, tokenized_query: list[str], k: int) -> tuple[ndarray, ndarray]:
+        """
+        Retrieves the k best scored documents for the given query.
+
+        Documents are ranked by descending score and ties are broken by ascending document id.
+
+        Args:
+            tokenized_query (list[str]): The query tokens.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            tuple: The ids of the top-k documents and their scores.
+        """
+        return top_k_scores(self.get_scores(tokenized_query), k)
+
+    def top_k_batch(self, tokenized_queries: list[list[str]], k: int) -> list[tuple[ndarray, ndarray]]:
+        """
+        Retrieves the k best scored documents of every query.
+
+        Args:
+            tokenized_queries (list[list[str]]): The tokens of every query.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            list[tuple]: The ids of the top-k documents of every query and their scores.
+        """
+        return [self.top_k(tokens, k) for tokens in tokenized_queries]
+
+
+def bm25_idf(df: ndarray, corpus_size: int, epsilon: float = 0.25) -> ndarray:
+    """
+    Computes the Okapi BM25 IDF of every term, flooring negative values at a fraction of the average IDF.
+
+    Args:
+        df (numpy.ndarray): The document frequency of every term, in term id order.
+        corpus_size (int): The number of documents.
+        epsilon (float, optional): Fraction of the average IDF used as floor for negative IDFs. Defaults to 0.25.
+
+    Returns:
+        numpy.ndarray: The IDF of every term.
+    """
+    idf = numpy.array([math.log(corpus_size - n + 0.5) - math.log(n + 0.5) for n in df.tolist()])
+    if len(idf) == 0:
+        return idf
+
+    # Sequential sum, so the floor is bit-for-bit the one rank_bm25 computes
+    average_idf = numpy.cumsum(idf)[-1] / len(idf)
+    idf[idf < 0] = epsilon * average_idf
+    return idf
+
+
+def top_k_scores(scores: ndarray, k: int) -> tuple[ndarray, ndarray]:
+    """
+    Selects the k highest scores in linear time.
+
+    Ties are broken by ascending position, which matches a stable descending sort of the full score list.
+
+    Args:
+        scores (numpy.ndarray): The score of every document.
+        k (int): The number of documents to select.
+
+    Returns:
+        tuple: The positions of the top-k scores and the scores themselves, best first.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=scores.dtype)
+
+    kth_score = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+    above = numpy.flatnonzero(scores > kth_score)
+    tied = numpy.flatnonzero(scores == kth_score)[: k - len(above)]
+    top = numpy.concatenate([above, tied])
+
+    top = top[numpy.lexsort((top, -scores[top]))]
+    return top, scores[top]
+
+
+class MutableBM25Index:
+    """
+    Okapi BM25 index that supports adding, updating and deleting documents under stable external ids.
+
+    Documents occupy slots. The postings of compacted slots are kept in CSR arrays like `BM25Index`, and the
+    postings of documents added since the last compaction in small per-term lists. Deleting a document
+    tombstones its slot: it is no longer returned and its terms leave the statistics right away, while its
+    postings stay until `compact` rebuilds the CSR arrays over the live slots. Document frequencies, IDF and
+    the average length always describe the live documents, so scores match a `BM25Index` built over them.
+
+    Reads and writes may come from different threads; writes must not run concurrently with each other.
+
+    Args:
+        k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+        b (float, optional): Document length normalization. Defaults to 0.75.
+        epsilon (float, optional): Fraction of the average IDF used as floor for negative IDFs. Defaults to 0.25.
+        analyzer (Callable, optional): The analyzer the documents are tokenized with, kept so that queries are
+            tokenized the same way.
+    """
+
+    def __init__(
+        self,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        analyzer: Callable[[str], list[str]] | None = None,
+    ):
+        self.analyzer = analyzer
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        # Bumped by every change, so cached results of an older state are not reused
+        self.version = 0
+
+        self.vocab: dict[str, int] = {}
+        self.df = numpy.zeros(0, dtype=numpy.int64)
+
+        self.indptr = numpy.zeros(1, dtype=numpy.int64)
+        self.doc_ids = numpy.empty(0, dtype=numpy.int32)
+        self.tfs = numpy.empty(0, dtype=numpy.int32)
+        self._compacted_slots = 0
+        self._pending: dict[int, tuple[list[int], list[int]]] = {}
+
+        self.slot_ids = numpy.empty(0, dtype=numpy.int64)
+        self.doc_lens = numpy.empty(0, dtype=numpy.int64)
+        self.live = numpy.empty(0, dtype=bool)
+        self.num_slots = 0
+        self._slots: dict[int, int] = {}
+        self._terms: list[tuple[ndarray, ndarray] | None] = []
+        self._total_len = 0
+
+        self._lock = threading.RLock()
+        self._stats: tuple[ndarray, ndarray] | None = None
+
+    @property
+    def corpus_size(self) -> int:
+        """
+        The number of live documents.
+        """
+        return len(self._slots)
+
+    @property
+    def tombstones(self) -> int:
+        """
+        The number of deleted documents whose postings are still stored.
+        """
+        return self.num_slots - len(self._slots)
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of documents added since the last compaction.
+        """
+        return self.num_slots - self._compacted_slots
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._slots
+
+    def add(self, doc_ids: list[int], tokenized_docs: list[list[str]]):
+        """
+        Adds documents. An id already in the index replaces its document.
+
+        Args:
+            doc_ids (list[int]): The external ids of the documents.
+            tokenized_docs (list[list[str]]): The tokens of every document.
+        """
+        with self._lock:
+            self.delete([doc_id for doc_id in doc_ids if doc_id in self._slots])
+            self._reserve(self.num_slots + len(doc_ids))
+
+            for doc_id, tokens in zip(doc_ids, tokenized_docs):
+                counts = Counter(tokens)
+                term_ids = numpy.fromiter(
+                    (self.vocab.setdefault(term, len(self.vocab)) for term in counts), dtype=numpy.int32
+                )
+                tfs = numpy.fromiter(counts.values(), dtype=numpy.int32)
+                if len(self.vocab) > len(self.df):
+                    df = numpy.zeros(max(len(self.vocab), 2 * len(self.df)), dtype=numpy.int64)
+                    df[: len(self.df)] = self.df
+                    self.df = df
+                self.df[term_ids] += 1
+
+                slot = self.num_slots
+                for term_id, tf in zip(term_ids.tolist(), tfs.tolist()):
+                    slots, term_tfs = self._pending.setdefault(term_id, ([], []))
+                    slots.append(slot)
+                    term_tfs.append(tf)
+
+                self.slot_ids[slot] = doc_id
+                self.doc_lens[slot] = len(tokens)
+                self.live[slot] = True
+                self._slots[doc_id] = slot
+                self._terms.append((term_ids, tfs))
+                self._total_len += len(tokens)
+                self.num_slots += 1
+
+            self._changed()
+
+    def delete(self, doc_ids: list[int]):
+        """
+        Deletes documents. Unknown ids are ignored.
+
+        Args:
+            doc_ids (list[int]): The external ids of the documents.
+        """
+        with self._lock:
+            for doc_id in doc_ids:
+                slot = self._slots.pop(doc_id, None)
+                if slot is None:
+                    continue
+                term_ids, _ = self._terms[slot]
+                self.df[term_ids] -= 1
+                self.live[slot] = False
+                self._terms[slot] = None
+                self._total_len -= int(self.doc_lens[slot])
+            self._changed()
+
+    def compact(self):
+        """
+        Rebuilds the CSR postings over the live documents, dropping tombstones and folding in the pending
+        postings. Terms left without documents are removed from the vocabulary.
+
+        Searches keep running on the previous postings while the new ones are built.
+        """
+        live_slots = numpy.flatnonzero(self.live[: self.num_slots])
+        terms = [self._terms[slot] for slot in live_slots.tolist()]
+        lengths = numpy.fromiter((len(term_ids) for term_ids, _ in terms), dtype=numpy.int64, count=len(terms))
+
+        keep = self.df > 0
+        remap = numpy.cumsum(keep) - 1
+        vocab = {term: int(remap[term_id]) for term, term_id in self.vocab.items() if keep[term_id]}
+        df = self.df[keep]
+
+        if terms:
+            term_ids = remap[numpy.concatenate([term_ids for term_ids, _ in terms])].astype(numpy.int32)
+            tfs = numpy.concatenate([tfs for _, tfs in terms])
+        else:
+            term_ids = numpy.empty(0, dtype=numpy.int32)
+            tfs = numpy.empty(0, dtype=numpy.int32)
+        doc_ids = numpy.repeat(numpy.arange(len(terms), dtype=numpy.int32), lengths)
+
+        order = numpy.argsort(term_ids, kind="stable")
+        indptr = numpy.zeros(len(vocab) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+        boundaries = numpy.cumsum(lengths)[:-1]
+        new_terms = list(zip(numpy.split(term_ids, boundaries), numpy.split(tfs, boundaries))) if terms else []
+
+        with self._lock:
+            self.vocab = vocab
+            self.df = df
+            self.indptr = indptr
+            self.doc_ids = doc_ids[order]
+            self.tfs = tfs[order]
+            self._pending = {}
+
+            self.slot_ids = self.slot_ids[live_slots]
+            self.doc_lens = self.doc_lens[live_slots]
+            self.live = numpy.ones(len(live_slots), dtype=bool)
+            self.num_slots = self._compacted_slots = len(live_slots)
+            self._slots = {doc_id: slot for slot, doc_id in enumerate(self.slot_ids.tolist())}
+            self._terms = new_terms
+            self._changed()
+
+    def get_scores(self, tokenized_query: list[str]) -> ndarray:
+        """
+        Computes the BM25 score of every slot for the given query. Deleted slots score -inf.
+
+        Args:
+            tokenized_query (list[str]): The query tokens.
+
+        Returns:
+            numpy.ndarray: The score of every slot; `slot_ids` maps slots to document ids.
+        """
+        with self._lock:
+            idf, norms = self._statistics()
+            term_ids = [self.vocab[term] for term in tokenized_query if term in self.vocab]
+
+            slot_parts, tf_parts, idf_parts = [], [], []
+            for term_id in term_ids:
+                # Terms first seen after the last compaction only have pending postings
+                if term_id < len(self.indptr) - 1:
+                    start, end = self.indptr[term_id], self.indptr[term_id + 1]
+                    slot_parts.append(self.doc_ids[start:end])
+                    tf_parts.append(self.tfs[start:end])
+                    idf_parts.append(numpy.full(end - start, idf[term_id]))
+                if term_id in self._pending:
+                    pending_slots, pending_tfs = self._pending[term_id]
+                    slot_parts.append(numpy.asarray(pending_slots, dtype=numpy.int32))
+                    tf_parts.append(numpy.asarray(pending_tfs, dtype=numpy.int32))
+                    idf_parts.append(numpy.full(len(pending_slots), idf[term_id]))
+
+            scores = numpy.zeros(self.num_slots)
+            if slot_parts:
+                slots = numpy.concatenate(slot_parts)
+                tfs = numpy.concatenate(tf_parts).astype(numpy.float64)
+                weights = numpy.concatenate(idf_parts) * (tfs * (self.k1 + 1) / (tfs + norms[slots]))
+                scores = numpy.bincount(slots, weights=weights, minlength=self.num_slots)
+            scores[~self.live[: self.num_slots]] = -numpy.inf
+            return scores
+
+    def top_k(self, tokenized_query: list[str], k: int) -> tuple[ndarray, ndarray]:
+        """
+        Retrieves the k best scored live documents for the given query.
+
+        Args:
+            tokenized_query (list[str]): The query tokens.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            tuple: The external ids of the top-k documents and their scores.
+        """
+        with self._lock:
+            scores = self.get_scores(tokenized_query)
+            slots, top_scores = top_k_scores(scores, min(k, self.corpus_size))
+            return self.slot_ids[slots], top_scores
+
+    def top_k_batch(self, tokenized_queries: list[list[str]], k: int) -> list[tuple[ndarray, ndarray]]:
+        """
+        Retrieves the k best scored live documents of every query.
+
+        Args:
+            tokenized_queries (list[list[str]]): The tokens of every query.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            list[tuple]: The external ids of the top-k documents of every query and their scores.
+        """
+        return [self.top_k(tokens, k) for tokens in tokenized_queries]
+
+    def _reserve(self, capacity: int):
+        if capacity <= len(self.slot_ids):
+            return
+        capacity = max(capacity, 2 * len(self.slot_ids))
+        self.slot_ids = numpy.resize(self.slot_ids, capacity)
+        self.doc_lens = numpy.resize(self.doc_lens, capacity)
+        self.live = numpy.resize(self.live, capacity)
+
+    def _changed(self):
+        self._stats = None
+        self.version += 1
+
+    def _statistics(self) -> tuple[ndarray, ndarray]:
+        # Recomputed on the first query after a change: O(terms + slots) vector operations
+        if self._stats is None:
+            n = self.corpus_size
+            present = self.df > 0
+            idf = numpy.log(n - self.df + 0.5) - numpy.log(self.df + 0.5)
+            if present.any():
+                idf[(idf < 0) & present] = self.epsilon * idf[present].mean()
+
+            avgdl = self._total_len / n if n else 1.0
+            norms = self.k1 * (1 - self.b + self.b * self.doc_lens[: self.num_slots] / (avgdl or 1.0))
+            self._stats = idf, norms
+        return self._stats
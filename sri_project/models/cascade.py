@@ -0,0 +1,353 @@
+import math
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import TYPE_CHECKING, Callable
+
+import faiss
+import numpy
+from numpy import ndarray
+
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.bm25_index import BM25Index, top_k_scores
+from sri_project.models.dpr import encode_query
+from sri_project.models.hybrid import min_max_normalize
+from sri_project.models.reranker import lookup_passage_embeddings
+from sri_project.utils.tracing import Histogram, span
+from sri_project.utils.utils import get_retrieved_docs
+
+if TYPE_CHECKING:
+    import torch
+
+CROSS_ENCODER_MODEL_ID = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+STAGES = ("candidates", "rescore", "cross_encoder")
+
+# Observations of a stage needed before its p95 is trusted to skip it
+MIN_COST_SAMPLES = 5
+
+# The p95 of a stage is estimated from at most its last COST_WINDOW observations, none older than COST_MAX_AGE_S
+# seconds, so the estimate follows changes of load and a slow spell is forgotten
+COST_WINDOW = 100
+COST_MAX_AGE_S = 30.0
+
+# A stage skipped for its cost runs anyway on every this many skips, so its cost estimate is kept up to date
+PROBE_EVERY = 10
+
+# Stage costs from 10 µs to 10 s in steps of about 12%, finer than the tracing buckets for the reported percentiles
+COST_BUCKETS = tuple(numpy.geomspace(1e-5, 10.0, 61).tolist())
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cascade-bm25")
+
+
+@cache
+def get_cross_encoder(model_id: str = CROSS_ENCODER_MODEL_ID) -> tuple:
+    """
+    Returns the tokenizer and model of a cross-encoder, loading them on first use.
+
+    Args:
+        model_id (str, optional): A sequence classification model scoring (query, passage) pairs. Defaults to
+            `CROSS_ENCODER_MODEL_ID`.
+
+    Returns:
+        tuple: The tokenizer and the model.
+    """
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_id), AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+
+
+def cross_encode(query: str, passages: list[str], model_id: str = CROSS_ENCODER_MODEL_ID, max_length: int = 256):
+    """
+    Scores the relevance of passages to a query with a cross-encoder, in one batch.
+
+    Args:
+        query (str): The query.
+        passages (list[str]): The passages.
+        model_id (str, optional): The cross-encoder model ID. Defaults to `CROSS_ENCODER_MODEL_ID`.
+        max_length (int, optional): The maximum length of a (query, passage) pair. Defaults to 256.
+
+    Returns:
+        numpy.ndarray: The relevance score of every passage, higher is better.
+    """
+    import torch
+
+    tokenizer, model = get_cross_encoder(model_id)
+    inputs = tokenizer(
+        [query] * len(passages), passages, padding=True, truncation=True, max_length=max_length, return_tensors="pt"
+    )
+    with torch.no_grad():
+        logits = model(**inputs).logits
+    # Single-logit models output the score itself; classifiers have the "relevant" class last
+    return logits[:, -1].numpy().astype(numpy.float64)
+
+
+class RetrievalCascade:
+    """
+    Retrieves in stages of increasing cost per candidate, each narrowing the candidates of the previous one, within
+    a latency budget.
+
+    1. candidates: the top `candidates` of BM25 and of DPR, fused by reciprocal rank.
+    2. rescore: the cosine similarity of the candidate embeddings, read from the DPR index, to the query, fused
+       with the normalized first-stage score. The best `rescore_k` move to the front, ahead of the other candidates
+       in their first-stage order, so a request for more than `rescore_k` passages still gets them.
+    3. cross_encoder: the best `cross_encoder_k` are reordered by a cross-encoder. Off unless `cross_encoder_k` is
+       set.
+
+    A stage is skipped when the p95 of its recent costs (the last `COST_WINDOW`, up to `COST_MAX_AGE_S` old) does
+    not fit in what is left of the request budget or exceeds its own stage budget, so requests keep to the budget at
+    the p95 instead of overrunning it and then exiting. Every `PROBE_EVERY`-th such skip runs the stage anyway, so a
+    stage skipped after a slow spell is measured again and comes back once it is fast. The cross-encoder is also
+    skipped when the rescored leader is ahead of the runner-up by `margin`. Candidates are always generated. The
+    models of the optional stages are loaded when the cascade is created, so loading them is never taken for a stage
+    cost. Costs over the life of the cascade are kept in a latency histogram per stage for `stats`; `reset_costs`
+    starts measuring again.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index holding the passage embeddings.
+        candidates (int, optional): The candidates taken from each source. Defaults to 100.
+        sources (tuple[str, ...], optional): The candidate sources, "bm25" and/or "dpr". Defaults to both.
+        rescore_k (int, optional): The candidates ranked first by the rescoring stage. Defaults to 20.
+        weight (float, optional): The weight of the DPR similarity in the rescored score. Defaults to 0.7.
+        cross_encoder_k (int, optional): The candidates reordered by the cross-encoder; 0 disables the stage.
+            Defaults to 0.
+        cross_encoder_model (str, optional): The cross-encoder model ID. Defaults to `CROSS_ENCODER_MODEL_ID`.
+        budget_ms (float, optional): The latency budget of a request. Defaults to no budget.
+        stage_budgets_ms (dict[str, float], optional): The maximum p95 cost of each optional stage, by name.
+        margin (float, optional): The lead of the rescored top passage that makes the cross-encoder unnecessary.
+            Defaults to never skipping it.
+        query_encoder (Callable, optional): Encodes a single query, e.g. a cached `encode_query`. Defaults to
+            `encode_query`.
+    """
+
+    def __init__(
+        self,
+        bm25: BM25Index,
+        dpr_index: faiss.Index,
+        candidates: int = 100,
+        sources: tuple[str, ...] = ("bm25", "dpr"),
+        rescore_k: int = 20,
+        weight: float = 0.7,
+        cross_encoder_k: int = 0,
+        cross_encoder_model: str = CROSS_ENCODER_MODEL_ID,
+        budget_ms: float | None = None,
+        stage_budgets_ms: dict[str, float] | None = None,
+        margin: float | None = None,
+        query_encoder: Callable[[str], "torch.Tensor"] = encode_query,
+    ):
+        unknown = set(sources) - {"bm25", "dpr"}
+        if unknown or not sources:
+            raise ValueError(f"Unknown candidate sources {sorted(unknown)}, expected 'bm25' and/or 'dpr'")
+
+        self.bm25 = bm25
+        self.dpr_index = dpr_index
+        self.candidates = candidates
+        self.sources = sources
+        self.rescore_k = rescore_k
+        self.weight = weight
+        self.cross_encoder_k = cross_encoder_k
+        self.cross_encoder_model = cross_encoder_model
+        self.budget_ms = budget_ms
+        self.stage_budgets_ms = stage_budgets_ms or {}
+        self.margin = margin
+        self.query_encoder = query_encoder
+
+        self.costs = {stage: Histogram(COST_BUCKETS) for stage in STAGES}
+        self._recent_costs = {stage: deque(maxlen=COST_WINDOW) for stage in STAGES}
+        self._skips = Counter()
+        self._costs_lock = threading.Lock()
+        self.exits: Counter = Counter()
+        self._exits_lock = threading.Lock()
+
+        self._warm_up()
+
+    def _warm_up(self):
+        # Loads the models of the optional stages and runs them once, outside the cost accounting
+        if self.rescore_k > 0 and "dpr" not in self.sources:
+            self.query_encoder("")
+        if self.cross_encoder_k > 0:
+            cross_encode("", [""], self.cross_encoder_model)
+
+    def _observe(self, stage: str, elapsed: float):
+        self.costs[stage].observe(elapsed)
+        with self._costs_lock:
+            self._recent_costs[stage].append((time.monotonic(), elapsed))
+
+    def _skip_reason(self, stage: str, elapsed_ms: float, budget_ms: float | None) -> str | None:
+        if budget_ms is not None and elapsed_ms >= budget_ms:
+            return "budget"
+
+        with self._costs_lock:
+            window = self._recent_costs[stage]
+            while window and window[0][0] < time.monotonic() - COST_MAX_AGE_S:
+                window.popleft()
+            recent = sorted(cost for _, cost in window)
+        if len(recent) < MIN_COST_SAMPLES:
+            return None
+        p95_ms = recent[int(0.95 * (len(recent) - 1))] * 1000
+
+        reason = None
+        if p95_ms > self.stage_budgets_ms.get(stage, math.inf):
+            reason = "stage_budget"
+        elif budget_ms is not None and elapsed_ms + p95_ms > budget_ms:
+            reason = "budget"
+        if reason is not None:
+            with self._costs_lock:
+                self._skips[stage] += 1
+                if self._skips[stage] >= PROBE_EVERY:
+                    self._skips[stage] = 0
+                    return None
+        return reason
+
+    def _candidates(self, query: str) -> tuple[ndarray, ndarray, ndarray | None]:
+        bm25_future = (
+            _executor.submit(bm25_retrieve, query, self.bm25, self.candidates) if "bm25" in self.sources else None
+        )
+
+        rankings = []
+        query_embedding = None
+        if "dpr" in self.sources:
+            query_embedding = self.query_encoder(query).numpy()
+            _, dpr_results = self.dpr_index.search(query_embedding, self.candidates)
+            # FAISS pads with -1 when the index holds fewer passages
+            rankings.append(dpr_results[0][dpr_results[0] >= 0])
+        if bm25_future is not None:
+            rankings.insert(0, numpy.asarray(bm25_future.result()[0], dtype=numpy.int64))
+
+        # Reciprocal rank fusion, with the constant of `HybridRetriever`
+        ids = numpy.unique(numpy.concatenate(rankings))
+        scores = numpy.zeros(len(ids))
+        for ranking in rankings:
+            scores[numpy.searchsorted(ids, ranking)] += 1.0 / (60 + numpy.arange(1, len(ranking) + 1))
+
+        order = numpy.argsort(-scores, kind="stable")
+        return ids[order], scores[order], query_embedding
+
+    def _rescore(self, query: str, ids: ndarray, scores: ndarray, query_embedding: ndarray | None):
+        if query_embedding is None:
+            query_embedding = self.query_encoder(query).numpy()
+        query_embedding = query_embedding[0]
+
+        embeddings = lookup_passage_embeddings(self.dpr_index, ids.tolist())
+        similarities = embeddings @ query_embedding
+        similarities /= numpy.maximum(numpy.linalg.norm(embeddings, axis=1) * numpy.linalg.norm(query_embedding), 1e-8)
+        fused = self.weight * similarities + (1 - self.weight) * min_max_normalize(scores)
+
+        positions, rescored = top_k_scores(fused, self.rescore_k)
+        rest = numpy.ones(len(ids), dtype=bool)
+        rest[positions] = False
+        return numpy.concatenate([ids[positions], ids[rest]]), numpy.concatenate([rescored, scores[rest]])
+
+    def _cross_encode(self, query: str, ids: ndarray, scores: ndarray) -> tuple[ndarray, ndarray]:
+        top = min(self.cross_encoder_k, len(ids))
+        cross_scores = cross_encode(query, get_retrieved_docs(ids[:top].tolist()), self.cross_encoder_model)
+        order = numpy.argsort(-cross_scores, kind="stable")
+        return (
+            numpy.concatenate([ids[:top][order], ids[top:]]),
+            numpy.concatenate([cross_scores[order], scores[top:]]),
+        )
+
+    def retrieve_with_report(
+        self, query: str, k: int = 10, budget_ms: float | None = None
+    ) -> tuple[list[int], list[float], dict]:
+        """
+        Retrieves the k best passages for the query and reports what every stage cost.
+
+        Every passage keeps the score of the last stage that ranked it, so the scores come in blocks on different
+        scales: cross-encoder scores for the first `cross_encoder_k`, fused rescoring scores for the rest of the
+        first `rescore_k`, and first-stage reciprocal rank scores after that, for the stages that ran. Scores are
+        only comparable, and only descending, within a block.
+
+        Args:
+            query (str): The query string.
+            k (int, optional): The number of passages to return. Defaults to 10.
+            budget_ms (float, optional): The latency budget of this request. Defaults to `budget_ms`.
+
+        Returns:
+            tuple: The passage indices, their scores from the last stage that ranked them, and a report with the
+            milliseconds spent in every stage run ("stages"), the total ("total_ms") and why the cascade stopped
+            ("exit": "complete", "budget", "stage_budget" or "margin").
+        """
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        start_time = time.perf_counter()
+        stage_ms = {}
+        exit_reason = "complete"
+
+        def run(stage: str, fn, *args):
+            stage_start = time.perf_counter()
+            with span(f"cascade.{stage}"):
+                result = fn(*args)
+            elapsed = time.perf_counter() - stage_start
+            self._observe(stage, elapsed)
+            stage_ms[stage] = elapsed * 1000
+            return result
+
+        ids, scores, query_embedding = run("candidates", self._candidates, query)
+
+        pipeline = [("rescore", self.rescore_k > 0), ("cross_encoder", self.cross_encoder_k > 0)]
+        for stage, enabled in pipeline:
+            if not enabled or not len(ids):
+                continue
+            if stage == "cross_encoder" and self.margin is not None and len(scores) > 1:
+                if scores[0] - scores[1] >= self.margin:
+                    exit_reason = "margin"
+                    break
+            skip_reason = self._skip_reason(stage, (time.perf_counter() - start_time) * 1000, budget_ms)
+            if skip_reason is not None:
+                exit_reason = skip_reason
+                break
+
+            if stage == "rescore":
+                ids, scores = run(stage, self._rescore, query, ids, scores, query_embedding)
+            else:
+                ids, scores = run(stage, self._cross_encode, query, ids, scores)
+
+        with self._exits_lock:
+            self.exits[exit_reason] += 1
+
+        report = {"stages": stage_ms, "total_ms": (time.perf_counter() - start_time) * 1000, "exit": exit_reason}
+        return ids[:k].tolist(), numpy.asarray(scores[:k], dtype=numpy.float64).tolist(), report
+
+    def retrieve(self, query: str, k: int = 10, budget_ms: float | None = None) -> tuple[list[int], list[float]]:
+        """
+        Retrieves the k best passages for the query within the latency budget.
+
+        Scores past the first `rescore_k` (or `cross_encoder_k`) come from an earlier stage, on another scale; see
+        `retrieve_with_report`.
+
+        Args:
+            query (str): The query string.
+            k (int, optional): The number of passages to return. Defaults to 10.
+            budget_ms (float, optional): The latency budget of this request. Defaults to `budget_ms`.
+
+        Returns:
+            tuple: The indices of the retrieved passages and their scores.
+        """
+        ids, scores, _ = self.retrieve_with_report(query, k, budget_ms)
+        return ids, scores
+
+    def reset_costs(self):
+        """
+        Discards the recorded stage costs and exit counts.
+        """
+        self.costs = {stage: Histogram(COST_BUCKETS) for stage in STAGES}
+        with self._costs_lock:
+            self._recent_costs = {stage: deque(maxlen=COST_WINDOW) for stage in STAGES}
+            self._skips.clear()
+        with self._exits_lock:
+            self.exits.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cost of every stage and how often the cascade stopped for each reason.
+
+        Returns:
+            dict: The `Histogram.snapshot` of every stage under "stages", in seconds, and the exit counts under
+            "exits".
+        """
+        with self._exits_lock:
+            exits = dict(self.exits)
+        return {"stages": {stage: cost.snapshot() for stage, cost in self.costs.items()}, "exits": exits}
@@ -0,0 +1,206 @@
+import threading
+
+import numpy
+from numpy import ndarray
+
+from .analyzers import Analyzer, get_analyzer
+from .bm25_index import MutableBM25Index
+from .dpr import encode_passages, passage_embedding_dim
+from .embedding_store import update_store
+from .faiss_index import MutableIndex, build_index
+
+
+class DocumentStore:
+    """
+    Passages under stable external ids, indexed by a BM25 and a DPR index that are updated in place.
+
+    `add`, `update` and `delete` touch only the given passages: BM25 statistics are adjusted incrementally and
+    the vectors are added to or tombstoned in the FAISS index. Tombstones and the BM25 postings added since the
+    last compaction are folded in by `compact`, which a background thread can run whenever they pile up.
+
+    `bm25` and `dpr_index` can be passed to the retrieval functions in place of the static indexes; the ids they
+    return are the store ids, resolved to passages with `get`.
+
+    Args:
+        dpr_index (faiss.Index): An empty, trained index from `build_index(..., add=False)`.
+        analyzer (Analyzer | str, optional): The BM25 analyzer or tokenizer name. Defaults to NLTK.
+        k1 (float, optional): BM25 term frequency saturation. Defaults to 1.5.
+        b (float, optional): BM25 document length normalization. Defaults to 0.75.
+        compaction_ratio (float, optional): The fraction of tombstoned or uncompacted passages that makes
+            the background compaction run. Defaults to 0.1.
+    """
+
+    def __init__(
+        self,
+        dpr_index,
+        analyzer: Analyzer | str | None = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        compaction_ratio: float = 0.1,
+    ):
+        self.analyzer = get_analyzer(analyzer)
+        self.bm25 = MutableBM25Index(k1, b, analyzer=self.analyzer)
+        self.dpr_index = MutableIndex(dpr_index)
+        self.compaction_ratio = compaction_ratio
+
+        self._passages: dict[int, str] = {}
+        self._next_id = 0
+        # Serializes writers; searches only take the lock of the index they read
+        self._write_lock = threading.Lock()
+        self._stop_compaction: threading.Event | None = None
+
+    @classmethod
+    def from_corpus(
+        cls,
+        corpus: list[str],
+        store_dir: str | None = None,
+        index_type: str = "flat",
+        analyzer: Analyzer | str | None = None,
+        **index_params,
+    ) -> "DocumentStore":
+        """
+        Builds a document store holding the corpus, with the corpus positions as ids.
+
+        Args:
+            corpus (list[str]): The passages.
+            store_dir (str, optional): The embedding store to take the passage embeddings from. If None, the
+                corpus is encoded in memory.
+            index_type (str, optional): The type of Faiss index. Defaults to "flat".
+            analyzer (Analyzer | str, optional): The BM25 analyzer or tokenizer name. Defaults to NLTK.
+            **index_params: Build parameters of the index type, see `faiss_index.build_index`.
+
+        Returns:
+            DocumentStore: The store.
+        """
+        if not corpus:
+            embeddings = numpy.empty((0, passage_embedding_dim()), dtype=numpy.float32)
+        elif store_dir is None:
+            embeddings = encode_passages(corpus)
+        else:
+            corpus_rows, stored = update_store(corpus, store_dir)
+            embeddings = numpy.ascontiguousarray(stored[corpus_rows])
+
+        store = cls(build_index(embeddings, index_type, add=False, **index_params), analyzer)
+        store.add(corpus, embeddings)
+        store.compact()
+        return store
+
+    def __len__(self) -> int:
+        return len(self._passages)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._passages
+
+    def get(self, doc_ids: list[int]) -> list[str]:
+        """
+        Returns the passages of the given ids.
+
+        Args:
+            doc_ids (list[int]): The store ids.
+
+        Returns:
+            list[str]: The passages.
+        """
+        return [self._passages[doc_id] for doc_id in doc_ids]
+
+    def add(self, passages: list[str], embeddings: ndarray | None = None) -> list[int]:
+        """
+        Adds passages under new ids.
+
+        Args:
+            passages (list[str]): The passages to add.
+            embeddings (numpy.ndarray, optional): Their DPR embeddings. Encoded if not given.
+
+        Returns:
+            list[int]: The ids of the passages.
+        """
+        tokenized, embeddings = self._prepare(passages, embeddings)
+        with self._write_lock:
+            doc_ids = list(range(self._next_id, self._next_id + len(passages)))
+            self._next_id += len(passages)
+            self._index(doc_ids, passages, tokenized, embeddings)
+        return doc_ids
+
+    def update(self, doc_ids: list[int], passages: list[str], embeddings: ndarray | None = None):
+        """
+        Replaces the passages of existing ids, or adds them under the given ids.
+
+        Args:
+            doc_ids (list[int]): The store ids.
+            passages (list[str]): The new passages.
+            embeddings (numpy.ndarray, optional): Their DPR embeddings. Encoded if not given.
+        """
+        tokenized, embeddings = self._prepare(passages, embeddings)
+        with self._write_lock:
+            self._next_id = max([self._next_id, *(doc_id + 1 for doc_id in doc_ids)])
+            self._index(doc_ids, passages, tokenized, embeddings)
+
+    def delete(self, doc_ids: list[int]):
+        """
+        Deletes passages. They stop being retrieved at once; their space is reclaimed by `compact`.
+
+        Args:
+            doc_ids (list[int]): The store ids. Unknown ids are ignored.
+        """
+        with self._write_lock:
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in self._passages]
+            self.bm25.delete(doc_ids)
+            self.dpr_index.delete(numpy.asarray(doc_ids, dtype=numpy.int64))
+            for doc_id in doc_ids:
+                del self._passages[doc_id]
+
+    def _prepare(self, passages: list[str], embeddings: ndarray | None) -> tuple[list[list[str]], ndarray]:
+        # Tokenizing and encoding run before taking the write lock, so concurrent writers only wait for the
+        # index updates themselves
+        if embeddings is None:
+            embeddings = encode_passages(passages)
+        return self.analyzer.analyze_batch(passages), embeddings
+
+    def _index(self, doc_ids: list[int], passages: list[str], tokenized: list[list[str]], embeddings: ndarray):
+        self.bm25.add(doc_ids, tokenized)
+        self.dpr_index.add(numpy.asarray(doc_ids, dtype=numpy.int64), embeddings)
+        self._passages.update(zip(doc_ids, passages))
+
+    def needs_compaction(self) -> bool:
+        """
+        Tells whether tombstones or uncompacted BM25 postings exceed the compaction ratio.
+
+        Returns:
+            bool: True if `compact` is due.
+        """
+        stale = max(self.bm25.tombstones + self.bm25.pending, self.dpr_index.tombstones)
+        return stale > self.compaction_ratio * max(len(self), 1)
+
+    def compact(self):
+        """
+        Drops the tombstoned passages from both indexes and folds the pending BM25 postings into the CSR arrays.
+        """
+        with self._write_lock:
+            self.bm25.compact()
+            self.dpr_index.compact()
+
+    def start_compaction(self, interval: float = 30.0):
+        """
+        Starts a daemon thread that compacts the store every `interval` seconds when `needs_compaction`.
+
+        Args:
+            interval (float, optional): The number of seconds between checks. Defaults to 30.
+        """
+        if self._stop_compaction is not None:
+            return
+        self._stop_compaction = stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                if self.needs_compaction():
+                    self.compact()
+
+        threading.Thread(target=run, name="document-store-compaction", daemon=True).start()
+
+    def stop_compaction(self):
+        """
+        Stops the background compaction thread.
+        """
+        if self._stop_compaction is not None:
+            self._stop_compaction.set()
+            self._stop_compaction = None
@@ -1,58 +1,120 @@
+import faiss
 import numpy
-import torch
-from faiss import IndexFlatIP
 from numpy import ndarray
 
-from .dpr_models import context_encoder, context_tokenizer, question_encoder, question_tokenizer
+from sri_project.utils.tracing import span
 
+from .dpr_models import get_context_encoder, get_context_tokenizer, get_question_encoder, get_question_tokenizer
+from .faiss_index import RescoringIndex, build_index
 
-def encode_passages(passages: list[str], max_length: int = 1024, batch_size: int = 10000) -> ndarray:
+
+def passage_embedding_dim() -> int:
+    """
+    Returns the dimension of the embeddings produced by the context encoder.
+
+    Returns:
+        int: The embedding dimension.
+    """
+    return get_context_encoder().config.hidden_size
+
+
+def length_batches(lengths: ndarray, token_budget: int) -> list[ndarray]:
+    """
+    Groups sequences of similar length into micro-batches whose padded size fits in a token budget.
+
+    Sequences are sorted by length, so each micro-batch is padded to a length close to that of all its members.
+
+    Args:
+        lengths (numpy.ndarray): The number of tokens of every sequence.
+        token_budget (int): The maximum number of tokens (batch size times padded length) of a micro-batch.
+
+    Returns:
+        list[numpy.ndarray]: The positions of the sequences in every micro-batch.
+    """
+    order = numpy.argsort(lengths, kind="stable")
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        # The last sequence added is the longest, so it sets the padded length of the batch
+        if end == len(order) or (end - start + 1) * lengths[order[end]] > token_budget:
+            batches.append(order[start:end])
+            start = end
+    return batches
+
+
+def encode_passages(
+    passages: list[str],
+    max_length: int = 512,
+    token_budget: int = 16384,
+    chunk_size: int = 4096,
+    out: ndarray | None = None,
+) -> ndarray:
     """
     Encodes the given passages into embeddings using a context encoder.
 
+    Passages are tokenized a chunk at a time, grouped into length buckets and run through the encoder in
+    micro-batches sized by a token budget, so memory stays bounded and little work is spent on padding.
+    Embeddings are written in place as they are computed.
+
     Args:
         passages (list[str]): A list of passages to be encoded.
         max_length (int, optional): The maximum length of the encoded passages. Defaults to 512.
-        batch_size (int, optional): The batch size for encoding the passages. Defaults to 10000.
+        token_budget (int, optional): The maximum number of tokens in a micro-batch. Defaults to 16384.
+        chunk_size (int, optional): The number of passages tokenized at a time. Defaults to 4096.
+        out (numpy.ndarray, optional): A preallocated (passages x dim) float32 array or memmap to write the
+            embeddings to. If None, a new array is allocated.
 
     Returns:
         numpy.ndarray: An array of embeddings representing the encoded passages.
     """
+    return _encode(passages, get_context_tokenizer(), get_context_encoder(), max_length, token_budget, chunk_size, out)
+
+
+def _encode(
+    texts: list[str], tokenizer, encoder, max_length: int, token_budget: int, chunk_size: int, out: ndarray | None
+) -> ndarray:
+    # torch is imported on the first encoding call, so importing this module stays cheap
+    import torch
+
+    max_length = min(max_length, encoder.config.max_position_embeddings)
+
+    if out is None:
+        out = numpy.empty((len(texts), encoder.config.hidden_size), dtype=numpy.float32)
 
-    all_embeddings = []
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start : start + chunk_size]
+        with span("encode.tokenize"):
+            input_ids = tokenizer(chunk, truncation=True, max_length=max_length)["input_ids"]
+        lengths = numpy.fromiter((len(ids) for ids in input_ids), dtype=numpy.int64, count=len(input_ids))
 
-    for i in range(0, len(passages), batch_size):
-        batch_passages = passages[i : i + batch_size]
-        inputs = context_tokenizer(
-            batch_passages, return_tensors="pt", padding=True, truncation=True, max_length=max_length
-        )
+        for batch in length_batches(lengths, token_budget):
+            inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt")
 
-        with torch.no_grad():
-            embeddings = context_encoder(**inputs).pooler_output
+            with torch.no_grad(), span("encode.forward"):
+                embeddings = encoder(**inputs).pooler_output
 
-        all_embeddings.append(embeddings.numpy())
+            out[start + batch] = embeddings.numpy()
 
-    return numpy.vstack(all_embeddings)
+    return out
 
 
-def create_faiss_index(embeddings: ndarray) -> IndexFlatIP:
+def create_faiss_index(embeddings: ndarray, index_type: str = "flat", **index_params) -> faiss.Index:
     """
     Create a Faiss index for the given embeddings.
 
     Parameters:
     embeddings (numpy.ndarray): The embeddings to be indexed.
+    index_type (str): One of "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw". Defaults to "flat".
+    **index_params: Build parameters of the index type, see `faiss_index.build_index`.
 
     Returns:
-    faiss.IndexFlatIP: The Faiss index object.
+    faiss.Index: The Faiss index object.
 
     """
-    dimension = embeddings.shape[1]
-    index = IndexFlatIP(dimension)
-    index.add(embeddings)
-    return index
+    return build_index(embeddings, index_type, **index_params)
 
 
-def encode_query(query: str, max_length: int = 1024):
+def encode_query(query: str, max_length: int = 512):
     """
     Encodes the given query using the question_tokenizer and question_encoder models.
 
@@ -63,29 +125,61 @@ def encode_query(query: str, max_length: int = 1024):
     Returns:
         numpy.ndarray: The encoded query as a numpy array.
     """
-    inputs = question_tokenizer(query, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
-    with torch.no_grad():
-        query_embedding = question_encoder(**inputs).pooler_output
-    return query_embedding
+    import torch
+
+    with span("encode_query"):
+        with span("encode_query.tokenize"):
+            inputs = get_question_tokenizer()(
+                query, return_tensors="pt", padding=True, truncation=True, max_length=max_length
+            )
+        with torch.no_grad(), span("encode_query.forward"):
+            query_embedding = get_question_encoder()(**inputs).pooler_output
+        return query_embedding
+
+
+def encode_queries(
+    queries: list[str], max_length: int = 512, token_budget: int = 8192, chunk_size: int = 4096
+) -> ndarray:
+    """
+    Encodes a batch of queries with the question encoder, in padded micro-batches of similar length.
+
+    Args:
+        queries (list[str]): The queries to be encoded.
+        max_length (int, optional): The maximum length of the encoded queries. Defaults to 512.
+        token_budget (int, optional): The maximum number of tokens in a micro-batch. Defaults to 8192.
+        chunk_size (int, optional): The number of queries tokenized at a time. Defaults to 4096.
+
+    Returns:
+        numpy.ndarray: A (queries x dim) float32 array of query embeddings.
+    """
+    return _encode(
+        queries, get_question_tokenizer(), get_question_encoder(), max_length, token_budget, chunk_size, None
+    )
 
 
-def create_index(corpus: list[str]) -> IndexFlatIP:
+def create_index(corpus: list[str], index_type: str = "flat", rescore: int = 4, **index_params) -> faiss.Index:
     """
     Creates an index for the given corpus.
 
     Parameters:
     corpus (list[str]): A list of passages in the corpus.
+    index_type (str): The type of Faiss index to build. Defaults to "flat".
+    rescore (int): With a compressed `storage`, the candidates per result rescored with the full embeddings,
+        which are then kept in memory. 0 searches the compressed index alone. Defaults to 4.
+    **index_params: Build parameters of the index type, see `faiss_index.build_index`.
 
     Returns:
     index: The created index.
 
     """
     passage_embeddings = encode_passages(corpus)
-    index = create_faiss_index(passage_embeddings)
+    index = create_faiss_index(passage_embeddings, index_type, **index_params)
+    if index_params.get("storage", "float32") != "float32" and rescore:
+        return RescoringIndex(index, passage_embeddings, rescore=rescore)
     return index
 
 
-def retrieve_top_k_passages(index: IndexFlatIP, query: str, k: int = 3) -> tuple[ndarray, list[int]]:
+def retrieve_top_k_passages(index: faiss.Index, query: str, k: int = 3) -> tuple[ndarray, list[int]]:
     """
     Retrieve the top k passages from the given index based on the query.
 
@@ -97,5 +191,30 @@ def retrieve_top_k_passages(index: IndexFlatIP, query: str, k: int = 3) -> tuple
     Returns:
         list: A list of passage indices representing the top k passages.
     """
-    D, results = index.search(encode_query(query), k)
-    return D[0], results[0].tolist()
+    with span("dpr"):
+        query_embedding = encode_query(query)
+        with span("dpr.search"):
+            D, results = index.search(query_embedding, k)
+        return D[0], results[0].tolist()
+
+
+def retrieve_top_k_passages_batch(
+    index: faiss.Index, queries: list[str], k: int = 3
+) -> tuple[ndarray, list[list[int]]]:
+    """
+    Retrieve the top k passages for every query with a single encoding pass and a single index search.
+
+    Parameters:
+        index (object): The index object used for searching.
+        queries (list[str]): The query strings.
+        k (int, optional): The number of passages to retrieve per query. Defaults to 3.
+
+    Returns:
+        tuple: A (queries x k) array of scores and the passage indices retrieved for every query.
+    """
+    if not queries:
+        return numpy.empty((0, k), dtype=numpy.float32), []
+    query_embeddings = encode_queries(queries)
+    with span("dpr.batch.search"):
+        D, results = index.search(query_embeddings, k)
+    return D, results.tolist()
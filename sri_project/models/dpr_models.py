@@ -1,7 +1,117 @@
-from transformers import DPRContextEncoder, DPRContextEncoderTokenizer, DPRQuestionEncoder, DPRQuestionEncoderTokenizer
+import os
+from functools import cache
 
-context_tokenizer = DPRContextEncoderTokenizer.from_pretrained("facebook/dpr-ctx_encoder-single-nq-base")
-context_encoder = DPRContextEncoder.from_pretrained("facebook/dpr-ctx_encoder-single-nq-base")
+from .encoder_backends import BACKENDS, load_encoder
 
-question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained("facebook/dpr-question_encoder-single-nq-base")
-question_encoder = DPRQuestionEncoder.from_pretrained("facebook/dpr-question_encoder-single-nq-base")
+CONTEXT_MODEL_ID = "facebook/dpr-ctx_encoder-single-nq-base"
+QUESTION_MODEL_ID = "facebook/dpr-question_encoder-single-nq-base"
+
+# Inference backend of both encoders, see `encoder_backends.load_encoder`
+_backend = os.environ.get("SRI_DPR_BACKEND", "torch")
+
+# Models are loaded on first use, so importing the package does not pull in transformers or download weights.
+# The old module attributes (context_encoder, question_tokenizer, ...) still resolve through __getattr__.
+
+
+@cache
+def get_context_tokenizer():
+    """
+    Returns the DPR context tokenizer, loading it on first use.
+    """
+    from transformers import DPRContextEncoderTokenizer
+
+    return DPRContextEncoderTokenizer.from_pretrained(CONTEXT_MODEL_ID)
+
+
+@cache
+def get_context_encoder():
+    """
+    Returns the DPR context encoder, loading it on first use.
+    """
+    from transformers import DPRContextEncoder
+
+    return load_encoder(DPRContextEncoder, CONTEXT_MODEL_ID, _backend)
+
+
+@cache
+def get_question_tokenizer():
+    """
+    Returns the DPR question tokenizer, loading it on first use.
+    """
+    from transformers import DPRQuestionEncoderTokenizer
+
+    return DPRQuestionEncoderTokenizer.from_pretrained(QUESTION_MODEL_ID)
+
+
+@cache
+def get_question_encoder():
+    """
+    Returns the DPR question encoder, loading it on first use.
+    """
+    from transformers import DPRQuestionEncoder
+
+    return load_encoder(DPRQuestionEncoder, QUESTION_MODEL_ID, _backend)
+
+
+def get_backend() -> str:
+    """
+    Returns the inference backend of the DPR encoders.
+    """
+    return _backend
+
+
+def set_backend(backend: str):
+    """
+    Selects the inference backend of the DPR encoders. They are reloaded on next use.
+
+    The default can also be set with the SRI_DPR_BACKEND environment variable.
+
+    Args:
+        backend (str): One of "torch", "int8", "onnx" or "onnx_int8".
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    _backend = backend
+    get_context_encoder.cache_clear()
+    get_question_encoder.cache_clear()
+
+
+def model_key(model_id: str) -> str:
+    """
+    Identifies the embeddings of an encoder under the current backend.
+
+    Quantized encoders produce slightly different embeddings, so caches and embedding stores key them apart
+    from the fp32 ones.
+
+    Args:
+        model_id (str): The encoder model ID.
+
+    Returns:
+        str: The model ID, suffixed with the backend unless it is "torch".
+    """
+    return model_id if _backend == "torch" else f"{model_id}@{_backend}"
+
+
+def preload_models():
+    """
+    Loads every DPR tokenizer and encoder now instead of on first use.
+    """
+    get_context_tokenizer()
+    get_context_encoder()
+    get_question_tokenizer()
+    get_question_encoder()
+
+
+_LAZY_ATTRIBUTES = {
+    "context_tokenizer": get_context_tokenizer,
+    "context_encoder": get_context_encoder,
+    "question_tokenizer": get_question_tokenizer,
+    "question_encoder": get_question_encoder,
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
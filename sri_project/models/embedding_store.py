@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+
+import faiss
+import numpy
+from numpy import ndarray
+
+from .dpr import create_faiss_index, encode_passages, passage_embedding_dim
+from .dpr_models import CONTEXT_MODEL_ID, model_key
+from .faiss_index import RescoringIndex, load_index, save_index
+
+DEFAULT_STORE_DIR = "sri_project/data/.dpr_store"
+
+HASH_SIZE = 16
+
+EMBEDDINGS_FILE = "embeddings.f32"
+HASHES_FILE = "hashes.bin"
+META_FILE = "meta.json"
+INDEXES_DIR = "indexes"
+
+
+def hash_passage(passage: str) -> bytes:
+    """
+    Computes the content hash used as the store key of a passage.
+
+    Args:
+        passage (str): The passage text.
+
+    Returns:
+        bytes: A fixed-size digest of the UTF-8 encoded passage.
+    """
+    return hashlib.blake2b(passage.encode("utf-8"), digest_size=HASH_SIZE).digest()
+
+
+def model_store_dir(store_dir: str, model_id: str | None = None) -> str:
+    """
+    Returns the directory holding the embeddings produced by the given encoder model.
+
+    Embeddings of different encoders never mix: each model ID gets its own subdirectory.
+
+    Args:
+        store_dir (str): The root directory of the embedding store.
+        model_id (str, optional): The encoder model ID. Defaults to the context encoder of the current backend.
+
+    Returns:
+        str: The path of the model's store directory.
+    """
+    if model_id is None:
+        model_id = model_key(CONTEXT_MODEL_ID)
+    return os.path.join(store_dir, model_id.replace("/", "__"))
+
+
+def _read_meta(path: str) -> dict:
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return {"count": 0, "dim": None}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(path: str, meta: dict):
+    # Written last and atomically, so a crash while appending leaves the previous count valid.
+    tmp_path = os.path.join(path, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+
+def load_embeddings(store_dir: str = DEFAULT_STORE_DIR, model_id: str | None = None) -> tuple[dict, ndarray]:
+    """
+    Memory-maps every embedding stored for the given model.
+
+    Args:
+        store_dir (str, optional): The root directory of the embedding store.
+        model_id (str, optional): The encoder model ID. Defaults to the context encoder of the current backend.
+
+    Returns:
+        tuple: A dictionary mapping passage hashes to store rows and a read-only (rows x dim) float32 memmap.
+    """
+    path = model_store_dir(store_dir, model_id)
+    meta = _read_meta(path)
+    count = meta["count"]
+
+    if count == 0:
+        return {}, numpy.empty((0, 0), dtype=numpy.float32)
+
+    with open(os.path.join(path, HASHES_FILE), "rb") as f:
+        raw = f.read(count * HASH_SIZE)
+    rows = {raw[i * HASH_SIZE : (i + 1) * HASH_SIZE]: i for i in range(count)}
+
+    embeddings = numpy.memmap(
+        os.path.join(path, EMBEDDINGS_FILE), dtype=numpy.float32, mode="r", shape=(count, meta["dim"])
+    )
+    return rows, embeddings
+
+
+def _append_embeddings(path: str, passages: list[str], hashes: list[bytes], meta: dict):
+    count = meta["count"]
+    dim = passage_embedding_dim()
+    embeddings_path = os.path.join(path, EMBEDDINGS_FILE)
+
+    # Grow the file (dropping any bytes past the committed count left behind by an interrupted append) and
+    # let the encoder write the new rows straight into a memmap of its tail.
+    with open(embeddings_path, "ab") as f:
+        f.truncate((count + len(passages)) * dim * 4)
+    out = numpy.memmap(
+        embeddings_path, dtype=numpy.float32, mode="r+", offset=count * dim * 4, shape=(len(passages), dim)
+    )
+    encode_passages(passages, out=out)
+    out.flush()
+    del out
+
+    with open(os.path.join(path, HASHES_FILE), "ab") as f:
+        f.truncate(count * HASH_SIZE)
+        f.write(b"".join(hashes))
+
+    _write_meta(path, {**meta, "count": count + len(passages), "dim": dim})
+
+
+def update_store(
+    corpus: list[str], store_dir: str = DEFAULT_STORE_DIR, model_id: str | None = None
+) -> tuple[ndarray, ndarray]:
+    """
+    Makes sure every passage of the corpus has an embedding in the store, encoding only the missing ones.
+
+    The store is append-only: passages are keyed by their content hash, so unchanged passages are reused
+    across runs and corpus subsets, and new or edited passages are encoded and appended.
+
+    Args:
+        corpus (list[str]): A list of passages in the corpus.
+        store_dir (str, optional): The root directory of the embedding store.
+        model_id (str, optional): The encoder model ID. Defaults to the context encoder of the current backend.
+
+    Returns:
+        tuple: The store row of every corpus passage and the memory-mapped store embeddings.
+    """
+    path = model_store_dir(store_dir, model_id)
+    os.makedirs(path, exist_ok=True)
+
+    hashes = [hash_passage(passage) for passage in corpus]
+    rows, embeddings = load_embeddings(store_dir, model_id)
+
+    missing = {}
+    for i, passage_hash in enumerate(hashes):
+        if passage_hash not in rows and passage_hash not in missing:
+            missing[passage_hash] = i
+
+    if missing:
+        _append_embeddings(path, [corpus[i] for i in missing.values()], list(missing), _read_meta(path))
+        rows, embeddings = load_embeddings(store_dir, model_id)
+
+    corpus_rows = numpy.fromiter((rows[h] for h in hashes), dtype=numpy.int64, count=len(hashes))
+    return corpus_rows, embeddings
+
+
+def _index_config(index_type: str, index_params: dict) -> bytes:
+    return json.dumps([index_type, sorted(index_params.items())]).encode("utf-8")
+
+
+def index_fingerprint(
+    corpus: list[str], model_id: str | None = None, index_type: str = "flat", rescore: int = 4, **index_params
+) -> str:
+    """
+    Identifies the DPR index of a corpus without building or loading it, e.g. to key results computed with it.
+
+    Like the name of a saved index, the fingerprint changes with the contents or order of the passages and the
+    index configuration. It also changes with the encoder and its backend, and with the rescoring factor of
+    compressed storage.
+
+    Args:
+        corpus (list[str]): A list of passages in the corpus.
+        model_id (str, optional): The encoder model ID. Defaults to the context encoder of the current backend.
+        index_type (str, optional): The type of Faiss index. Defaults to "flat".
+        rescore (int, optional): The rescoring factor of compressed storage, see `load_or_create_index`.
+        **index_params: Build parameters of the index type, see `faiss_index.build_index`.
+
+    Returns:
+        str: A hex digest.
+    """
+    if model_id is None:
+        model_id = model_key(CONTEXT_MODEL_ID)
+    if index_params.get("storage", "float32") == "float32":
+        rescore = 0
+
+    fingerprint = hashlib.blake2b(digest_size=HASH_SIZE)
+    for passage in corpus:
+        fingerprint.update(hash_passage(passage))
+    fingerprint.update(_index_config(index_type, index_params))
+    fingerprint.update(json.dumps([model_id, rescore]).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def load_or_create_index(
+    corpus: list[str],
+    store_dir: str = DEFAULT_STORE_DIR,
+    model_id: str | None = None,
+    index_type: str = "flat",
+    rescore: int = 4,
+    **index_params,
+) -> faiss.Index:
+    """
+    Loads the FAISS index of the given corpus from disk, building and saving it on a cold start.
+
+    Indexes are saved per corpus fingerprint and index configuration, so any change in the corpus contents or
+    order builds a new one from the stored embeddings. Only passages absent from the store are run through the
+    encoder.
+
+    With a compressed `storage`, only the compressed index is held in memory and results are rescored with the
+    full embeddings, read from the memory-mapped store for the candidates alone.
+
+    Args:
+        corpus (list[str]): A list of passages in the corpus.
+        store_dir (str, optional): The root directory of the embedding store.
+        model_id (str, optional): The encoder model ID. Defaults to the context encoder of the current backend.
+        index_type (str, optional): The type of Faiss index to build. Defaults to "flat".
+        rescore (int, optional): With a compressed `storage`, the candidates per result rescored with the full
+            embeddings. 0 searches the compressed index alone. Defaults to 4.
+        **index_params: Build parameters of the index type, see `faiss_index.build_index`.
+
+    Returns:
+        faiss.Index: The index of the corpus (or its `RescoringIndex`), where ids are positions in the corpus.
+    """
+    corpus_rows, embeddings = update_store(corpus, store_dir, model_id)
+
+    config = _index_config(index_type, index_params)
+    fingerprint = hashlib.blake2b(corpus_rows.tobytes() + config, digest_size=HASH_SIZE).hexdigest()
+    indexes_dir = os.path.join(model_store_dir(store_dir, model_id), INDEXES_DIR)
+    index_path = os.path.join(indexes_dir, f"{fingerprint}.faiss")
+
+    if os.path.exists(index_path):
+        index = load_index(index_path)
+    else:
+        index = create_faiss_index(numpy.ascontiguousarray(embeddings[corpus_rows]), index_type, **index_params)
+        save_index(index, index_path)
+
+    if index_params.get("storage", "float32") != "float32" and rescore:
+        return RescoringIndex(index, embeddings, corpus_rows, rescore)
+    return index
@@ -0,0 +1,170 @@
+import os
+
+from numpy import ndarray
+
+BACKENDS = ("torch", "int8", "onnx", "onnx_int8")
+
+ONNX_DIR = "sri_project/data/.onnx"
+
+ONNX_OPSET = 17
+
+
+def quantize_int8(encoder):
+    """
+    Dynamically quantizes the linear layers of an encoder to int8 for CPU inference.
+
+    Weights are stored as int8 and activations are quantized on the fly, so no calibration data is needed.
+
+    Args:
+        encoder (torch.nn.Module): The fp32 encoder.
+
+    Returns:
+        torch.nn.Module: The quantized encoder, with the same interface.
+    """
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def onnx_path(model_id: str, backend: str) -> str:
+    """
+    Returns the file of the ONNX export of a model for an ONNX backend.
+
+    Args:
+        model_id (str): The encoder model ID.
+        backend (str): "onnx" or "onnx_int8".
+
+    Returns:
+        str: The path of the .onnx file.
+    """
+    suffix = ".int8.onnx" if backend == "onnx_int8" else ".onnx"
+    return os.path.join(ONNX_DIR, model_id.replace("/", "__") + suffix)
+
+
+def export_onnx(encoder, path: str, quantize: bool = False):
+    """
+    Exports the pooled output of an encoder to ONNX, optionally with int8 weights.
+
+    The batch and sequence dimensions are dynamic. The file is written atomically.
+
+    Args:
+        encoder (torch.nn.Module): The fp32 DPR encoder.
+        path (str): The destination file.
+        quantize (bool, optional): Quantize the weights of the exported graph to int8. Defaults to False.
+    """
+    import torch
+
+    class PooledOutput(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, input_ids, attention_mask):
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask).pooler_output
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fp32_path = path + ".fp32.tmp" if quantize else path + ".tmp"
+
+    dummy = torch.ones((1, 8), dtype=torch.long)
+    # torch 2.5 added a dynamo exporter, later made the default; before it, TorchScript is the only one
+    torch_version = tuple(int(part) for part in torch.__version__.split("+")[0].split(".")[:2])
+    exporter = {"dynamo": False} if torch_version >= (2, 5) else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            PooledOutput().eval(),
+            (dummy, dummy),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["pooler_output"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "pooler_output": {0: "batch"},
+            },
+            opset_version=ONNX_OPSET,
+            **exporter,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(fp32_path, path + ".tmp", weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    os.replace(path + ".tmp", path)
+
+
+class OnnxEncoder:
+    """
+    Runs an ONNX export of a DPR encoder with ONNX Runtime, behind the call interface of the PyTorch model.
+
+    Args:
+        path (str): The ONNX file written by `export_onnx`.
+        config (transformers.PretrainedConfig): The configuration of the exported model.
+        threads (int, optional): The intra-op threads of the session. Defaults to ONNX Runtime's choice.
+    """
+
+    def __init__(self, path: str, config, threads: int | None = None):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The ONNX backends need onnxruntime: poetry install --extras onnx") from e
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.path = path
+        self.config = config
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def run(self, input_ids: ndarray, attention_mask: ndarray) -> ndarray:
+        """
+        Computes the pooled embeddings of a tokenized batch.
+
+        Args:
+            input_ids (numpy.ndarray): The (batch x sequence) int64 token ids.
+            attention_mask (numpy.ndarray): The (batch x sequence) int64 attention mask.
+
+        Returns:
+            numpy.ndarray: The (batch x dim) float32 embeddings.
+        """
+        return self.session.run(["pooler_output"], {"input_ids": input_ids, "attention_mask": attention_mask})[0]
+
+    def __call__(self, input_ids, attention_mask=None, **_):
+        import torch
+        from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        pooled = self.run(input_ids.numpy().astype("int64"), attention_mask.numpy().astype("int64"))
+        return BaseModelOutputWithPooling(pooler_output=torch.from_numpy(pooled))
+
+
+def load_encoder(model_class, model_id: str, backend: str = "torch"):
+    """
+    Loads a DPR encoder for the given inference backend.
+
+    Args:
+        model_class (type): The transformers class of the encoder, e.g. `DPRQuestionEncoder`.
+        model_id (str): The encoder model ID.
+        backend (str, optional): One of "torch" (fp32 PyTorch), "int8" (PyTorch with dynamically quantized
+            linear layers), "onnx" (fp32 ONNX Runtime) or "onnx_int8" (ONNX Runtime with int8 weights). ONNX
+            exports are made on first use and kept under `ONNX_DIR`. Defaults to "torch".
+
+    Returns:
+        The encoder, called like the PyTorch model and returning an output with `pooler_output`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+    encoder = model_class.from_pretrained(model_id).eval()
+    if backend == "torch":
+        return encoder
+    if backend == "int8":
+        return quantize_int8(encoder)
+
+    path = onnx_path(model_id, backend)
+    if not os.path.exists(path):
+        export_onnx(encoder, path, quantize=backend == "onnx_int8")
+    return OnnxEncoder(path, encoder.config)
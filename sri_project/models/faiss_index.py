@@ -0,0 +1,409 @@
+import math
+import os
+import threading
+
+import faiss
+import numpy
+from numpy import ndarray
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Vector encodings of the flat, ivf_flat and hnsw indexes: 4, 2 and 1 bytes per dimension
+STORAGE_TYPES = {
+    "float32": None,
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+# Queries rescored together, bounding the gathered full vectors to RESCORE_CHUNK * rescore * k rows
+RESCORE_CHUNK = 256
+
+
+def default_nlist(n: int) -> int:
+    """
+    Returns the default number of IVF cells for a corpus of n passages (about 4 * sqrt(n)).
+
+    Args:
+        n (int): The number of passages.
+
+    Returns:
+        int: The number of IVF cells.
+    """
+    return max(1, min(n, int(4 * math.sqrt(n))))
+
+
+def build_index(
+    embeddings: ndarray,
+    index_type: str = "flat",
+    nlist: int | None = None,
+    pq_m: int = 64,
+    pq_nbits: int = 8,
+    hnsw_m: int = 32,
+    ef_construction: int = 40,
+    train_size: int | None = None,
+    seed: int = 0,
+    add: bool = True,
+    storage: str = "float32",
+) -> faiss.Index:
+    """
+    Builds an inner product FAISS index of the given type over the embeddings.
+
+    Args:
+        embeddings (numpy.ndarray): The (passages x dim) float32 embeddings to be indexed.
+        index_type (str, optional): One of "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw". Defaults to "flat".
+        nlist (int, optional): The number of IVF cells. Defaults to about 4 * sqrt(passages).
+        pq_m (int, optional): The number of PQ sub-quantizers (bytes per vector with 8 bits). Defaults to 64.
+        pq_nbits (int, optional): The bits per PQ sub-quantizer code. Defaults to 8.
+        hnsw_m (int, optional): The number of neighbours per HNSW node. Defaults to 32.
+        ef_construction (int, optional): The HNSW construction search depth. Defaults to 40.
+        train_size (int, optional): The number of passages sampled to train IVF cells and int8 ranges. Defaults
+            to 64 per IVF cell, or 65536.
+        seed (int, optional): The seed of the training sample. Defaults to 0.
+        add (bool, optional): Add the embeddings to the index. If False, the embeddings only train the
+            index and it is returned empty. Defaults to True.
+        storage (str, optional): How the flat, ivf_flat and hnsw indexes store vectors: "float32", "float16"
+            or "int8" (scalar quantized with per-dimension ranges learned from the training sample). Compressed
+            indexes score approximately; wrap them in a `RescoringIndex` to rescore with the full vectors.
+            Defaults to "float32".
+
+    Returns:
+        faiss.Index: The index, with ids being the row positions of the embeddings.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage {storage!r}, expected one of {tuple(STORAGE_TYPES)}")
+    if index_type == "ivf_pq" and storage != "float32":
+        raise ValueError("ivf_pq indexes store PQ codes; storage only applies to flat, ivf_flat and hnsw")
+
+    embeddings = numpy.ascontiguousarray(embeddings, dtype=numpy.float32)
+    n, dimension = embeddings.shape
+    qtype = STORAGE_TYPES[storage]
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dimension) if qtype is None else faiss.IndexScalarQuantizer(dimension, qtype, metric)
+    elif index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dimension, hnsw_m, metric)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, qtype, hnsw_m, metric)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        nlist = nlist or default_nlist(n)
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == "ivf_pq":
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, pq_nbits, metric)
+        elif qtype is None:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, qtype, metric)
+        train_size = train_size or 64 * nlist
+
+    if not index.is_trained:
+        # IVF centroids and int8 ranges are learned from a sample of the corpus
+        train_size = min(n, train_size or 65536)
+        sample = numpy.random.default_rng(seed).choice(n, size=train_size, replace=False)
+        index.train(embeddings[numpy.sort(sample)])
+
+    if not add:
+        return index
+
+    index.add(embeddings)
+
+    if isinstance(index, faiss.IndexIVF):
+        # Lets the reranker reconstruct stored vectors by id
+        index.make_direct_map()
+
+    return index
+
+
+def set_search_params(index: faiss.Index, nprobe: int | None = None, ef_search: int | None = None):
+    """
+    Sets the query-time accuracy/speed controls of an approximate index. Exact indexes are left untouched.
+
+    Args:
+        index (faiss.Index): The index to configure, or a `RescoringIndex` over it.
+        nprobe (int, optional): The number of IVF cells visited per query.
+        ef_search (int, optional): The HNSW search depth.
+    """
+    if isinstance(index, RescoringIndex):
+        index = index.index
+    if nprobe is not None:
+        try:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        except RuntimeError:
+            pass
+    if ef_search is not None and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+
+def save_index(index: faiss.Index, path: str):
+    """
+    Writes the index to disk atomically.
+
+    Args:
+        index (faiss.Index): The index to save.
+        path (str): The destination file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_index(path: str) -> faiss.Index:
+    """
+    Reads an index from disk, memory-mapping it where the index type allows it.
+
+    Args:
+        path (str): The index file.
+
+    Returns:
+        faiss.Index: The loaded index.
+    """
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+
+
+class RescoringIndex:
+    """
+    Searches a compressed index for `rescore * k` candidates and reorders them by their exact inner product
+    with the full vectors, returning the top k.
+
+    The full vectors are only read for the candidates, so they can stay in a memory-mapped embedding store on
+    disk while only the compressed codes are held in memory.
+
+    Offers the `search`, `reconstruct_batch`, `ntotal` and `d` members of `faiss.Index` used by the retrievers.
+
+    Args:
+        index (faiss.Index): The compressed index, with ids being positions in `rows` (or in `vectors`).
+        vectors (numpy.ndarray): The full (rows x dim) embeddings, e.g. the store memmap.
+        rows (numpy.ndarray, optional): The row of `vectors` holding each index id. Defaults to the identity.
+        rescore (int, optional): The number of candidates fetched per result. Defaults to 4.
+    """
+
+    def __init__(self, index: faiss.Index, vectors: ndarray, rows: ndarray | None = None, rescore: int = 4):
+        self.index = index
+        self.vectors = vectors
+        self.rows = rows
+        self.rescore = rescore
+        self.d = index.d
+
+    @property
+    def ntotal(self) -> int:
+        """
+        The number of indexed vectors.
+        """
+        return self.index.ntotal
+
+    def reconstruct_batch(self, ids: ndarray) -> ndarray:
+        """
+        Returns the full vectors of the given ids.
+
+        Args:
+            ids (numpy.ndarray): The index ids.
+
+        Returns:
+            numpy.ndarray: The (ids x dim) float32 vectors.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        rows = ids if self.rows is None else self.rows[ids]
+        return numpy.asarray(self.vectors[rows], dtype=numpy.float32)
+
+    def search(self, embeddings: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        """
+        Searches the k nearest vectors of every query, rescored with the full vectors.
+
+        Args:
+            embeddings (numpy.ndarray): The (queries x dim) float32 query embeddings.
+            k (int): The number of neighbours.
+
+        Returns:
+            tuple: The (queries x k) exact scores and ids, padded with -1 when fewer vectors are indexed.
+        """
+        embeddings = numpy.ascontiguousarray(embeddings, dtype=numpy.float32)
+        _, candidates = self.index.search(embeddings, max(k, self.rescore * k))
+
+        # FAISS pads missing results with the lowest float and id -1
+        scores = numpy.full(candidates.shape, -numpy.finfo(numpy.float32).max, dtype=numpy.float32)
+        for start in range(0, len(candidates), RESCORE_CHUNK):
+            chunk = candidates[start : start + RESCORE_CHUNK]
+            valid = chunk >= 0
+            if not valid.any():
+                continue
+            # Each candidate row is read once, in ascending order, which keeps reads from a memmap sequential
+            unique, inverse = numpy.unique(chunk[valid], return_inverse=True)
+            full = self.reconstruct_batch(unique)
+            query_rows = start + numpy.nonzero(valid)[0]
+            scores[start : start + RESCORE_CHUNK][valid] = numpy.einsum(
+                "ij,ij->i", embeddings[query_rows], full[inverse]
+            )
+
+        order = numpy.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return numpy.take_along_axis(scores, order, axis=1), numpy.take_along_axis(candidates, order, axis=1)
+
+
+class MutableIndex:
+    """
+    Wraps an empty FAISS index to store vectors under external ids that can be deleted and replaced.
+
+    Every stored vector gets a fresh label, mapped back to its external id on search. Deleting or replacing
+    an id tombstones the label of its old vector: tombstoned labels are excluded from searches with an
+    `IDSelector` at once, and `compact` removes their vectors. Flat and HNSW indexes are wrapped in an
+    `IndexIDMap2`; IVF indexes store the labels themselves. HNSW graphs do not support removal, so their
+    compaction rebuilds the graph from the live vectors.
+
+    Offers the `search`, `reconstruct_batch`, `ntotal` and `d` members of `faiss.Index` used by the retrievers.
+
+    Args:
+        index (faiss.Index): An empty, trained index from `build_index(..., add=False)`.
+    """
+
+    def __init__(self, index: faiss.Index):
+        if index.ntotal:
+            raise ValueError("MutableIndex needs an empty index")
+
+        try:
+            self._ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            self._ivf = None
+
+        self._base = index
+        if self._ivf is not None:
+            # Reconstruction by label, for the reranker
+            self._ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+            self.index = index
+        else:
+            self.index = faiss.IndexIDMap2(index)
+
+        self.d = index.d
+        # Bumped by every change, so cached results of an older state are not reused
+        self.version = 0
+        self._labels: dict[int, int] = {}
+        self._label_ids = numpy.empty(0, dtype=numpy.int64)
+        self._next_label = 0
+        self._tombstones: set[int] = set()
+        self._selector = None
+        self._lock = threading.RLock()
+
+    @property
+    def ntotal(self) -> int:
+        """
+        The number of live vectors.
+        """
+        return len(self._labels)
+
+    @property
+    def tombstones(self) -> int:
+        """
+        The number of deleted or replaced vectors still stored.
+        """
+        return len(self._tombstones)
+
+    def add(self, ids: ndarray, embeddings: ndarray):
+        """
+        Adds vectors. Ids already stored are replaced.
+
+        Args:
+            ids (numpy.ndarray): The external ids of the vectors.
+            embeddings (numpy.ndarray): The (vectors x dim) float32 embeddings.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        with self._lock:
+            self.delete(ids)
+
+            labels = numpy.arange(self._next_label, self._next_label + len(ids), dtype=numpy.int64)
+            self._next_label += len(ids)
+            if self._next_label > len(self._label_ids):
+                self._label_ids = numpy.resize(self._label_ids, max(self._next_label, 2 * len(self._label_ids)))
+            self._label_ids[labels] = ids
+            self._labels.update(zip(ids.tolist(), labels.tolist()))
+
+            self.index.add_with_ids(numpy.ascontiguousarray(embeddings, dtype=numpy.float32), labels)
+            self._changed()
+
+    def delete(self, ids: ndarray):
+        """
+        Deletes vectors. Unknown ids are ignored.
+
+        Args:
+            ids (numpy.ndarray): The external ids of the vectors.
+        """
+        with self._lock:
+            for doc_id in numpy.asarray(ids).tolist():
+                label = self._labels.pop(doc_id, None)
+                if label is not None:
+                    self._tombstones.add(label)
+            self._changed()
+
+    def compact(self):
+        """
+        Removes the tombstoned vectors from the index.
+        """
+        with self._lock:
+            if not self._tombstones:
+                return
+            tombstones = numpy.fromiter(self._tombstones, dtype=numpy.int64, count=len(self._tombstones))
+
+            if self._ivf is not None:
+                # The hashtable direct map can only remove an explicit label list
+                self.index.remove_ids(faiss.IDSelectorArray(tombstones))
+            elif isinstance(self._base, faiss.IndexHNSW):
+                labels = faiss.vector_to_array(self.index.id_map)
+                keep = ~numpy.isin(labels, tombstones)
+                vectors = self._base.storage.reconstruct_n(0, self._base.ntotal)[keep]
+                self._base.reset()
+                self.index = faiss.IndexIDMap2(self._base)
+                self.index.add_with_ids(vectors, labels[keep])
+            else:
+                self.index.remove_ids(faiss.IDSelectorBatch(tombstones))
+
+            self._tombstones.clear()
+            self._changed()
+
+    def search(self, embeddings: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        """
+        Searches the k nearest live vectors of every query.
+
+        Args:
+            embeddings (numpy.ndarray): The (queries x dim) float32 query embeddings.
+            k (int): The number of neighbours.
+
+        Returns:
+            tuple: The (queries x k) scores and external ids, padded with -1 when fewer vectors are live.
+        """
+        with self._lock:
+            if self._tombstones:
+                D, labels = self.index.search(embeddings, k, params=self._search_parameters())
+            else:
+                D, labels = self.index.search(embeddings, k)
+            return D, numpy.where(labels >= 0, self._label_ids[numpy.maximum(labels, 0)], -1)
+
+    def reconstruct_batch(self, ids: ndarray) -> ndarray:
+        """
+        Returns the stored vectors of the given ids.
+
+        Args:
+            ids (numpy.ndarray): The external ids.
+
+        Returns:
+            numpy.ndarray: The (ids x dim) vectors.
+        """
+        with self._lock:
+            labels = numpy.fromiter((self._labels[doc_id] for doc_id in numpy.asarray(ids).tolist()), dtype=numpy.int64)
+            return self.index.reconstruct_batch(labels)
+
+    def _search_parameters(self) -> faiss.SearchParameters:
+        if self._selector is None:
+            tombstones = numpy.fromiter(self._tombstones, dtype=numpy.int64, count=len(self._tombstones))
+            self._selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(tombstones))
+
+        if self._ivf is not None:
+            return faiss.SearchParametersIVF(sel=self._selector, nprobe=self._ivf.nprobe)
+        if isinstance(self._base, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=self._selector, efSearch=self._base.hnsw.efSearch)
+        return faiss.SearchParameters(sel=self._selector)
+
+    def _changed(self):
+        self._selector = None
+        self.version += 1
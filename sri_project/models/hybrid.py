@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+import faiss
+import numpy
+from numpy import ndarray
+
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.bm25_index import BM25Index, top_k_scores
+from sri_project.models.dpr import encode_query
+from sri_project.utils.tracing import span
+
+if TYPE_CHECKING:
+    import torch
+
+FUSION_METHODS = ("rrf", "score")
+
+# BM25 runs here while the calling thread encodes the query and searches FAISS; both release the GIL
+# for most of their work, so the two retrievers overlap.
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-bm25")
+
+
+def min_max_normalize(scores: ndarray) -> ndarray:
+    """
+    Rescales scores to [0, 1]. A constant list maps to all ones.
+
+    Args:
+        scores (numpy.ndarray): The scores of one retriever.
+
+    Returns:
+        numpy.ndarray: The normalized scores.
+    """
+    if len(scores) == 0:
+        return scores
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return numpy.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+class HybridRetriever:
+    """
+    Retrieves candidates with BM25 and DPR concurrently and fuses the union of both lists.
+
+    Unlike the BM25-then-rerank pipeline, passages found only by DPR can be returned too.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index.
+        fusion (str, optional): "rrf" for reciprocal rank fusion or "score" for the weighted sum of
+            min-max normalized scores. Defaults to "rrf".
+        weights (tuple[float, float], optional): The weights of BM25 and DPR in the fused score. Defaults to (1, 1).
+        candidates (int, optional): The number of candidates taken from each retriever. Defaults to 2k.
+        rrf_k (int, optional): The rank offset of reciprocal rank fusion. Defaults to 60.
+        query_encoder (Callable, optional): Encodes a single query. Defaults to `encode_query`.
+    """
+
+    def __init__(
+        self,
+        bm25: BM25Index,
+        dpr_index: faiss.Index,
+        fusion: str = "rrf",
+        weights: tuple[float, float] = (1.0, 1.0),
+        candidates: int | None = None,
+        rrf_k: int = 60,
+        query_encoder: Callable[[str], "torch.Tensor"] = encode_query,
+    ):
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method {fusion!r}, expected one of {FUSION_METHODS}")
+
+        self.bm25 = bm25
+        self.dpr_index = dpr_index
+        self.fusion = fusion
+        self.weights = weights
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.query_encoder = query_encoder
+
+    def retrieve(self, query: str, k: int = 10) -> tuple[list[int], list[float]]:
+        """
+        Retrieves the k passages with the best fused score for the query.
+
+        Args:
+            query (str): The query string.
+            k (int, optional): The number of passages to return. Defaults to 10.
+
+        Returns:
+            tuple: The indices of the retrieved passages and their fused scores.
+        """
+        n = self.candidates or 2 * k
+
+        with span("hybrid"):
+            bm25_future = _executor.submit(bm25_retrieve, query, self.bm25, n)
+            query_embedding = self.query_encoder(query).numpy()
+            with span("dpr.search"):
+                dpr_scores, dpr_results = self.dpr_index.search(query_embedding, n)
+            bm25_results, bm25_scores = bm25_future.result()
+
+            # FAISS pads with -1 when the index holds fewer than n passages
+            valid = dpr_results[0] >= 0
+            return self.fuse(
+                (numpy.asarray(bm25_results, dtype=numpy.int64), numpy.asarray(bm25_scores)),
+                (dpr_results[0][valid], dpr_scores[0][valid].astype(numpy.float64)),
+                k,
+            )
+
+    def fuse(self, bm25_ranking: tuple[ndarray, ndarray], dpr_ranking: tuple[ndarray, ndarray], k: int):
+        """
+        Fuses a BM25 and a DPR ranking into one.
+
+        Args:
+            bm25_ranking (tuple): The BM25 passage indices and scores, best first.
+            dpr_ranking (tuple): The DPR passage indices and scores, best first.
+            k (int): The number of passages to return.
+
+        Returns:
+            tuple: The indices of the k best fused passages and their fused scores.
+        """
+        with span("hybrid.fuse"):
+            union = numpy.unique(numpy.concatenate([bm25_ranking[0], dpr_ranking[0]]))
+            fused = numpy.zeros(len(union))
+
+            for weight, (ids, scores) in zip(self.weights, (bm25_ranking, dpr_ranking)):
+                if self.fusion == "rrf":
+                    contributions = 1.0 / (self.rrf_k + numpy.arange(1, len(ids) + 1))
+                else:
+                    contributions = min_max_normalize(scores)
+                fused[numpy.searchsorted(union, ids)] += weight * contributions
+
+            positions, scores = top_k_scores(fused, k)
+            return union[positions].tolist(), scores.tolist()
@@ -0,0 +1,183 @@
+from typing import TYPE_CHECKING, Callable
+
+import faiss
+import numpy
+from numpy import ndarray
+
+from sri_project.models.bm25 import bm25_retrieve, bm25_retrieve_batch
+from sri_project.models.bm25_index import BM25Index, top_k_scores
+from sri_project.models.dpr import encode_passages, encode_queries, encode_query
+from sri_project.utils.tracing import span
+from sri_project.utils.utils import get_retrieved_docs
+
+if TYPE_CHECKING:
+    import torch
+
+
+def lookup_passage_embeddings(dpr_index: faiss.Index | None, doc_ids: list[int]) -> ndarray:
+    """
+    Returns the context embeddings of the given passages, read from the DPR index where it stores them.
+
+    The whole batch is reconstructed at once. If that fails, the passages are reconstructed one by one and only
+    those the index cannot provide (e.g. it keeps no vectors, or not for these ids) are encoded, in one batch.
+
+    Args:
+        dpr_index (faiss.Index | None): The DPR index. If None, every passage is encoded.
+        doc_ids (list[int]): The ids of the passages.
+
+    Returns:
+        numpy.ndarray: A (passages x dim) float32 array of embeddings.
+    """
+    ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+    if dpr_index is None:
+        return encode_passages(get_retrieved_docs(ids.tolist()))
+    try:
+        return dpr_index.reconstruct_batch(ids)
+    except (RuntimeError, KeyError):
+        pass
+
+    embeddings = None
+    missing = []
+    for i in range(len(ids)):
+        try:
+            vector = dpr_index.reconstruct_batch(ids[i : i + 1])
+        except (RuntimeError, KeyError):
+            missing.append(i)
+            continue
+        if embeddings is None:
+            embeddings = numpy.empty((len(ids), vector.shape[1]), dtype=numpy.float32)
+        embeddings[i] = vector[0]
+
+    if missing:
+        encoded = encode_passages(get_retrieved_docs(ids[missing].tolist()))
+        if embeddings is None:
+            return encoded
+        embeddings[missing] = encoded
+    return embeddings
+
+
+class Reranker:
+    """
+    Reranks BM25 candidates by fusing their BM25 score with the DPR similarity to the query.
+
+    Candidate embeddings are read from the DPR index when it stores them; any candidate it cannot provide is
+    encoded with the context encoder in a single batch. Similarities and fused scores are computed for all
+    candidates at once.
+
+    Args:
+        bm25 (BM25Index): The BM25 model used to generate candidates.
+        dpr_index (faiss.Index, optional): The DPR index holding the precomputed passage embeddings.
+        weight (float, optional): The weight of the DPR similarity in the fused score. Defaults to 0.7.
+        threshold (float, optional): The minimum cosine similarity between the query and a candidate for the
+            candidate to be kept. DPR puts question/context cosines on a lower scale than question/question ones, so
+            a cutoff has to be chosen for the encoders and dataset at hand. Defaults to None, keeping every
+            candidate.
+        query_encoder (Callable, optional): Encodes a single query, e.g. a cached `encode_query`. Defaults to
+            `encode_query`.
+    """
+
+    def __init__(
+        self,
+        bm25: BM25Index,
+        dpr_index: faiss.Index | None = None,
+        weight: float = 0.7,
+        threshold: float | None = None,
+        query_encoder: Callable[[str], "torch.Tensor"] = encode_query,
+    ):
+        self.bm25 = bm25
+        self.dpr_index = dpr_index
+        self.weight = weight
+        self.threshold = threshold
+        self.query_encoder = query_encoder
+
+    def passage_embeddings(self, doc_ids: list[int]) -> ndarray:
+        """
+        Returns the context embeddings of the given passages.
+
+        Args:
+            doc_ids (list[int]): The ids of the passages.
+
+        Returns:
+            numpy.ndarray: A (passages x dim) float32 array of embeddings.
+        """
+        return lookup_passage_embeddings(self.dpr_index, doc_ids)
+
+    def rerank(self, query: str, k: int = 10) -> tuple[list[int], list[float]]:
+        """
+        Retrieves 2k BM25 candidates for the query and returns the k best by fused score.
+
+        Args:
+            query (str): The query string.
+            k (int, optional): The number of passages to return. Defaults to 10.
+
+        Returns:
+            tuple: The indices of the reranked passages and their fused scores.
+        """
+        with span("rerank"):
+            candidates, bm25_scores = bm25_retrieve(query, self.bm25, 2 * k)
+            if not candidates:
+                return [], []
+
+            query_embedding = self.query_encoder(query).numpy()[0]
+            with span("rerank.embeddings"):
+                doc_embeddings = self.passage_embeddings(candidates)
+            with span("rerank.fuse"):
+                return self._fuse(query_embedding, candidates, bm25_scores, doc_embeddings, k)
+
+    def rerank_batch(self, queries: list[str], k: int = 10) -> tuple[list[list[int]], list[list[float]]]:
+        """
+        Reranks the BM25 candidates of a batch of queries.
+
+        All queries are encoded in one pass and the embeddings of every distinct candidate are gathered at once.
+
+        Args:
+            queries (list[str]): The query strings.
+            k (int, optional): The number of passages to return per query. Defaults to 10.
+
+        Returns:
+            tuple: The indices of the reranked passages and their fused scores for every query.
+        """
+        candidates, bm25_scores = bm25_retrieve_batch(queries, self.bm25, 2 * k)
+        all_candidates = [doc_id for query_candidates in candidates for doc_id in query_candidates]
+        if not all_candidates:
+            return [[] for _ in queries], [[] for _ in queries]
+
+        query_embeddings = encode_queries(queries)
+        with span("rerank.batch.embeddings"):
+            unique_ids, rows = numpy.unique(all_candidates, return_inverse=True)
+            doc_embeddings = self.passage_embeddings(unique_ids.tolist())
+
+        results, scores = [], []
+        offset = 0
+        for query_embedding, query_candidates, query_scores in zip(query_embeddings, candidates, bm25_scores):
+            query_rows = rows[offset : offset + len(query_candidates)]
+            offset += len(query_candidates)
+            if not query_candidates:
+                results.append([])
+                scores.append([])
+                continue
+
+            query_results, query_fused = self._fuse(
+                query_embedding, query_candidates, query_scores, doc_embeddings[query_rows], k
+            )
+            results.append(query_results)
+            scores.append(query_fused)
+
+        return results, scores
+
+    def _fuse(
+        self, query_embedding: ndarray, candidates: list[int], bm25_scores: list[float], doc_embeddings: ndarray, k: int
+    ) -> tuple[list[int], list[float]]:
+        similarities = doc_embeddings @ query_embedding
+        similarities /= numpy.maximum(
+            numpy.linalg.norm(doc_embeddings, axis=1) * numpy.linalg.norm(query_embedding), 1e-8
+        )
+        fused = self.weight * similarities + (1 - self.weight) * numpy.asarray(bm25_scores)
+
+        if self.threshold is None:
+            positions, scores = top_k_scores(fused, k)
+            return numpy.asarray(candidates)[positions].tolist(), scores.tolist()
+
+        kept = numpy.flatnonzero(similarities >= self.threshold)
+        positions, scores = top_k_scores(fused[kept], k)
+        return numpy.asarray(candidates)[kept[positions]].tolist(), scores.tolist()
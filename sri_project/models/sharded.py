@@ -0,0 +1,304 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Connection
+
+import numpy
+from numpy import ndarray
+
+from .analyzers import Analyzer, get_analyzer
+from .bm25 import init_bm25
+from .bm25_index import bm25_idf, top_k_scores
+from .dpr import encode_passages
+from .embedding_store import update_store
+from .faiss_index import build_index
+
+
+def _serve_shard(
+    conn: Connection,
+    corpus: list[str],
+    embeddings: ndarray,
+    rows: ndarray,
+    offset: int,
+    analyzer: Analyzer,
+    k1: float,
+    b: float,
+    index_type: str,
+    index_params: dict,
+    threads: int,
+):
+    import faiss
+
+    faiss.omp_set_num_threads(threads)
+
+    # The pool is daemonic and cannot fork the analyzer's own workers
+    bm25 = init_bm25(corpus, k1, b, analyzer, workers=1)
+    # Gathered here, so the parent never holds a copy of the shard's vectors
+    index = build_index(embeddings[rows], index_type, **index_params)
+
+    conn.send((list(bm25.vocab), numpy.diff(bm25.indptr), int(bm25.doc_lens.sum()), bm25.corpus_size))
+    avgdl, idf = conn.recv()
+    bm25.set_collection_statistics(avgdl, idf)
+
+    def bm25_top_k(tokenized_queries: list[list[str]], k: int) -> list[tuple[ndarray, ndarray]]:
+        return [(ids + offset, scores) for ids, scores in bm25.top_k_batch(tokenized_queries, k)]
+
+    def dpr_search(query_embeddings: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        D, ids = index.search(query_embeddings, k)
+        return D, numpy.where(ids >= 0, ids + offset, -1)
+
+    handlers = {"bm25": bm25_top_k, "dpr": dpr_search, "reconstruct": index.reconstruct_batch}
+
+    while (request := conn.recv()) is not None:
+        method, args = request
+        try:
+            conn.send((True, handlers[method](*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class ShardPool:
+    """
+    Splits a corpus into contiguous shards, each indexed by BM25 and FAISS in its own worker process, and
+    answers searches by sending them to every shard and merging the per-shard top-k lists.
+
+    Workers are forked and talk to the parent over local socket pairs. Each one only holds the postings and
+    vectors of its shard, so the indexes of a corpus are spread over the workers' memory and a query is
+    searched by all shards in parallel. BM25 shards score with the document frequencies and average length of
+    the whole corpus, so the merged results are the ones of a single index over the corpus.
+
+    `bm25` and `dpr_index` can be passed to the retrieval functions in place of the single-process indexes;
+    ids are positions in the corpus.
+
+    Args:
+        corpus (list[str]): The passages.
+        num_shards (int, optional): The number of shards and worker processes, at most one per passage so that no
+            shard is empty. Defaults to 2.
+        store_dir (str, optional): The embedding store to take the passage embeddings from, memory-mapped by the
+            workers. If None, the corpus is encoded in memory.
+        index_type (str, optional): The type of Faiss index of every shard. Defaults to "flat".
+        analyzer (Analyzer | str, optional): The BM25 analyzer or tokenizer name. Defaults to NLTK.
+        k1 (float, optional): BM25 term frequency saturation. Defaults to 1.5.
+        b (float, optional): BM25 document length normalization. Defaults to 0.75.
+        epsilon (float, optional): Fraction of the average IDF used as floor for negative IDFs. Defaults to 0.25.
+        threads_per_shard (int, optional): The FAISS threads of every worker. Defaults to the cores per shard.
+        **index_params: Build parameters of the index type, see `faiss_index.build_index`.
+    """
+
+    def __init__(
+        self,
+        corpus: list[str],
+        num_shards: int = 2,
+        store_dir: str | None = None,
+        index_type: str = "flat",
+        analyzer: Analyzer | str | None = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        threads_per_shard: int | None = None,
+        **index_params,
+    ):
+        self.analyzer = get_analyzer(analyzer)
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        self.corpus_size = len(corpus)
+        # An empty shard has no average document length to score with
+        num_shards = self.num_shards = max(1, min(num_shards, len(corpus)))
+        self.bounds = numpy.linspace(0, len(corpus), num_shards + 1).astype(numpy.int64)
+
+        if store_dir is None:
+            rows, embeddings = numpy.arange(len(corpus)), encode_passages(corpus)
+        else:
+            rows, embeddings = update_store(corpus, store_dir)
+        self.d = embeddings.shape[1]
+        threads = threads_per_shard or max(1, (os.cpu_count() or 1) // num_shards)
+
+        # Load the tokenizer data before forking, so every worker inherits it
+        self.analyzer("")
+
+        context = multiprocessing.get_context("fork")
+        self._conns: list[Connection] = []
+        self._workers = []
+        for start, end in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            parent_conn, child_conn = context.Pipe()
+            args = (child_conn, corpus[start:end], embeddings, rows[start:end], start, self.analyzer, k1, b)
+            worker = context.Process(
+                target=_serve_shard,
+                args=(*args, index_type, index_params, threads),
+                name=f"shard-{len(self._workers)}",
+                daemon=True,
+            )
+            worker.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+
+        self._share_bm25_statistics(epsilon)
+        # One request at a time per pool, so the replies on every connection match their requests
+        self._lock = threading.Lock()
+
+        self.bm25 = ShardedBM25(self)
+        self.dpr_index = ShardedDPRIndex(self)
+
+    def _share_bm25_statistics(self, epsilon: float):
+        shard_stats = [conn.recv() for conn in self._conns]
+
+        # Shard vocabularies are in order of first occurrence, so merging them in shard order gives the term
+        # order of a single index, and with it the same IDF floor
+        vocab: dict[str, int] = {}
+        term_ids = []
+        for terms, _, _, _ in shard_stats:
+            term_ids.append(numpy.fromiter((vocab.setdefault(term, len(vocab)) for term in terms), dtype=numpy.int64))
+        df = numpy.zeros(len(vocab), dtype=numpy.int64)
+        for ids, (_, shard_df, _, _) in zip(term_ids, shard_stats):
+            df[ids] += shard_df
+
+        corpus_size = sum(size for _, _, _, size in shard_stats)
+        avgdl = sum(total_len for _, _, total_len, _ in shard_stats) / corpus_size
+        idf = bm25_idf(df, corpus_size, epsilon)
+        for conn, ids in zip(self._conns, term_ids):
+            conn.send((avgdl, idf[ids]))
+
+    def scatter(self, method: str, args_by_shard: list[tuple]) -> list:
+        """
+        Sends a request to every shard and waits for all the replies.
+
+        Args:
+            method (str): "bm25", "dpr" or "reconstruct".
+            args_by_shard (list[tuple]): The arguments of the request of every shard.
+
+        Returns:
+            list: The reply of every shard, in shard order.
+        """
+        with self._lock:
+            for conn, args in zip(self._conns, args_by_shard):
+                conn.send((method, args))
+            replies = [conn.recv() for conn in self._conns]
+
+        for ok, reply in replies:
+            if not ok:
+                raise reply
+        return [reply for _, reply in replies]
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._conns, self._workers = [], []
+
+    def __enter__(self) -> "ShardPool":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ShardedBM25:
+    """
+    The BM25 side of a `ShardPool`, with the `analyzer`, parameters and `top_k` members of `BM25Index`.
+    """
+
+    def __init__(self, pool: ShardPool):
+        self.pool = pool
+        self.analyzer = pool.analyzer
+        self.k1, self.b, self.epsilon = pool.k1, pool.b, pool.epsilon
+        self.corpus_size = pool.corpus_size
+
+    def top_k_batch(self, tokenized_queries: list[list[str]], k: int) -> list[tuple[ndarray, ndarray]]:
+        """
+        Retrieves the k best scored documents of every query from all the shards.
+
+        Args:
+            tokenized_queries (list[list[str]]): The tokens of every query.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            list[tuple]: The ids of the top-k documents of every query and their scores.
+        """
+        replies = self.pool.scatter("bm25", [(tokenized_queries, k)] * self.pool.num_shards)
+
+        results = []
+        for shard_results in zip(*replies):
+            # Shards hold ascending id ranges, so ties keep being broken by ascending id
+            ids = numpy.concatenate([shard_ids for shard_ids, _ in shard_results])
+            scores = numpy.concatenate([shard_scores for _, shard_scores in shard_results])
+            top, top_scores = top_k_scores(scores, k)
+            results.append((ids[top], top_scores))
+        return results
+
+    def top_k(self, tokenized_query: list[str], k: int) -> tuple[ndarray, ndarray]:
+        """
+        Retrieves the k best scored documents for the given query from all the shards.
+
+        Args:
+            tokenized_query (list[str]): The query tokens.
+            k (int): The number of documents to retrieve.
+
+        Returns:
+            tuple: The ids of the top-k documents and their scores.
+        """
+        return self.top_k_batch([tokenized_query], k)[0]
+
+
+class ShardedDPRIndex:
+    """
+    The FAISS side of a `ShardPool`, with the `search`, `reconstruct_batch`, `ntotal` and `d` members of
+    `faiss.Index` used by the retrievers.
+    """
+
+    def __init__(self, pool: ShardPool):
+        self.pool = pool
+        self.d = pool.d
+
+    @property
+    def ntotal(self) -> int:
+        """
+        The number of indexed vectors.
+        """
+        return self.pool.corpus_size
+
+    def search(self, embeddings: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        """
+        Searches the k nearest vectors of every query in all the shards.
+
+        Args:
+            embeddings (numpy.ndarray): The (queries x dim) float32 query embeddings.
+            k (int): The number of neighbours.
+
+        Returns:
+            tuple: The (queries x k) scores and ids, padded with -1 when fewer vectors are indexed.
+        """
+        embeddings = numpy.ascontiguousarray(embeddings, dtype=numpy.float32)
+        replies = self.pool.scatter("dpr", [(embeddings, k)] * self.pool.num_shards)
+
+        D = numpy.hstack([shard_D for shard_D, _ in replies])
+        ids = numpy.hstack([shard_ids for _, shard_ids in replies])
+        order = numpy.argsort(-D, axis=1, kind="stable")[:, :k]
+        return numpy.take_along_axis(D, order, axis=1), numpy.take_along_axis(ids, order, axis=1)
+
+    def reconstruct_batch(self, ids: ndarray) -> ndarray:
+        """
+        Returns the stored vectors of the given ids, fetched from their shards.
+
+        Args:
+            ids (numpy.ndarray): The corpus positions.
+
+        Returns:
+            numpy.ndarray: The (ids x dim) vectors.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        shards = numpy.searchsorted(self.pool.bounds, ids, side="right") - 1
+        starts = self.pool.bounds[:-1]
+        replies = self.pool.scatter("reconstruct", [(ids[shards == s] - starts[s],) for s in range(len(starts))])
+
+        vectors = numpy.empty((len(ids), self.d), dtype=numpy.float32)
+        for s, shard_vectors in enumerate(replies):
+            vectors[shards == s] = shard_vectors
+        return vectors
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy
+
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.cascade import RetrievalCascade
+from sri_project.models.dpr import encode_queries
+from sri_project.models.hybrid import HybridRetriever
+from sri_project.models.reranker import Reranker
+from sri_project.utils import tracing
+from sri_project.utils.batching import MicroBatcher
+from sri_project.utils.utils import get_retrieved_docs
+
+MODELS = ("BM25", "DPR", "Reranking", "Hybrid", "Cascade")
+
+STATUS_LINES = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    500: "500 Internal Server Error",
+}
+
+
+class RetrievalService:
+    """
+    Asynchronous front end of the retrieval models for concurrent callers.
+
+    DPR requests are micro-batched: the queries that arrive together are encoded in one forward pass of the
+    question encoder and searched with one FAISS call. Reranking requests are batched the same way through
+    `Reranker.rerank_batch`, and hybrid requests share the DPR batches. BM25 and cascade requests run on the
+    default thread pool; cascade requests can carry their own latency budget.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index.
+        max_batch_size (int, optional): The maximum number of queries per encoder pass. Defaults to 32.
+        max_wait_ms (float, optional): How long a query waits for others to share its batch. Defaults to 5.
+        max_k (int, optional): The largest number of passages a request may ask for. Defaults to 100.
+    """
+
+    def __init__(self, bm25, dpr_index, max_batch_size: int = 32, max_wait_ms: float = 5.0, max_k: int = 100):
+        self.bm25 = bm25
+        self.dpr_index = dpr_index
+        self.max_k = max_k
+        self.reranker = Reranker(bm25, dpr_index)
+        self.hybrid = HybridRetriever(bm25, dpr_index)
+        self.cascade = RetrievalCascade(bm25, dpr_index)
+
+        # torch and FAISS parallelize each batch themselves; running one batch at a time avoids oversubscription
+        self._model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoder")
+        self._dpr = MicroBatcher(self._dpr_batch, max_batch_size, max_wait_ms, self._model_executor)
+        self._rerank = MicroBatcher(self._rerank_batch, max_batch_size, max_wait_ms, self._model_executor)
+
+    def _dpr_batch(self, items: list[tuple[str, int]]) -> list[tuple[list[int], list[float]]]:
+        max_k = max(k for _, k in items)
+        query_embeddings = encode_queries([query for query, _ in items])
+        with tracing.span("dpr.batch.search"):
+            D, results = self.dpr_index.search(query_embeddings, max_k)
+
+        batch_results = []
+        for (_, k), scores, ids in zip(items, D, results):
+            # FAISS pads with -1 when the index holds fewer than k passages
+            valid = ids[:k] >= 0
+            batch_results.append((ids[:k][valid].tolist(), scores[:k][valid].tolist()))
+        return batch_results
+
+    def _rerank_batch(self, items: list[tuple[str, int]]) -> list[tuple[list[int], list[float]]]:
+        batch_results: list = [None] * len(items)
+        for k in {k for _, k in items}:
+            positions = [i for i, (_, item_k) in enumerate(items) if item_k == k]
+            results, scores = self.reranker.rerank_batch([items[i][0] for i in positions], k)
+            for i, query_results, query_scores in zip(positions, results, scores):
+                batch_results[i] = (query_results, query_scores)
+        return batch_results
+
+    async def search(
+        self, query: str, model: str = "DPR", k: int = 10, budget_ms: float | None = None
+    ) -> tuple[list[int], list[float]]:
+        """
+        Retrieves the k best passages for a query with the given model.
+
+        Args:
+            query (str): The query string.
+            model (str, optional): One of "BM25", "DPR", "Reranking", "Hybrid" or "Cascade". Defaults to "DPR".
+            k (int, optional): The number of passages to retrieve. Defaults to 10.
+            budget_ms (float, optional): The latency budget of a "Cascade" request. Defaults to the cascade's.
+
+        Returns:
+            tuple: The indices of the retrieved passages and their scores.
+        """
+        loop = asyncio.get_running_loop()
+        if model == "BM25":
+            return await loop.run_in_executor(None, bm25_retrieve, query, self.bm25, k)
+        if model == "DPR":
+            return await self._dpr.submit((query, k))
+        if model == "Reranking":
+            return await self._rerank.submit((query, k))
+        if model == "Hybrid":
+            n = self.hybrid.candidates or 2 * k
+            (bm25_ids, bm25_scores), (dpr_ids, dpr_scores) = await asyncio.gather(
+                loop.run_in_executor(None, bm25_retrieve, query, self.bm25, n), self._dpr.submit((query, n))
+            )
+            return self.hybrid.fuse(
+                (numpy.asarray(bm25_ids, dtype=numpy.int64), numpy.asarray(bm25_scores)),
+                (numpy.asarray(dpr_ids, dtype=numpy.int64), numpy.asarray(dpr_scores, dtype=numpy.float64)),
+                k,
+            )
+        if model == "Cascade":
+            return await loop.run_in_executor(None, self.cascade.retrieve, query, k, budget_ms)
+        raise ValueError(f"Unknown model {model!r}, expected one of {MODELS}")
+
+    def stats(self) -> dict:
+        """
+        Returns the batching counters of the DPR and reranking batchers, the stage costs and exits of the cascade
+        and, when tracing is on, the latency summary of every traced stage.
+
+        Returns:
+            dict: The stats of each batcher and of the cascade, by name, and the stage summaries under "stages".
+        """
+        stats = {"dpr": self._dpr.stats(), "rerank": self._rerank.stats(), "cascade": self.cascade.stats()}
+        if tracing.is_enabled():
+            stats["stages"] = tracing.stats()
+        return stats
+
+    async def close(self):
+        """
+        Stops the batchers and the encoder thread.
+        """
+        await self._dpr.close()
+        await self._rerank.close()
+        self._model_executor.shutdown(wait=False)
+
+
+async def _respond(service: RetrievalService, method: str, target: str) -> tuple[int, dict | str]:
+    if method != "GET":
+        return 405, {"error": "only GET is supported"}
+
+    url = urlsplit(target)
+    params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+    if url.path == "/stats":
+        return 200, service.stats()
+    if url.path == "/metrics":
+        return 200, tracing.prometheus_text()
+    if url.path != "/search":
+        return 404, {"error": f"unknown path {url.path}"}
+
+    model = params.get("model", "DPR")
+    k = params.get("k", "10")
+    budget_ms = params.get("budget_ms")
+    # An empty or oversized k would fail the whole micro-batch it joins
+    valid_k = k.isdigit() and 1 <= int(k) <= service.max_k
+    valid_budget = budget_ms is None or budget_ms.replace(".", "", 1).isdigit()
+    if "q" not in params or model not in MODELS or not valid_k or not valid_budget:
+        return 400, {
+            "error": f"expected q, an optional model in {MODELS}, an optional integer k from 1 to {service.max_k} "
+            "and an optional budget_ms"
+        }
+
+    try:
+        ids, scores = await service.search(params["q"], model, int(k), None if budget_ms is None else float(budget_ms))
+        passages = get_retrieved_docs(ids)
+    except Exception as e:
+        # Answered rather than raised, which would drop the connection without a response
+        return 500, {"error": f"{type(e).__name__}: {e}"}
+    return 200, {"model": model, "ids": ids, "scores": scores, "passages": passages}
+
+
+async def handle_connection(service: RetrievalService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Serves the HTTP/1.1 requests of one connection, keeping it open between requests unless asked not to.
+
+    `GET /search?q=<query>&model=<model>&k=<k>[&budget_ms=<ms>]` returns the retrieved ids, scores and passages as JSON,
+    `GET /stats` the batching counters and `GET /metrics` the stage latency histograms in the Prometheus text
+    format.
+
+    Args:
+        service (RetrievalService): The service answering the requests.
+        reader (asyncio.StreamReader): The connection input.
+        writer (asyncio.StreamWriter): The connection output.
+    """
+    try:
+        while request_line := await reader.readline():
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            status, body = await _respond(service, method, target)
+            keep_alive = headers.get("connection", "").lower() != "close"
+
+            if isinstance(body, str):
+                payload, content_type = body.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                payload, content_type = json.dumps(body).encode("utf-8"), "application/json"
+            head = (
+                f"HTTP/1.1 {STATUS_LINES[status]}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            )
+            writer.write(head.encode("latin-1") + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, ValueError):
+        # Client went away or sent a malformed request line
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(
+    bm25,
+    dpr_index,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 32,
+    max_wait_ms: float = 5.0,
+    max_k: int = 100,
+):
+    """
+    Serves the retrieval models over HTTP until cancelled.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index.
+        host (str, optional): The interface to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on. Defaults to 8000.
+        max_batch_size (int, optional): The maximum number of queries per encoder pass. Defaults to 32.
+        max_wait_ms (float, optional): How long a query waits for others to share its batch. Defaults to 5.
+        max_k (int, optional): The largest number of passages a request may ask for. Defaults to 100.
+    """
+    service = RetrievalService(bm25, dpr_index, max_batch_size, max_wait_ms, max_k)
+    server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+    print(f"Serving on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main():
+    """
+    Command line entry point: `python -m sri_project.server --port 8000`.
+    """
+    parser = argparse.ArgumentParser(description="Serve the retrieval models over HTTP with micro-batching.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="Maximum queries per encoder pass.")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="Maximum wait for a batch to fill.")
+    parser.add_argument("--max-k", type=int, default=100, help="Maximum passages per request.")
+    parser.add_argument(
+        "--trace",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=None,
+        metavar="SAMPLE_RATE",
+        help="Record per-stage latency histograms, for a fraction of the requests (default all), at /metrics.",
+    )
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        tracing.enable(args.trace)
+
+    from sri_project.utils import dataset_loader
+    from sri_project.utils.utils import initialize_indexes, preload
+
+    preload()
+    bm25, dpr_index = initialize_indexes(dataset_loader.corpus)
+    asyncio.run(serve(bm25, dpr_index, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.max_k))
+
+
+if __name__ == "__main__":
+    main()
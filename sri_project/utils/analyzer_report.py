@@ -0,0 +1,148 @@
+import argparse
+import json
+import time
+
+import numpy
+
+from sri_project.models.analyzers import Analyzer
+from sri_project.models.bm25_index import BM25Index
+
+# The first config is the baseline the savings of the others are measured against
+DEFAULT_CONFIGS = [
+    {"tokenizer": "nltk"},
+    {"tokenizer": "regex"},
+    {"tokenizer": "regex", "stopwords": True, "stem": True},
+    {"tokenizer": "hf"},
+    {"tokenizer": "hf", "stopwords": True, "stem": True},
+]
+
+
+def _recall(bm25: BM25Index, analyzed_queries: list[list[str]], qrels, k: int) -> float:
+    recall = [
+        len(numpy.intersect1d(bm25.top_k(terms, k)[0], qrels[i])) / len(qrels[i])
+        for i, terms in enumerate(analyzed_queries)
+        if len(qrels[i])
+    ]
+    return float(numpy.mean(recall)) if recall else 0.0
+
+
+def analyzer_report(
+    corpus: list[str],
+    queries: list[str],
+    qrels,
+    configs: list[dict] | None = None,
+    k: int = 10,
+    workers: int | None = None,
+) -> list[dict]:
+    """
+    Measures the BM25 build time, query analysis latency and recall@k of several analyzers.
+
+    Build time is the corpus tokenization (in this process and split across `workers` processes) plus the
+    construction of the inverted index. Savings are relative to the first config, the NLTK tokenizer by default.
+
+    Args:
+        corpus (list[str]): The corpus to index.
+        queries (list[str]): The queries to analyze and run.
+        qrels (Qrels): The relevance judgments of the queries.
+        configs (list[dict], optional): The `Analyzer` parameters to evaluate. Defaults to `DEFAULT_CONFIGS`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        workers (int, optional): The number of processes of the parallel tokenization. Defaults to all cores.
+
+    Returns:
+        list[dict]: One row per analyzer with timings, vocabulary size, recall and savings over the baseline.
+    """
+    configs = DEFAULT_CONFIGS if configs is None else configs
+    report = []
+
+    for config in configs:
+        analyzer = Analyzer(**config)
+        # Untimed call, so loading NLTK data or the HF tokenizer is not charged to the first timing
+        analyzer(corpus[0] if corpus else "")
+
+        start_time = time.perf_counter()
+        tokenized_corpus = [analyzer(doc) for doc in corpus]
+        tokenize_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        analyzer.analyze_batch(corpus, workers)
+        parallel_tokenize_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        bm25 = BM25Index(tokenized_corpus, analyzer=analyzer)
+        index_s = time.perf_counter() - start_time
+
+        latencies = numpy.empty(len(queries))
+        analyzed_queries = []
+        for i, query in enumerate(queries):
+            start_time = time.perf_counter()
+            analyzed_queries.append(analyzer(query))
+            latencies[i] = time.perf_counter() - start_time
+
+        report.append(
+            {
+                "analyzer": repr(analyzer),
+                "tokenize_s": tokenize_s,
+                "parallel_tokenize_s": parallel_tokenize_s,
+                "index_s": index_s,
+                "build_s": min(tokenize_s, parallel_tokenize_s) + index_s,
+                "query_us_mean": float(latencies.mean() * 1e6) if len(queries) else 0.0,
+                "query_us_p95": float(numpy.percentile(latencies, 95) * 1e6) if len(queries) else 0.0,
+                "vocab_size": len(bm25.vocab),
+                f"recall@{k}": _recall(bm25, analyzed_queries, qrels, k),
+            }
+        )
+
+    baseline = report[0]
+    for row in report:
+        row["build_saved_s"] = baseline["build_s"] - row["build_s"]
+        row["build_speedup"] = baseline["build_s"] / row["build_s"] if row["build_s"] else 0.0
+        row["query_saved_us"] = baseline["query_us_mean"] - row["query_us_mean"]
+        row["query_speedup"] = baseline["query_us_mean"] / row["query_us_mean"] if row["query_us_mean"] else 0.0
+
+    return report
+
+
+def print_report(report: list[dict]):
+    """
+    Prints an analyzer report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `analyzer_report`.
+    """
+    recall_key = next(key for key in report[0] if key.startswith("recall@"))
+    print(
+        f"{'analyzer':<80}{'build (s)':>10}{'speedup':>9}{'query (us)':>12}{'speedup':>9}"
+        f"{'vocab':>8}{recall_key:>11}"
+    )
+    for r in report:
+        print(
+            f"{r['analyzer']:<80}{r['build_s']:>10.2f}{r['build_speedup']:>8.1f}x{r['query_us_mean']:>12.1f}"
+            f"{r['query_speedup']:>8.1f}x{r['vocab_size']:>8}{r[recall_key]:>11.3f}"
+        )
+
+
+def main():
+    """
+    Compares the BM25 analyzers over the dataset and prints how much build and query time each one saves.
+    """
+    parser = argparse.ArgumentParser(description="Build time, query latency and recall of the BM25 analyzers.")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of dataset queries to analyze.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--workers", type=int, default=None, help="Processes of the parallel tokenization.")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    from sri_project.utils.dataset_loader import load_dataset
+
+    queries, corpus, qrels = load_dataset()
+
+    report = analyzer_report(corpus, queries[: args.queries], qrels, k=args.k, workers=args.workers)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
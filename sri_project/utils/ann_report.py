@@ -0,0 +1,225 @@
+import argparse
+import json
+import time
+
+import faiss
+import numpy
+from numpy import ndarray
+
+from sri_project.models.faiss_index import RescoringIndex, build_index, set_search_params
+
+DEFAULT_CONFIGS = [
+    {"index_type": "ivf_flat", "search": [{"nprobe": n} for n in (1, 4, 16, 64)]},
+    {"index_type": "ivf_pq", "search": [{"nprobe": n} for n in (1, 4, 16, 64)]},
+    {"index_type": "hnsw", "search": [{"ef_search": ef} for ef in (16, 32, 64, 128)]},
+]
+
+# Compressed vector storage, searched alone (rescore 0) and with rescoring of the candidates
+DEFAULT_STORAGE_CONFIGS = [
+    {"index_type": index_type, "storage": storage, "rescore": rescore}
+    for index_type in ("flat", "hnsw")
+    for storage in ("float16", "int8")
+    for rescore in (0, 2, 4)
+]
+
+
+def _timed_search(index: faiss.Index, query_embeddings: ndarray, k: int) -> tuple[ndarray, ndarray]:
+    # One query at a time, as the interactive search path issues them
+    latencies = numpy.empty(len(query_embeddings))
+    results = numpy.empty((len(query_embeddings), k), dtype=numpy.int64)
+    for i in range(len(query_embeddings)):
+        start_time = time.perf_counter()
+        _, ids = index.search(query_embeddings[i : i + 1], k)
+        latencies[i] = time.perf_counter() - start_time
+        results[i] = ids[0]
+    return results, latencies
+
+
+def _recall(results: ndarray, truth: ndarray) -> float:
+    hits = sum(len(numpy.intersect1d(r[r >= 0], t)) for r, t in zip(results, truth))
+    return hits / truth.size
+
+
+def recall_latency_report(
+    embeddings: ndarray, query_embeddings: ndarray, configs: list[dict] | None = None, k: int = 10
+) -> list[dict]:
+    """
+    Measures recall@k and search latency of approximate indexes against the exact flat index.
+
+    Each config holds the `build_index` parameters of an index plus a "search" list of `set_search_params`
+    settings to sweep. Recall is the overlap between the approximate and the exact top-k.
+
+    Args:
+        embeddings (numpy.ndarray): The passage embeddings to index.
+        query_embeddings (numpy.ndarray): The query embeddings to search with.
+        configs (list[dict], optional): The index configurations to evaluate. Defaults to `DEFAULT_CONFIGS`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+
+    Returns:
+        list[dict]: One row per index and search setting with build time, size, recall and latency figures.
+    """
+    query_embeddings = numpy.ascontiguousarray(query_embeddings, dtype=numpy.float32)
+    configs = DEFAULT_CONFIGS if configs is None else configs
+
+    def row(
+        name: str, index: faiss.Index, build_time: float, search: dict, truth: ndarray | None
+    ) -> tuple[dict, ndarray]:
+        results, latencies = _timed_search(index, query_embeddings, k)
+        return {
+            "index": name,
+            "search": search,
+            "build_s": build_time,
+            "bytes_per_vector": faiss.serialize_index(index).nbytes / max(index.ntotal, 1),
+            f"recall@{k}": 1.0 if truth is None else _recall(results, truth),
+            "latency_ms_mean": float(latencies.mean() * 1000),
+            "latency_ms_p95": float(numpy.percentile(latencies, 95) * 1000),
+        }, results
+
+    start_time = time.perf_counter()
+    flat = build_index(embeddings, "flat")
+    baseline, truth = row("flat", flat, time.perf_counter() - start_time, {}, None)
+    report = [baseline]
+
+    for config in configs:
+        build_params = {key: value for key, value in config.items() if key != "search"}
+        start_time = time.perf_counter()
+        index = build_index(embeddings, **build_params)
+        build_time = time.perf_counter() - start_time
+
+        for search in config.get("search", [{}]):
+            set_search_params(index, **search)
+            report.append(row(config["index_type"], index, build_time, search, truth)[0])
+
+    return report
+
+
+def storage_report(
+    embeddings: ndarray, query_embeddings: ndarray, configs: list[dict] | None = None, k: int = 10
+) -> list[dict]:
+    """
+    Measures the memory saved and the recall lost by storing the vectors as float16 or int8 instead of float32.
+
+    Each config holds the `build_index` parameters of an index plus a "rescore" factor: the number of candidates
+    per result rescored with the full float32 vectors, or 0 to search the compressed index alone. The full
+    vectors are not counted in the index memory, as they are read from the memory-mapped embedding store.
+    Recall is the overlap with the top-k of the exact float32 flat index, the current layout.
+
+    Args:
+        embeddings (numpy.ndarray): The passage embeddings to index.
+        query_embeddings (numpy.ndarray): The query embeddings to search with.
+        configs (list[dict], optional): The storage configurations to evaluate. Defaults to
+            `DEFAULT_STORAGE_CONFIGS`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+
+    Returns:
+        list[dict]: One row per configuration with index size, memory saved, recall, recall lost and latency.
+    """
+    query_embeddings = numpy.ascontiguousarray(query_embeddings, dtype=numpy.float32)
+    configs = DEFAULT_STORAGE_CONFIGS if configs is None else configs
+
+    truth = None
+    report = []
+    for config in [{"index_type": "flat", "storage": "float32", "rescore": 0}, *configs]:
+        build_params = {key: value for key, value in config.items() if key != "rescore"}
+        index = build_index(embeddings, **build_params)
+        index_bytes = faiss.serialize_index(index).nbytes
+        if config.get("rescore"):
+            index = RescoringIndex(index, embeddings, rescore=config["rescore"])
+
+        results, latencies = _timed_search(index, query_embeddings, k)
+        if truth is None:
+            truth, baseline_bytes = results, index_bytes
+
+        recall = _recall(results, truth)
+        report.append(
+            {
+                "index": config["index_type"],
+                "storage": config.get("storage", "float32"),
+                "rescore": config.get("rescore", 0),
+                "index_mb": index_bytes / 2**20,
+                "bytes_per_vector": index_bytes / max(len(embeddings), 1),
+                "memory_saved": 1 - index_bytes / baseline_bytes,
+                f"recall@{k}": recall,
+                "recall_lost": 1.0 - recall,
+                "latency_ms_mean": float(latencies.mean() * 1000),
+                "latency_ms_p95": float(numpy.percentile(latencies, 95) * 1000),
+            }
+        )
+
+    return report
+
+
+def print_report(report: list[dict]):
+    """
+    Prints a recall vs latency report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `recall_latency_report`.
+    """
+    recall_key = next(key for key in report[0] if key.startswith("recall@"))
+    print(
+        f"{'index':<10}{'search':<20}{'build (s)':>10}{'B/vector':>10}"
+        f"{recall_key:>11}{'mean (ms)':>11}{'p95 (ms)':>10}"
+    )
+    for r in report:
+        search = ", ".join(f"{key}={value}" for key, value in r["search"].items())
+        print(
+            f"{r['index']:<10}{search:<20}{r['build_s']:>10.2f}{r['bytes_per_vector']:>10.0f}"
+            f"{r[recall_key]:>11.3f}{r['latency_ms_mean']:>11.3f}{r['latency_ms_p95']:>10.3f}"
+        )
+
+
+def print_storage_report(report: list[dict]):
+    """
+    Prints a compressed storage report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `storage_report`.
+    """
+    recall_key = next(key for key in report[0] if key.startswith("recall@"))
+    print(
+        f"{'index':<8}{'storage':<9}{'rescore':>8}{'size (MB)':>11}{'B/vector':>10}{'saved':>8}"
+        f"{recall_key:>11}{'lost':>8}{'mean (ms)':>11}{'p95 (ms)':>10}"
+    )
+    for r in report:
+        print(
+            f"{r['index']:<8}{r['storage']:<9}{r['rescore']:>8}{r['index_mb']:>11.1f}{r['bytes_per_vector']:>10.0f}"
+            f"{r['memory_saved']:>8.1%}{r[recall_key]:>11.3f}{r['recall_lost']:>8.3f}"
+            f"{r['latency_ms_mean']:>11.3f}{r['latency_ms_p95']:>10.3f}"
+        )
+
+
+def main():
+    """
+    Builds every index configuration over the stored corpus embeddings and prints the recall vs latency report,
+    or with `--storage` the memory vs recall report of the compressed vector storage.
+    """
+    parser = argparse.ArgumentParser(description="Recall vs latency report of approximate DPR indexes.")
+    parser.add_argument("--store-dir", default=None, help="Embedding store directory.")
+    parser.add_argument("--queries", type=int, default=500, help="Number of dataset queries to search with.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--storage", action="store_true", help="Report float16 and int8 storage instead.")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    from sri_project.models.dpr import encode_queries
+    from sri_project.models.embedding_store import DEFAULT_STORE_DIR, update_store
+    from sri_project.utils.dataset_loader import corpus, queries
+
+    corpus_rows, embeddings = update_store(corpus, args.store_dir or DEFAULT_STORE_DIR)
+    query_embeddings = encode_queries(queries[: args.queries])
+
+    if args.storage:
+        report = storage_report(embeddings[corpus_rows], query_embeddings, k=args.k)
+        print_storage_report(report)
+    else:
+        report = recall_latency_report(embeddings[corpus_rows], query_embeddings, k=args.k)
+        print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable
+
+
+class MicroBatcher:
+    """
+    Groups the items submitted by concurrent coroutines into batches processed by one function call.
+
+    A batch starts with the first waiting item and takes every item that arrives within `max_wait_ms` of it, up to
+    `max_batch_size`. It is processed in `executor`, off the event loop, and each caller gets its own result.
+    While a batch is being processed the next one fills up, so batches grow with the load on their own and a
+    lone request only waits `max_wait_ms`.
+
+    Args:
+        process_batch (Callable[[list], list]): Processes a list of items, returning one result per item.
+        max_batch_size (int, optional): The maximum number of items per batch. Defaults to 32.
+        max_wait_ms (float, optional): How long the first item of a batch waits for others. Defaults to 5.
+        executor (Executor, optional): Where batches run. Defaults to the event loop's default executor.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[list], list],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        executor: Executor | None = None,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+
+        self.batches = 0
+        self.items = 0
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Adds an item to the next batch and waits for its result.
+
+        Args:
+            item (Any): The item to process.
+
+        Returns:
+            Any: The result of the item. Errors raised by the batch are raised here, to every caller of the batch.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def close(self):
+        """
+        Stops the batching task. Items still queued are cancelled.
+        """
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            self._queue.get_nowait()[1].cancel()
+        self._worker = self._queue = None
+
+    def stats(self) -> dict:
+        """
+        Returns the batching counters.
+
+        Returns:
+            dict: The number of batches and items processed and the mean batch size.
+        """
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Callers that gave up are left out of the batch
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
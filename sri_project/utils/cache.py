@@ -0,0 +1,342 @@
+import itertools
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Hashable
+
+import numpy
+
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.dpr import encode_query
+from sri_project.models.dpr_models import QUESTION_MODEL_ID, model_key
+from sri_project.utils.tracing import span
+
+if TYPE_CHECKING:
+    import torch
+
+_MISSING = object()
+
+
+def size_of(value: Any) -> int:
+    """
+    Estimates the memory held by a cached value.
+
+    Args:
+        value (Any): The cached value.
+
+    Returns:
+        int: The approximate size in bytes.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if hasattr(value, "element_size"):
+        # torch.Tensor, checked by duck typing so that torch is not imported just for this
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by number of entries and optionally by memory, with an optional TTL.
+
+    Args:
+        maxsize (int, optional): The maximum number of entries. Defaults to 1024.
+        ttl (float, optional): The number of seconds an entry stays valid. If None, entries never expire.
+        max_bytes (int, optional): The maximum estimated memory of all entries. If None, only maxsize applies.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None, max_bytes: int | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[Hashable, tuple[Any, float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the cached value of a key and marks it as most recently used.
+
+        The stored object itself is returned, not a copy, so cached values should be immutable or copied out by the
+        caller.
+
+        Args:
+            key (Hashable): The cache key.
+            default (Any, optional): The value returned on a miss. Defaults to None.
+
+        Returns:
+            Any: The cached value, or default if the key is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Stores a value, evicting the least recently used entries to stay within the bounds.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value to cache.
+        """
+        size = size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, time.monotonic(), size)
+            self.bytes += size
+
+            while len(self._entries) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of a key, computing and storing it on a miss.
+
+        Args:
+            key (Hashable): The cache key.
+            compute (Callable[[], Any]): Computes the value on a miss.
+
+        Returns:
+            Any: The cached or computed value.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """
+        Removes every entry. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Hits, misses, hit rate, evictions, expirations, number of entries and estimated bytes.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+            }
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+
+query_embedding_cache = LRUCache(maxsize=8192, max_bytes=64 * 1024 * 1024)
+result_cache = LRUCache(maxsize=8192, ttl=3600, max_bytes=64 * 1024 * 1024)
+
+_tokens = itertools.count()
+_model_tokens: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_tokens_lock = threading.Lock()
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query for use as cache key: lowercased, with whitespace collapsed.
+
+    Both the BM25 and the (uncased) DPR tokenizers produce the same tokens for a query and its normalized form.
+
+    Args:
+        query (str): The query string.
+
+    Returns:
+        str: The normalized query.
+    """
+    return " ".join(query.lower().split())
+
+
+def cache_token(model: Any) -> tuple[int, int]:
+    """
+    Returns a process-unique token identifying a model or index in cache keys.
+
+    Unlike `id`, the token is never reused by a later object, so results of a rebuilt index are not mixed up.
+    Indexes updated in place carry a `version` that is part of the token, so results of older states are
+    not reused either.
+
+    Args:
+        model (Any): The BM25 model or DPR index.
+
+    Returns:
+        tuple: The token of the object and its version.
+    """
+    with _tokens_lock:
+        token = _model_tokens.get(model)
+        if token is None:
+            token = _model_tokens[model] = next(_tokens)
+    return token, getattr(model, "version", 0)
+
+
+def _freeze_result(ids, scores) -> tuple[tuple[int, ...], tuple[float, ...] | numpy.ndarray]:
+    if isinstance(scores, numpy.ndarray):
+        scores = scores.copy()
+        scores.flags.writeable = False
+    else:
+        scores = tuple(scores)
+    return tuple(ids), scores
+
+
+def _cached_result(key: Hashable, compute: Callable[[], tuple]) -> tuple[list[int], list[float] | numpy.ndarray]:
+    # Results are stored frozen and handed out as copies, so a caller mutating the ids or scores it got back
+    # cannot change what later hits return
+    ids, scores = result_cache.get_or_compute(key, lambda: _freeze_result(*compute()))
+    return list(ids), scores.copy() if isinstance(scores, numpy.ndarray) else list(scores)
+
+
+def cached_encode_query(query: str) -> "torch.Tensor":
+    """
+    Encodes a query with the question encoder, reusing the embedding of previously seen queries.
+
+    Args:
+        query (str): The query to be encoded.
+
+    Returns:
+        torch.Tensor: The (1 x dim) query embedding, a copy of the cached one.
+    """
+    key = (normalize_query(query), model_key(QUESTION_MODEL_ID))
+    return query_embedding_cache.get_or_compute(key, lambda: encode_query(query)).clone()
+
+
+def cached_bm25_retrieve(query: str, bm25, top_k: int = 3) -> tuple[list[int], list[float]]:
+    """
+    Retrieves the top-k BM25 documents for a query, reusing the results of previously seen queries.
+
+    Args:
+        query (str): The query string.
+        bm25 (BM25Index): The BM25 object used for scoring.
+        top_k (int, optional): The number of top indices to retrieve. Defaults to 3.
+
+    Returns:
+        tuple: The top-k document indices and their scores.
+    """
+    key = ("bm25", normalize_query(query), cache_token(bm25), top_k)
+    return _cached_result(key, lambda: bm25_retrieve(query, bm25, top_k))
+
+
+def cached_retrieve_top_k_passages(index, query: str, k: int = 3) -> tuple[numpy.ndarray, list[int]]:
+    """
+    Retrieves the top k DPR passages for a query, reusing cached results and query embeddings.
+
+    Args:
+        index (faiss.Index): The index object used for searching.
+        query (str): The query string.
+        k (int, optional): The number of passages to retrieve. Defaults to 3.
+
+    Returns:
+        tuple: The scores and indices of the top k passages.
+    """
+
+    def retrieve():
+        query_embedding = cached_encode_query(query).numpy()
+        with span("dpr.search"):
+            D, results = index.search(query_embedding, k)
+        return results[0].tolist(), D[0]
+
+    key = ("dpr", normalize_query(query), model_key(QUESTION_MODEL_ID), cache_token(index), k)
+    ids, scores = _cached_result(key, retrieve)
+    return scores, ids
+
+
+def cached_rerank(reranker, query: str, k: int = 10) -> tuple[list[int], list[float]]:
+    """
+    Reranks the BM25 candidates of a query, reusing the results of previously seen queries.
+
+    Results are keyed by the reranker's BM25 model, DPR index and fusion settings, so rerankers built over
+    the same indexes share entries.
+
+    Args:
+        reranker (Reranker): The reranker.
+        query (str): The query string.
+        k (int, optional): The number of passages to return. Defaults to 10.
+
+    Returns:
+        tuple: The indices of the reranked passages and their fused scores.
+    """
+    index_token = None if reranker.dpr_index is None else cache_token(reranker.dpr_index)
+    key = (
+        "rerank",
+        normalize_query(query),
+        model_key(QUESTION_MODEL_ID),
+        cache_token(reranker.bm25),
+        index_token,
+        reranker.weight,
+        reranker.threshold,
+        k,
+    )
+    return _cached_result(key, lambda: reranker.rerank(query, k))
+
+
+def cached_hybrid_retrieve(hybrid, query: str, k: int = 10) -> tuple[list[int], list[float]]:
+    """
+    Retrieves the fused BM25 and DPR results of a query, reusing the results of previously seen queries.
+
+    Args:
+        hybrid (HybridRetriever): The hybrid retriever.
+        query (str): The query string.
+        k (int, optional): The number of passages to return. Defaults to 10.
+
+    Returns:
+        tuple: The indices of the retrieved passages and their fused scores.
+    """
+    key = (
+        "hybrid",
+        normalize_query(query),
+        model_key(QUESTION_MODEL_ID),
+        cache_token(hybrid.bm25),
+        cache_token(hybrid.dpr_index),
+        hybrid.fusion,
+        hybrid.weights,
+        hybrid.candidates,
+        hybrid.rrf_k,
+        k,
+    )
+    return _cached_result(key, lambda: hybrid.retrieve(query, k))
+
+
+def cache_stats() -> dict:
+    """
+    Returns the counters of the query embedding and result caches.
+
+    Returns:
+        dict: The stats of each cache, by name.
+    """
+    return {"query_embedding": query_embedding_cache.stats(), "result": result_cache.stats()}
@@ -0,0 +1,150 @@
+import argparse
+import json
+import time
+
+import numpy
+
+from sri_project.models.cascade import CROSS_ENCODER_MODEL_ID, STAGES, RetrievalCascade
+from sri_project.utils.metrics import ranking_metrics, result_matrix
+
+DEFAULT_CONFIGS = [
+    {"name": "candidates", "rescore_k": 0},
+    {"name": "rescore", "rescore_k": 20},
+    {"name": "cross_encoder", "rescore_k": 20, "cross_encoder_k": 5},
+    {"name": "cross_encoder margin", "rescore_k": 20, "cross_encoder_k": 5, "margin": 0.1},
+]
+
+# Untimed queries per config, so the stage costs the budgets rely on are known before measuring
+WARMUP_QUERIES = 20
+
+
+def cascade_report(bm25, dpr_index, queries: list[str], qrels, configs: list[dict] | None = None, k: int = 10):
+    """
+    Measures the quality, end-to-end latency and stage costs of retrieval cascade configurations.
+
+    Every config holds the `RetrievalCascade` parameters plus a "name". Queries are issued one at a time, as the
+    interactive search path issues them, after `WARMUP_QUERIES` untimed ones.
+
+    Args:
+        bm25 (BM25Index): The BM25 model.
+        dpr_index (faiss.Index): The DPR index.
+        queries (list[str]): The queries.
+        qrels (Qrels): The relevance judgments of the queries.
+        configs (list[dict], optional): The cascades to compare. Defaults to `DEFAULT_CONFIGS`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+
+    Returns:
+        list[dict]: One row per config with recall, MRR, latency percentiles, the p95 cost of every stage and the
+        count of every exit reason.
+    """
+    report = []
+    for config in configs or DEFAULT_CONFIGS:
+        params = {key: value for key, value in config.items() if key != "name"}
+        cascade = RetrievalCascade(bm25, dpr_index, **params)
+
+        for query in queries[:WARMUP_QUERIES]:
+            cascade.retrieve(query, k)
+        exits_before = dict(cascade.exits)
+
+        results = []
+        latencies = numpy.empty(len(queries))
+        for i, query in enumerate(queries):
+            start_time = time.perf_counter()
+            ids, _ = cascade.retrieve(query, k)
+            latencies[i] = time.perf_counter() - start_time
+            results.append(ids)
+
+        metrics = ranking_metrics(result_matrix(results, k), qrels)
+        stats = cascade.stats()
+        report.append(
+            {
+                "name": config.get("name", str(params)),
+                f"recall@{k}": float(metrics["recall"][:, -1].mean()),
+                f"mrr@{k}": float(metrics["mrr"][:, -1].mean()),
+                "latency_ms_mean": float(latencies.mean() * 1000),
+                "latency_ms_p50": float(numpy.percentile(latencies, 50) * 1000),
+                "latency_ms_p95": float(numpy.percentile(latencies, 95) * 1000),
+                "latency_ms_p99": float(numpy.percentile(latencies, 99) * 1000),
+                "stage_ms_p95": {stage: stats["stages"][stage]["p95"] * 1000 for stage in STAGES},
+                "exits": {
+                    reason: count - exits_before.get(reason, 0)
+                    for reason, count in stats["exits"].items()
+                    if count - exits_before.get(reason, 0)
+                },
+            }
+        )
+    return report
+
+
+def print_report(report: list[dict]):
+    """
+    Prints a cascade report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `cascade_report`.
+    """
+    recall_key = next(key for key in report[0] if key.startswith("recall@"))
+    mrr_key = next(key for key in report[0] if key.startswith("mrr@"))
+    print(
+        f"{'config':<24}{recall_key:>11}{mrr_key:>9}{'mean (ms)':>11}{'p95 (ms)':>10}{'p99 (ms)':>10}"
+        f"{'cand p95':>10}{'resc p95':>10}{'cross p95':>11}  exits"
+    )
+    for r in report:
+        stage_ms = r["stage_ms_p95"]
+        exits = ", ".join(f"{reason} {count}" for reason, count in sorted(r["exits"].items()))
+        print(
+            f"{r['name']:<24}{r[recall_key]:>11.3f}{r[mrr_key]:>9.3f}{r['latency_ms_mean']:>11.2f}"
+            f"{r['latency_ms_p95']:>10.2f}{r['latency_ms_p99']:>10.2f}{stage_ms['candidates']:>10.2f}"
+            f"{stage_ms['rescore']:>10.2f}{stage_ms['cross_encoder']:>11.2f}  {exits}"
+        )
+
+
+def main():
+    """
+    Compares retrieval cascade configurations over a slice of the dataset.
+    """
+    parser = argparse.ArgumentParser(description="Quality and latency of budgeted retrieval cascades.")
+    parser.add_argument("--passages", type=int, default=2000, help="Number of dataset passages to index.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of dataset queries to run.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--cross-encoder", default=CROSS_ENCODER_MODEL_ID, help="Cross-encoder model ID.")
+    parser.add_argument(
+        "--budgets", type=float, nargs="*", default=[], help="Also run the full cascade under these budgets (ms)."
+    )
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    from sri_project.utils.dataset_loader import Qrels, load_dataset
+    from sri_project.utils.utils import initialize_indexes
+
+    queries, corpus, qrels = load_dataset()
+
+    # Keep the queries with a judgment inside the passage slice, and only those judgments
+    queries_in_slice, indptr, doc_ids = [], [0], []
+    for i, query in enumerate(queries):
+        relevant = qrels[i][qrels[i] < args.passages]
+        if len(relevant):
+            queries_in_slice.append(query)
+            doc_ids.extend(relevant.tolist())
+            indptr.append(len(doc_ids))
+        if len(queries_in_slice) == args.queries:
+            break
+    qrels = Qrels(numpy.asarray(indptr, dtype=numpy.int64), numpy.asarray(doc_ids, dtype=numpy.int64))
+
+    configs = [dict(config) for config in DEFAULT_CONFIGS]
+    for budget in args.budgets:
+        configs.append({"name": f"budget {budget:g} ms", "rescore_k": 20, "cross_encoder_k": 5, "budget_ms": budget})
+    for config in configs:
+        config["cross_encoder_model"] = args.cross_encoder
+
+    bm25, dpr_index = initialize_indexes(corpus[: args.passages], store_dir=None)
+    report = cascade_report(bm25, dpr_index, queries_in_slice, qrels, configs, args.k)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,191 @@
 import os
-from collections import defaultdict
+from functools import cache
 
-import pandas as pd
+import numpy
+from numpy import ndarray
+
+from sri_project.utils.passage_store import PassageStore, write_passages
 
 # Load the CSV file
 csv_file = "sri_project/data/data.csv"
-data = pd.read_csv(csv_file)
+cache_dir = "sri_project/data/.cache"
+
+CACHE_VERSION = 1
+
+
+class Qrels:
+    """
+    Relevance judgments in CSR layout: the corpus indices relevant to query `i` are
+    `doc_ids[indptr[i] : indptr[i + 1]]`, in ascending order.
+
+    Args:
+        indptr (numpy.ndarray): The (queries + 1) offsets of every query's judgments.
+        doc_ids (numpy.ndarray): The relevant corpus indices of all queries, concatenated.
+    """
+
+    def __init__(self, indptr: ndarray, doc_ids: ndarray):
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def __getitem__(self, query_index: int) -> ndarray:
+        return self.doc_ids[self.indptr[query_index] : self.indptr[query_index + 1]]
+
+
+def pack_strings(strings: list[str]) -> tuple[ndarray, ndarray]:
+    """
+    Packs strings into a single UTF-8 blob and an offsets array.
+
+    Args:
+        strings (list[str]): The strings to pack.
+
+    Returns:
+        tuple: The uint8 blob and the (strings + 1) int64 byte offsets of every string in it.
+    """
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets
+
+
+def unpack_strings(blob: ndarray, offsets: ndarray) -> list[str]:
+    """
+    Unpacks the strings packed by `pack_strings`.
+
+    Args:
+        blob (numpy.ndarray): The uint8 blob.
+        offsets (numpy.ndarray): The byte offsets of every string.
+
+    Returns:
+        list[str]: The strings.
+    """
+    raw = blob.tobytes()
+    bounds = offsets.tolist()
+    return [raw[start:end].decode("utf-8") for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _build_dataset(path: str) -> dict[str, ndarray]:
+    import pandas as pd
+
+    data = pd.read_csv(path, usecols=["question_id", "question", "answer"])
+
+    # Codes follow the order of first appearance, so query and corpus indices are stable across loads
+    query_codes, _ = pd.factorize(data["question_id"])
+    answer_codes, corpus = pd.factorize(data["answer"])
+    query_codes = query_codes.astype(numpy.int64)
+
+    first_rows = numpy.unique(query_codes, return_index=True)[1]
+    queries = data["question"].to_numpy()[first_rows]
+
+    # Distinct (query, answer) pairs, sorted by query and then by corpus index
+    pairs = numpy.unique(query_codes * len(corpus) + answer_codes)
+    pair_queries, pair_docs = numpy.divmod(pairs, len(corpus))
+
+    qrels_indptr = numpy.zeros(len(queries) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(pair_queries, minlength=len(queries)), out=qrels_indptr[1:])
+
+    queries_blob, queries_offsets = pack_strings(queries.tolist())
+    corpus_blob, corpus_offsets = pack_strings(corpus.tolist())
+    return {
+        "queries_blob": queries_blob,
+        "queries_offsets": queries_offsets,
+        "corpus_blob": corpus_blob,
+        "corpus_offsets": corpus_offsets,
+        "qrels_indptr": qrels_indptr,
+        "qrels_doc_ids": pair_docs.astype(numpy.int32),
+    }
+
+
+def dataset_cache_path(path: str = csv_file) -> str:
+    """
+    Returns the binary cache file of a dataset CSV. The name changes whenever the CSV does.
+
+    Args:
+        path (str, optional): The dataset CSV. Defaults to the project dataset.
+
+    Returns:
+        str: The path of the cache file.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.basename(path)}-{stat.st_size}-{stat.st_mtime_ns}-v{CACHE_VERSION}"
+    return os.path.join(cache_dir, f"{key}.npz")
+
+
+def load_arrays(path: str = csv_file) -> dict[str, ndarray]:
+    """
+    Loads the dataset as compact arrays, from the binary cache while the CSV is unchanged.
+
+    Args:
+        path (str, optional): The dataset CSV. Defaults to the project dataset.
+
+    Returns:
+        dict: The packed queries and corpus (blob and offsets) and the relevance judgments in CSR layout.
+    """
+    cache_path = dataset_cache_path(path)
+    if os.path.exists(cache_path):
+        with numpy.load(cache_path) as cached:
+            return dict(cached)
+
+    arrays = _build_dataset(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp.npz"
+    numpy.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+    return arrays
+
 
-# Initialize a dictionary to hold the grouped data
-grouped_data = defaultdict(lambda: {"question": "", "answers": []})
+@cache
+def load_dataset() -> tuple[list[str], list[str], Qrels]:
+    """
+    Loads the dataset on first use.
 
-queries = []
-corpus = []
+    Returns:
+        tuple: The queries, the corpus of distinct answers, and the relevance judgments mapping every query
+        index to the corpus indices of its answers.
+    """
+    arrays = load_arrays()
+    queries = unpack_strings(arrays["queries_blob"], arrays["queries_offsets"])
+    corpus = unpack_strings(arrays["corpus_blob"], arrays["corpus_offsets"])
+    return queries, corpus, Qrels(arrays["qrels_indptr"], arrays["qrels_doc_ids"])
 
-used_ids = set()
-used_answers = set()
 
-id = -1
-for _, row in data.iterrows():
-    question_id = row["question_id"]
+@cache
+def corpus_store(path: str = csv_file) -> PassageStore:
+    """
+    Opens the corpus as a memory-mapped `PassageStore`, writing its blob next to the binary cache on first use.
 
-    question = row["question"]
-    answer = row["answer"]
-    label = row["label"]
+    Unlike `corpus`, the store holds no Python strings: all processes share the page-cached blob.
 
-    if question_id not in used_ids:
-        used_ids.add(question_id)
-        queries.append(row["question"])
+    Args:
+        path (str, optional): The dataset CSV. Defaults to the project dataset.
 
-    question_id = len(used_ids) - 1
+    Returns:
+        PassageStore: The corpus passages, by corpus index.
+    """
+    blob_path = dataset_cache_path(path).removesuffix(".npz") + ".corpus.bin"
+    if not os.path.exists(blob_path):
+        arrays = load_arrays(path)
+        write_passages(arrays["corpus_blob"], arrays["corpus_offsets"], blob_path)
+    return PassageStore(blob_path)
 
-    if answer not in used_answers:
-        used_answers.add(answer)
-        corpus.append(answer)
-        id += 1
 
-    # Update the dictionary
-    grouped_data[question_id]["question"] = question
-    # if label == 1:
-    grouped_data[question_id]["answers"].append(id)
+@cache
+def _grouped_data() -> dict:
+    queries, _, qrels = load_dataset()
+    return {i: {"question": queries[i], "answers": qrels[i].tolist()} for i in range(len(queries))}
 
 
-# clear console
-os.system("clear")
+def __getattr__(name: str):
+    # Keeps `from dataset_loader import corpus, queries, ...` working, loading the data on first access
+    if name == "queries":
+        return load_dataset()[0]
+    if name == "corpus":
+        return load_dataset()[1]
+    if name == "qrels":
+        return load_dataset()[2]
+    if name == "grouped_data":
+        return _grouped_data()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,170 @@
+import argparse
+import io
+import json
+import os
+import time
+
+import numpy
+from numpy import ndarray
+
+from sri_project.models import dpr_models
+from sri_project.models.dpr import create_faiss_index, encode_passages, encode_queries, encode_query
+from sri_project.models.encoder_backends import BACKENDS, OnnxEncoder
+
+
+def _model_size_mb(encoder) -> float:
+    if isinstance(encoder, OnnxEncoder):
+        return os.path.getsize(encoder.path) / 2**20
+
+    import torch
+
+    buffer = io.BytesIO()
+    torch.save(encoder.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def _cosine(a: ndarray, b: ndarray) -> ndarray:
+    return (a * b).sum(axis=1) / (numpy.linalg.norm(a, axis=1) * numpy.linalg.norm(b, axis=1) + 1e-12)
+
+
+def encoder_report(
+    corpus: list[str], queries: list[str], qrels, backends: list[str] | None = None, k: int = 10
+) -> list[dict]:
+    """
+    Compares the DPR inference backends against the fp32 PyTorch encoders.
+
+    Every backend encodes the corpus and the queries and searches an exact index of its own passage embeddings.
+    Agreement with fp32 is measured as the cosine similarity of the embeddings and the overlap of the top-k
+    results; retrieval quality as recall@k against the relevance judgments. Query latency is measured one
+    query at a time, as the interactive search path encodes them.
+
+    Args:
+        corpus (list[str]): The passages to encode and search.
+        queries (list[str]): The queries to encode and search with.
+        qrels (Qrels): The relevance judgments of the queries, as positions in `corpus`.
+        backends (list[str], optional): The backends to compare. Defaults to all of `BACKENDS`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+
+    Returns:
+        list[dict]: One row per backend with agreement, recall, latency, speedup and model size figures.
+    """
+    backends = list(BACKENDS) if backends is None else backends
+    if backends[0] != "torch":
+        backends = ["torch", *(backend for backend in backends if backend != "torch")]
+
+    previous_backend = dpr_models.get_backend()
+    report = []
+    try:
+        for backend in backends:
+            dpr_models.set_backend(backend)
+
+            start_time = time.perf_counter()
+            embeddings = encode_passages(corpus)
+            encode_passages_s = time.perf_counter() - start_time
+            query_embeddings = encode_queries(queries)
+
+            # Untimed call, so loading or exporting the model is not charged to the first query
+            encode_query(queries[0])
+            latencies = numpy.empty(len(queries))
+            for i, query in enumerate(queries):
+                start_time = time.perf_counter()
+                encode_query(query)
+                latencies[i] = time.perf_counter() - start_time
+
+            _, results = create_faiss_index(embeddings).search(query_embeddings, k)
+
+            if not report:
+                fp32_embeddings, fp32_query_embeddings, fp32_results = embeddings, query_embeddings, results
+            similarity = numpy.concatenate(
+                [_cosine(embeddings, fp32_embeddings), _cosine(query_embeddings, fp32_query_embeddings)]
+            )
+            overlap = [len(numpy.intersect1d(r, t)) / k for r, t in zip(results, fp32_results)]
+            recall = [
+                len(numpy.intersect1d(results[i], qrels[i])) / len(qrels[i])
+                for i in range(len(queries))
+                if len(qrels[i])
+            ]
+
+            report.append(
+                {
+                    "backend": backend,
+                    "cosine_mean": float(similarity.mean()),
+                    "cosine_min": float(similarity.min()),
+                    f"overlap@{k}": float(numpy.mean(overlap)),
+                    f"recall@{k}": float(numpy.mean(recall)) if recall else 0.0,
+                    "encode_passages_s": encode_passages_s,
+                    "query_ms_mean": float(latencies.mean() * 1000),
+                    "query_ms_p95": float(numpy.percentile(latencies, 95) * 1000),
+                    "model_mb": _model_size_mb(dpr_models.get_question_encoder()),
+                }
+            )
+    finally:
+        dpr_models.set_backend(previous_backend)
+
+    baseline = report[0]
+    for row in report:
+        row["query_speedup"] = baseline["query_ms_mean"] / row["query_ms_mean"] if row["query_ms_mean"] else 0.0
+        row[f"recall@{k}_delta"] = row[f"recall@{k}"] - baseline[f"recall@{k}"]
+
+    return report
+
+
+def print_report(report: list[dict]):
+    """
+    Prints an encoder backend report as a table.
+
+    Args:
+        report (list[dict]): The rows returned by `encoder_report`.
+    """
+    overlap_key = next(key for key in report[0] if key.startswith("overlap@"))
+    recall_key = next(key for key in report[0] if key.startswith("recall@") and not key.endswith("_delta"))
+    print(
+        f"{'backend':<11}{'cos mean':>10}{'cos min':>9}{overlap_key:>12}{recall_key:>11}{'delta':>8}"
+        f"{'query (ms)':>12}{'p95 (ms)':>10}{'speedup':>9}{'size (MB)':>11}"
+    )
+    for r in report:
+        print(
+            f"{r['backend']:<11}{r['cosine_mean']:>10.4f}{r['cosine_min']:>9.4f}{r[overlap_key]:>12.3f}"
+            f"{r[recall_key]:>11.3f}{r[recall_key + '_delta']:>+8.3f}{r['query_ms_mean']:>12.2f}"
+            f"{r['query_ms_p95']:>10.2f}{r['query_speedup']:>8.1f}x{r['model_mb']:>11.1f}"
+        )
+
+
+def main():
+    """
+    Compares the accuracy and query encoding speed of the DPR backends over a slice of the dataset.
+    """
+    parser = argparse.ArgumentParser(description="Accuracy and speed of the quantized and ONNX DPR encoders.")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS), help="Backends.")
+    parser.add_argument("--passages", type=int, default=2000, help="Number of dataset passages to encode.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of dataset queries to encode.")
+    parser.add_argument("-k", type=int, default=10, help="Number of passages retrieved per query.")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    from sri_project.utils.dataset_loader import Qrels, load_dataset
+
+    queries, corpus, qrels = load_dataset()
+
+    # Keep the queries with a judgment inside the passage slice, and only those judgments
+    queries_in_slice, indptr, doc_ids = [], [0], []
+    for i, query in enumerate(queries):
+        relevant = qrels[i][qrels[i] < args.passages]
+        if len(relevant):
+            queries_in_slice.append(query)
+            doc_ids.extend(relevant.tolist())
+            indptr.append(len(doc_ids))
+        if len(queries_in_slice) == args.queries:
+            break
+    qrels = Qrels(numpy.asarray(indptr, dtype=numpy.int64), numpy.asarray(doc_ids, dtype=numpy.int64))
+
+    report = encoder_report(corpus[: args.passages], queries_in_slice, qrels, args.backends, args.k)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import json
+import os
+from typing import Iterator
+
+from sri_project.models.dpr_models import CONTEXT_MODEL_ID, QUESTION_MODEL_ID, model_key
+from sri_project.models.embedding_store import index_fingerprint
+from sri_project.utils.metrics import RunningMetrics, iter_retrievals, print_average_metrics, score_records
+
+EVAL_LOG_DIR = "sri_project/data/.eval"
+
+
+class EvaluationLog:
+    """
+    An append-only JSON Lines log of evaluation records with a checkpoint next to it.
+
+    The checkpoint (`<path>.ckpt`) holds the byte size of the log, the number of queries done and the running
+    aggregates at the last `checkpoint` call, written atomically after the log is synced to disk. Reopening a log
+    truncates it back to its checkpoint, dropping any record written after it (e.g. by a run that crashed), and
+    restores the aggregates, so the evaluation continues where the checkpoint left it. A log written with a
+    different config is started over.
+
+    Args:
+        path (str): The log file.
+        config (dict): What the evaluation depends on, e.g. the model, the cutoff and the fingerprint of the
+            indexes. A log is only resumed by an evaluation with the same config.
+        labels (tuple[str, ...]): The models of the records.
+        resume (bool, optional): Continue an existing log. If False, it is started over. Defaults to True.
+    """
+
+    def __init__(self, path: str, config: dict, labels: tuple[str, ...], resume: bool = True):
+        self.path = path
+        self.checkpoint_path = path + ".ckpt"
+        self.config = config
+
+        checkpoint = None
+        if resume and os.path.exists(self.checkpoint_path) and os.path.exists(path):
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+            # A log of other indexes or settings holds stale records, and one shorter than its checkpoint was
+            # replaced or cut by something else; neither can be resumed
+            if checkpoint["config"] != config or os.path.getsize(path) < checkpoint["size"]:
+                checkpoint = None
+        elif os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        if checkpoint is None:
+            self.position, self.metrics, size = 0, RunningMetrics(labels), 0
+        else:
+            self.position, self.metrics = checkpoint["position"], RunningMetrics.from_state(checkpoint["metrics"])
+            size = checkpoint["size"]
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "ab")
+        self._file.truncate(size)
+        self._file.seek(size)
+
+    def append(self, record: dict):
+        """
+        Writes a scored record to the log and adds it to the running aggregates.
+
+        Args:
+            record (dict): A record of `score_records`.
+        """
+        self._file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.metrics.update(record)
+        self.position += 1
+
+    def checkpoint(self):
+        """
+        Syncs the log to disk and records the current position and aggregates as the point to resume from.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        checkpoint = {
+            "config": self.config,
+            "position": self.position,
+            "size": self._file.tell(),
+            "metrics": self.metrics.state(),
+        }
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def close(self):
+        """
+        Checkpoints and closes the log.
+        """
+        if not self._file.closed:
+            self.checkpoint()
+            self._file.close()
+
+    def __enter__(self) -> "EvaluationLog":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def read_log(path: str) -> Iterator[dict]:
+    """
+    Streams the records of an evaluation log, up to its last complete line.
+
+    Args:
+        path (str): The log file.
+
+    Yields:
+        dict: The records, in evaluation order.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            if line.endswith(b"\n"):
+                yield json.loads(line)
+
+
+class ResultTable:
+    """
+    Random access to the records of an evaluation log by query index.
+
+    The byte offset of every complete record is indexed when the table is opened; a lookup reads and parses only
+    the line of its query.
+
+    Args:
+        path (str): The log file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets: dict[int, int] = {}
+
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    self._offsets[json.loads(line)["query"]] = offset
+                offset += len(line)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __contains__(self, query_index: int) -> bool:
+        return query_index in self._offsets
+
+    def get(self, query_index: int) -> dict | None:
+        """
+        Returns the record of a query.
+
+        Args:
+            query_index (int): The query index.
+
+        Returns:
+            dict | None: The record, or None if the query is not in the table.
+        """
+        offset = self._offsets.get(query_index)
+        if offset is None:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def query_indices(self) -> list[int]:
+        """
+        Returns the indices of the queries in the table, in log order.
+        """
+        return list(self._offsets)
+
+
+def log_series(path: str, labels: tuple[str, ...], k: int = 10) -> tuple[list, list, list]:
+    """
+    Reads the per-query times, recall and precision of every model from an evaluation log.
+
+    Args:
+        path (str): The log file.
+        labels (tuple[str, ...]): The models, in output order.
+        k (int, optional): The cutoff of the logged metrics. Defaults to 10.
+
+    Returns:
+        tuple: The times, recall values and precision values of every model, in the layout of
+        `evaluate_performance`.
+    """
+    times, recall_values, precision_values = ([[] for _ in labels] for _ in range(3))
+    for record in read_log(path):
+        for m, label in enumerate(labels):
+            times[m].append(record[label]["time"])
+            recall_values[m].append(record[label][f"recall@{k}"])
+            precision_values[m].append(record[label][f"precision@{k}"])
+    return times, recall_values, precision_values
+
+
+def evaluation_fingerprint(corpus: list[str], bm25, index_type: str = "flat", index_params: dict | None = None) -> dict:
+    """
+    Identifies everything the results of an evaluation over a corpus depend on besides the queries.
+
+    Covers the passages and DPR index configuration (see `embedding_store.index_fingerprint`), both encoders and
+    their backend, the BM25 analyzer and the BM25 parameters.
+
+    Args:
+        corpus (list[str]): The indexed passages.
+        bm25 (BM25Index): The BM25 model of the corpus.
+        index_type (str, optional): The type of the DPR index. Defaults to "flat".
+        index_params (dict, optional): The build parameters of the DPR index, see `utils.initialize_indexes`.
+
+    Returns:
+        dict: The fingerprint, JSON serializable.
+    """
+    return {
+        "index": index_fingerprint(corpus, index_type=index_type, **(index_params or {})),
+        "encoders": [model_key(CONTEXT_MODEL_ID), model_key(QUESTION_MODEL_ID)],
+        "analyzer": repr(bm25.analyzer),
+        "bm25": [bm25.k1, bm25.b, bm25.epsilon],
+    }
+
+
+def evaluate_to_log(
+    data,
+    queries: list[str],
+    bm25,
+    dpr_index,
+    path: str,
+    k: int = 10,
+    rerank_model: str = "Reranking",
+    checkpoint_every: int = 256,
+    resume: bool = True,
+    fingerprint: dict | None = None,
+) -> dict[str, dict[str, float]]:
+    """
+    Evaluates BM25, DPR and the reranking model over all queries, streaming one record per query to a log.
+
+    Records hold ids, scores, timings and metrics, never passage text, and aggregates are kept as running sums,
+    so memory does not grow with the number of queries. The log is checkpointed every `checkpoint_every` queries;
+    an interrupted evaluation resumes from its last checkpoint, and a finished one returns its aggregates without
+    evaluating again. Both only happen for a log written with the same `fingerprint`; otherwise, or without a
+    fingerprint, the log is started over.
+
+    Args:
+        data (Qrels): The relevance judgments, where data[i] holds the corpus indices of the answers of query i.
+        queries (list[str]): The queries to evaluate.
+        bm25 (BM25Index): The BM25 retrieval model.
+        dpr_index (faiss.Index): The DPR retrieval model index.
+        path (str): The log file, e.g. under `EVAL_LOG_DIR`.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        rerank_model (str, optional): The model of the third stage, "Reranking" or "Hybrid". Defaults to
+            "Reranking".
+        checkpoint_every (int, optional): The number of queries between checkpoints. Defaults to 256.
+        resume (bool, optional): Continue the existing log at `path`. If False, it is started over. Defaults to
+            True.
+        fingerprint (dict, optional): The `evaluation_fingerprint` of the corpus and indexes.
+
+    Returns:
+        dict[str, dict[str, float]]: The mean time and metrics of every model over all queries.
+    """
+    labels = ("BM25", "DPR", rerank_model)
+    config = {"queries": len(queries), "k": k, "rerank_model": rerank_model, "fingerprint": fingerprint}
+
+    with EvaluationLog(path, config, labels, resume and fingerprint is not None) as log:
+        query_indices = range(log.position, len(queries))
+        records = score_records(iter_retrievals(queries, bm25, dpr_index, query_indices, k, rerank_model), data, k)
+        for record in records:
+            log.append(record)
+            if log.position % checkpoint_every == 0:
+                log.checkpoint()
+
+    means = log.metrics.means()
+    # Each mean stands for the whole run, so it is passed as the only value of its model
+    print_average_metrics(
+        [[means[label].get(f"recall@{k}", 0.0)] for label in labels],
+        [[means[label].get(f"precision@{k}", 0.0)] for label in labels],
+        rerank_model,
+        [means[label] for label in labels],
+    )
+    return means
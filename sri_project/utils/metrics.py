@@ -1,96 +1,375 @@
 import time
-
-from torch import cosine_similarity
-
-from sri_project.models.bm25 import bm25_retrieve
-from sri_project.models.dpr import encode_query, retrieve_top_k_passages
+from functools import partial
+from itertools import islice
+from typing import Iterable, Iterator
+
+import numpy
+from numpy import ndarray
+
+from sri_project.models.hybrid import HybridRetriever
+from sri_project.models.reranker import Reranker
+from sri_project.utils.cache import (
+    cached_bm25_retrieve,
+    cached_encode_query,
+    cached_hybrid_retrieve,
+    cached_rerank,
+    cached_retrieve_top_k_passages,
+)
 from sri_project.utils.utils import get_retrieved_docs
 
 
-def evaluate_performance(data, queries: list[str], bm25, dpr_index, query_index: int | None = None) -> tuple:
+def evaluate_performance(
+    data, queries: list[str], bm25, dpr_index, query_index: int | None = None, rerank_model: str = "Reranking"
+) -> tuple:
     """
     Evaluate the performance of the BM25 and DPR retrieval models.
 
     Args:
-        data:  A dictionary containing the grouped data.
+        data (Qrels): The relevance judgments, where data[i] holds the corpus indices of the answers of query i.
         queries (list): A list of queries to evaluate.
         bm25 (BM25): The BM25 retrieval model.
         dpr_index (DPRIndex): The DPR retrieval model index.
         query_index (int): The index of the query to evaluate. If None, all queries are evaluated.
+        rerank_model (str): The model of the third stage: "Reranking" (BM25 candidates rescored with DPR) or
+            "Hybrid" (BM25 and DPR candidates retrieved concurrently and fused). Defaults to "Reranking".
 
     Returns:
         tuple: A tuple containing the time, memory usage, recall, and precision values for BM25, DPR, and Reranking.
     """
+    k = 10
+    labels = ("BM25", "DPR", rerank_model)
+    query_indices = range(len(queries)) if query_index is None else [query_index]
 
     times = [[] for _ in range(3)]
     recall_values = [[] for _ in range(3)]
     precision_values = [[] for _ in range(3)]
     retrieved_docs = [[] for _ in range(3)]
+    running = RunningMetrics(labels)
 
-    for i in range(len(queries)):
-        query = queries[i]
+    for record in score_records(iter_retrievals(queries, bm25, dpr_index, query_indices, k, rerank_model), data, k):
+        running.update(record)
+        for m, label in enumerate(labels):
+            times[m].append(record[label]["time"])
+            recall_values[m].append(record[label][f"recall@{k}"])
+            precision_values[m].append(record[label][f"precision@{k}"])
+            retrieved_docs[m].append(get_retrieved_docs(record[label]["ids"]))
 
-        k = 10
+    print_average_metrics(recall_values, precision_values, rerank_model, list(running.means().values()))
 
-        # BM25 evaluation
-        start_time = time.time()
+    return (times, recall_values, precision_values, retrieved_docs)
 
-        bm25_results_indices, _ = bm25_retrieve(query, bm25, k)
-        retrieved_docs[0].append(get_retrieved_docs(bm25_results_indices))
 
-        times[0].append(time.time() - start_time)
+def iter_retrievals(
+    queries: list[str],
+    bm25,
+    dpr_index,
+    query_indices: Iterable[int] | None = None,
+    k: int = 10,
+    rerank_model: str = "Reranking",
+    models: tuple[str, ...] | None = None,
+) -> Iterator[dict]:
+    """
+    Retrieves the k best passages of every query with BM25, DPR and the reranking model, one query at a time.
 
-        recall_values[0].append(recall_at_k(data[i]["answers"], bm25_results_indices))
-        precision_values[0].append(precision_at_k(data[i]["answers"], bm25_results_indices))
+    Records hold ids, scores and timings only, never passage text, so consumers can stream them without memory
+    growing with the number of queries.
 
-        # DPR evaluation
-        start_time = time.time()
+    Args:
+        queries (list[str]): The queries.
+        bm25 (BM25Index): The BM25 retrieval model.
+        dpr_index (faiss.Index): The DPR retrieval model index.
+        query_indices (Iterable[int], optional): The queries to evaluate, in order. Defaults to all of them.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        rerank_model (str, optional): The model of the third stage, "Reranking" or "Hybrid". Defaults to
+            "Reranking".
+        models (tuple[str, ...], optional): Run only these of "BM25", "DPR" and `rerank_model`. Defaults to all
+            three.
+
+    Yields:
+        dict: `{"query": i, "BM25": {...}, "DPR": {...}, <rerank_model>: {...}}`, where every model entry holds the
+        retrieved "ids", their "scores" and the retrieval "time" in seconds.
+    """
+    if rerank_model == "Hybrid":
+        hybrid = HybridRetriever(bm25, dpr_index, query_encoder=cached_encode_query)
+        rerank = partial(cached_hybrid_retrieve, hybrid)
+    else:
+        reranker = Reranker(bm25, dpr_index, query_encoder=cached_encode_query)
+        rerank = partial(cached_rerank, reranker)
+
+    def dpr(query: str) -> tuple[list[int], list[float]]:
+        scores, ids = cached_retrieve_top_k_passages(dpr_index, query, k)
+        return ids, scores
+
+    retrievers = (
+        ("BM25", lambda query: cached_bm25_retrieve(query, bm25, k)),
+        ("DPR", dpr),
+        (rerank_model, lambda query: rerank(query, k)),
+    )
+    if models is not None:
+        retrievers = tuple((label, retrieve) for label, retrieve in retrievers if label in models)
+
+    for i in range(len(queries)) if query_indices is None else query_indices:
+        record = {"query": int(i)}
+        for label, retrieve in retrievers:
+            start_time = time.perf_counter()
+            ids, scores = retrieve(queries[i])
+            elapsed = time.perf_counter() - start_time
+            record[label] = {"ids": list(ids), "scores": numpy.asarray(scores, dtype=float).tolist(), "time": elapsed}
+        yield record
+
+
+def score_records(records: Iterable[dict], qrels, k: int = 10, batch_size: int = 256) -> Iterator[dict]:
+    """
+    Adds the `RANKING_METRICS` at k to the model entries of retrieval records, as they stream by.
 
-        _, dpr_results_indices = retrieve_top_k_passages(dpr_index, query, k)
-        retrieved_docs[1].append(get_retrieved_docs(dpr_results_indices))
+    Records are scored a batch at a time with `ranking_metrics`, so only `batch_size` records are held at once.
 
-        times[1].append(time.time() - start_time)
+    Args:
+        records (Iterable[dict]): Records of `iter_retrievals`.
+        qrels (Qrels): The relevance judgments.
+        k (int, optional): The cutoff. Defaults to 10.
+        batch_size (int, optional): The number of records scored together. Defaults to 256.
+
+    Yields:
+        dict: The records, in order, with "recall@k", "precision@k", "mrr@k", "ndcg@k" and "map@k" added to every
+        model entry.
+    """
+    records = iter(records)
+    while batch := list(islice(records, batch_size)):
+        query_indices = numpy.fromiter((record["query"] for record in batch), dtype=numpy.int64, count=len(batch))
+        for label in batch[0]:
+            if label == "query":
+                continue
+            metrics = ranking_metrics(
+                result_matrix([record[label]["ids"] for record in batch], k), qrels, query_indices
+            )
+            for name, values in metrics.items():
+                for record, value in zip(batch, values[:, -1].tolist()):
+                    record[label][f"{name}@{k}"] = value
+        yield from batch
 
-        recall_values[1].append(recall_at_k(data[i]["answers"], dpr_results_indices))
-        precision_values[1].append(precision_at_k(data[i]["answers"], dpr_results_indices))
 
-        # Reranking evaluation
-        start_time = time.time()
+class RunningMetrics:
+    """
+    Running means of the per-query timings and metrics of scored records, kept in constant memory.
 
-        query_embedding = encode_query(query)
-        bm25_results, bm25_scores = bm25_retrieve(query, bm25, 2 * k)
-        docs = get_retrieved_docs(bm25_results)
+    Args:
+        labels (Iterable[str]): The models of the records.
+    """
 
-        reranking_match_list = []
+    def __init__(self, labels: Iterable[str]):
+        self.count = 0
+        self.sums: dict[str, dict[str, float]] = {label: {} for label in labels}
+
+    def update(self, record: dict):
+        """
+        Adds the figures of a scored record.
+
+        Args:
+            record (dict): A record of `score_records`.
+        """
+        self.count += 1
+        for label, sums in self.sums.items():
+            for key, value in record[label].items():
+                if key not in ("ids", "scores"):
+                    sums[key] = sums.get(key, 0.0) + value
+
+    def means(self) -> dict[str, dict[str, float]]:
+        """
+        Returns the mean of every figure of every model.
+
+        Returns:
+            dict[str, dict[str, float]]: The means by model, keyed as in the records, e.g. "recall@10" or "time".
+        """
+        return {
+            label: {key: total / self.count for key, total in sums.items()} if self.count else {}
+            for label, sums in self.sums.items()
+        }
+
+    def state(self) -> dict:
+        """
+        Returns the counters, JSON serializable, to restore them later with `from_state`.
+        """
+        return {"count": self.count, "sums": self.sums}
+
+    @classmethod
+    def from_state(cls, state: dict) -> "RunningMetrics":
+        """
+        Restores counters saved with `state`.
+
+        Args:
+            state (dict): The saved counters.
+
+        Returns:
+            RunningMetrics: The restored counters.
+        """
+        running = cls(state["sums"])
+        running.count = state["count"]
+        running.sums = {label: dict(sums) for label, sums in state["sums"].items()}
+        return running
+
+
+def print_average_metrics(
+    recall_values: list[list[float]],
+    precision_values: list[list[float]],
+    rerank_model: str = "Reranking",
+    ranking: list[dict[str, float]] | None = None,
+):
+    """
+    Prints the average precision and recall of BM25, DPR and Reranking.
 
-        for idx in range(len(docs)):
-            doc_embedding = encode_query(docs[idx])
-            similarity = cosine_similarity(query_embedding, doc_embedding)
-            if similarity < 0.7:
-                continue
-            combined_score = 0.7 * similarity + (1 - 0.7) * bm25_scores[idx]
-            reranking_match_list.append((bm25_results[idx], combined_score))
+    Args:
+        recall_values (list): The per-query recall values of every model.
+        precision_values (list): The per-query precision values of every model.
+        rerank_model (str, optional): The name of the third model. Defaults to "Reranking".
+        ranking (list[dict[str, float]], optional): The `mean_metrics` of every model. Their MRR, nDCG and MAP
+            are printed too.
+    """
+    labels = ("BM25", "DPR", rerank_model)
 
-        reranking_match_list = sorted(reranking_match_list, key=lambda x: x[1], reverse=True)[:k]
-        reranking_result_indices = [x[0] for x in reranking_match_list]
-        retrieved_docs[2].append(get_retrieved_docs(reranking_result_indices))
+    for label, values in zip(labels, precision_values):
+        print(f"Average Precision for {label}: {numpy.mean(values) if len(values) else 0.0}")
 
-        times[2].append(time.time() - start_time)
+    print("-" * 50)
 
-        recall_values[2].append(recall_at_k(data[i]["answers"], reranking_result_indices))
-        precision_values[2].append(precision_at_k(data[i]["answers"], reranking_result_indices))
+    for label, values in zip(labels, recall_values):
+        print(f"Average Recall for {label}: {numpy.mean(values) if len(values) else 0.0}")
 
-    print(f"Average Precision for BM25: {sum(precision_values[0]) / len(precision_values[0])}")
-    print(f"Average Precision for DPR: {sum(precision_values[1]) / len(precision_values[1])}")
-    print(f"Average Precision for Reranking: {sum(precision_values[2]) / len(precision_values[2])}")
+    if ranking is not None:
+        print("-" * 50)
+        for label, means in zip(labels, ranking):
+            figures = ", ".join(
+                f"{key.upper()}: {value:.4f}"
+                for key, value in means.items()
+                if key.split("@")[0] in ("mrr", "ndcg", "map")
+            )
+            print(f"{label}: {figures}")
 
-    print("-" * 50)
 
-    print(f"Average Recall for BM25: {sum(recall_values[0]) / len(recall_values[0])}")
-    print(f"Average Recall for DPR: {sum(recall_values[1]) / len(recall_values[1])}")
-    print(f"Average Recall for Reranking: {sum(recall_values[2]) / len(recall_values[2])}")
+RANKING_METRICS = ("recall", "precision", "mrr", "ndcg", "map")
 
-    return (times, recall_values, precision_values, retrieved_docs)
+
+def result_matrix(results: list[list[int]], k: int | None = None) -> ndarray:
+    """
+    Packs ranked result lists into a (queries x k) id matrix, padded with -1.
+
+    Args:
+        results (list[list[int]]): The ranked document ids of every query.
+        k (int, optional): The number of columns. Defaults to the longest list.
+
+    Returns:
+        numpy.ndarray: The int64 result matrix.
+    """
+    lengths = numpy.fromiter((len(ids) for ids in results), dtype=numpy.int64, count=len(results))
+    k = int(lengths.max(initial=0)) if k is None else k
+    lengths = numpy.minimum(lengths, k)
+
+    matrix = numpy.full((len(results), k), -1, dtype=numpy.int64)
+    flat = numpy.fromiter((doc_id for ids in results for doc_id in ids[:k]), dtype=numpy.int64, count=lengths.sum())
+    matrix[numpy.arange(k) < lengths[:, None]] = flat
+    return matrix
+
+
+def relevance_matrix(results: ndarray, qrels, query_indices: ndarray | None = None) -> tuple[ndarray, ndarray]:
+    """
+    Marks which retrieved documents are relevant, for all queries at once.
+
+    Every (query, document) pair is encoded as one int64 key; the judgments of the queries, sorted by query and
+    then document, form a sorted key array that all the results are looked up in with one binary search.
+
+    Args:
+        results (numpy.ndarray): The (queries x k) retrieved ids, padded with -1.
+        qrels (Qrels): The relevance judgments, with ascending ids per query.
+        query_indices (numpy.ndarray, optional): The query of `qrels` of every result row. Defaults to row i
+            being query i.
+
+    Returns:
+        tuple: The (queries x k) boolean relevance matrix and the number of relevant documents of every query.
+    """
+    results = numpy.asarray(results, dtype=numpy.int64)
+    if query_indices is None:
+        query_indices = numpy.arange(len(results))
+    query_indices = numpy.asarray(query_indices, dtype=numpy.int64)
+
+    starts, ends = qrels.indptr[query_indices], qrels.indptr[query_indices + 1]
+    num_relevant = ends - starts
+    stride = int(max(qrels.doc_ids.max(initial=-1), results.max(initial=-1))) + 1
+
+    # The judgments of the selected queries, keyed by their row in `results`
+    rows = numpy.repeat(numpy.arange(len(results)), num_relevant)
+    offsets = numpy.arange(num_relevant.sum()) - numpy.repeat(numpy.cumsum(num_relevant) - num_relevant, num_relevant)
+    keys = rows * stride + qrels.doc_ids[numpy.repeat(starts, num_relevant) + offsets]
+    keys.sort()
+
+    result_keys = numpy.arange(len(results))[:, None] * stride + results
+    positions = numpy.minimum(numpy.searchsorted(keys, result_keys), max(len(keys) - 1, 0))
+    relevant = (results >= 0) & (keys[positions] == result_keys) if len(keys) else numpy.zeros(results.shape, bool)
+    return relevant, num_relevant
+
+
+def ranking_metrics(results: ndarray, qrels, query_indices: ndarray | None = None) -> dict[str, ndarray]:
+    """
+    Computes recall, precision, MRR, nDCG and MAP at every cutoff for every query at once.
+
+    Column j of every matrix is the metric at k = j + 1. Precision is over the documents actually retrieved,
+    recall over the relevant documents of the query, nDCG uses binary gains and MAP is normalized by
+    min(relevant, k). Queries without relevant documents score 0.
+
+    Args:
+        results (numpy.ndarray): The (queries x k) retrieved ids, padded with -1, e.g. from `result_matrix`.
+        qrels (Qrels): The relevance judgments, with ascending ids per query.
+        query_indices (numpy.ndarray, optional): The query of `qrels` of every result row. Defaults to row i
+            being query i.
+
+    Returns:
+        dict[str, numpy.ndarray]: The (queries x k) float matrices of `RANKING_METRICS`, by name.
+    """
+    results = numpy.asarray(results, dtype=numpy.int64)
+    relevant, num_relevant = relevance_matrix(results, qrels, query_indices)
+    k = results.shape[1]
+    ranks = numpy.arange(1, k + 1)
+
+    hits = numpy.cumsum(relevant, axis=1)
+    retrieved = numpy.cumsum(results >= 0, axis=1)
+    num_relevant = num_relevant[:, None]
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        recall = numpy.where(num_relevant > 0, hits / num_relevant, 0.0)
+        precision = numpy.where(retrieved > 0, hits / retrieved, 0.0)
+
+        first_hit = numpy.where(relevant.any(axis=1), relevant.argmax(axis=1), k)[:, None]
+        mrr = numpy.where(first_hit < ranks, 1.0 / (first_hit + 1), 0.0)
+
+        discounts = 1.0 / numpy.log2(ranks + 1)
+        dcg = numpy.cumsum(relevant * discounts, axis=1)
+        ideal = numpy.concatenate([[0.0], numpy.cumsum(discounts)])[numpy.minimum(num_relevant, ranks)]
+        ndcg = numpy.where(ideal > 0, dcg / ideal, 0.0)
+
+        precision_sum = numpy.cumsum(relevant * hits / ranks, axis=1)
+        cutoff = numpy.minimum(num_relevant, ranks)
+        average_precision = numpy.where(cutoff > 0, precision_sum / cutoff, 0.0)
+
+    return {"recall": recall, "precision": precision, "mrr": mrr, "ndcg": ndcg, "map": average_precision}
+
+
+def mean_metrics(metrics: dict[str, ndarray], ks: tuple[int, ...] = (1, 5, 10)) -> dict[str, float]:
+    """
+    Averages the per-query metrics of `ranking_metrics` at the given cutoffs.
+
+    Args:
+        metrics (dict[str, numpy.ndarray]): The metric matrices.
+        ks (tuple[int, ...], optional): The cutoffs. Those beyond the retrieved depth are skipped.
+            Defaults to (1, 5, 10).
+
+    Returns:
+        dict[str, float]: The means, keyed as "recall@10".
+    """
+    return {
+        f"{name}@{k}": float(values[:, k - 1].mean()) if len(values) else 0.0
+        for name, values in metrics.items()
+        for k in ks
+        if k <= values.shape[1]
+    }
 
 
 def recall_at_k(answers: list[int], match_list: list[int]) -> float:
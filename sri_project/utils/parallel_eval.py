@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+import time
+
+import numpy
+
+from sri_project.models.bm25 import bm25_retrieve
+from sri_project.models.dpr import retrieve_top_k_passages
+from sri_project.models.hybrid import HybridRetriever
+from sri_project.models.reranker import Reranker
+from sri_project.utils.cache import cached_encode_query
+from sri_project.utils.metrics import mean_metrics, print_average_metrics, ranking_metrics, result_matrix
+from sri_project.utils.utils import get_retrieved_docs
+
+MODELS = ("BM25", "DPR", "Reranking")
+
+# Set by the parent right before forking, so workers inherit the indexes copy-on-write instead of pickling them
+_shared: dict = {}
+
+
+def _init_worker(threads_per_worker: int):
+    import faiss
+    import torch
+
+    # One pool process per core: intra-op threads would only oversubscribe the CPU
+    torch.set_num_threads(threads_per_worker)
+    faiss.omp_set_num_threads(threads_per_worker)
+
+
+def _evaluate_shard(query_indices: list[int]) -> dict:
+    queries, k = _shared["queries"], _shared["k"]
+    bm25, dpr_index = _shared["bm25"], _shared["dpr_index"]
+    if _shared["rerank_model"] == "Hybrid":
+        rerank = HybridRetriever(bm25, dpr_index, query_encoder=cached_encode_query).retrieve
+    else:
+        rerank = Reranker(bm25, dpr_index, query_encoder=cached_encode_query).rerank
+
+    retrievers = (
+        lambda query: bm25_retrieve(query, bm25, k)[0],
+        lambda query: retrieve_top_k_passages(dpr_index, query, k)[1],
+        lambda query: rerank(query, k)[0],
+    )
+
+    results = {"query_indices": query_indices, "pid": os.getpid(), "times": [], "doc_ids": [], "busy": 0.0}
+
+    # One pass per model over the whole shard keeps each model's weights and index hot in cache
+    for retrieve in retrievers:
+        model_times, model_doc_ids = [], []
+        for i in query_indices:
+            start_time = time.perf_counter()
+            model_doc_ids.append(retrieve(queries[i]))
+            model_times.append(time.perf_counter() - start_time)
+        results["times"].append(model_times)
+        results["doc_ids"].append(model_doc_ids)
+        results["busy"] += sum(model_times)
+
+    return results
+
+
+def evaluate_performance_parallel(
+    data,
+    queries: list[str],
+    bm25,
+    dpr_index,
+    workers: int | None = None,
+    k: int = 10,
+    shards_per_worker: int = 4,
+    threads_per_worker: int = 1,
+    rerank_model: str = "Reranking",
+) -> tuple:
+    """
+    Evaluate BM25, DPR and Reranking over all queries with a pool of forked worker processes.
+
+    Queries are split in shards that workers pick up as they become free. Workers share the parent's
+    indexes read-only through fork (memory-mapped indexes stay a single page-cached copy) and run each model
+    in its own pass over their shard. The results are merged in query order.
+
+    Args:
+        data (Qrels): The relevance judgments, where data[i] holds the corpus indices of the answers of query i.
+        queries (list): A list of queries to evaluate.
+        bm25 (BM25Index): The BM25 retrieval model.
+        dpr_index (faiss.Index): The DPR retrieval model index.
+        workers (int, optional): The number of worker processes. Defaults to the number of cores.
+        k (int, optional): The number of passages retrieved per query. Defaults to 10.
+        shards_per_worker (int, optional): The number of shards per worker, for load balancing. Defaults to 4.
+        threads_per_worker (int, optional): The torch/faiss threads of every worker. Defaults to 1.
+        rerank_model (str, optional): The model of the third stage, "Reranking" or "Hybrid". Defaults to "Reranking".
+
+    Returns:
+        tuple: The times, recall, precision and retrieved documents in the layout of `evaluate_performance`,
+        plus a list with the number of queries, busy time and throughput of every worker.
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = [shard.tolist() for shard in numpy.array_split(numpy.arange(len(queries)), workers * shards_per_worker)]
+    shards = [shard for shard in shards if shard]
+
+    _shared.update(queries=queries, bm25=bm25, dpr_index=dpr_index, k=k, rerank_model=rerank_model)
+    start_time = time.perf_counter()
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+            shard_results = list(pool.imap_unordered(_evaluate_shard, shards))
+    finally:
+        _shared.clear()
+    elapsed = time.perf_counter() - start_time
+
+    shard_results.sort(key=lambda result: result["query_indices"][0])
+
+    times = [[t for result in shard_results for t in result["times"][m]] for m in range(len(MODELS))]
+    doc_ids = [[ids for result in shard_results for ids in result["doc_ids"][m]] for m in range(len(MODELS))]
+
+    # Metrics of all queries at once in the parent, from the merged result matrices
+    metrics = [ranking_metrics(result_matrix(ids, k), data) for ids in doc_ids]
+    recall_values = [m["recall"][:, -1].tolist() for m in metrics]
+    precision_values = [m["precision"][:, -1].tolist() for m in metrics]
+    retrieved_docs = [[get_retrieved_docs(ids) for ids in model_doc_ids] for model_doc_ids in doc_ids]
+
+    worker_stats = {}
+    for result in shard_results:
+        stats = worker_stats.setdefault(result["pid"], {"pid": result["pid"], "queries": 0, "busy_s": 0.0})
+        stats["queries"] += len(result["query_indices"])
+        stats["busy_s"] += result["busy"]
+    for stats in worker_stats.values():
+        stats["queries_per_s"] = stats["queries"] / stats["busy_s"] if stats["busy_s"] else 0.0
+
+    print_average_metrics(recall_values, precision_values, rerank_model, [mean_metrics(m, (k,)) for m in metrics])
+    print("-" * 50)
+    for stats in worker_stats.values():
+        print(f"Worker {stats['pid']}: {stats['queries']} queries, {stats['queries_per_s']:.2f} queries/s")
+    print(f"Total: {len(queries)} queries in {elapsed:.2f}s ({len(queries) / elapsed:.2f} queries/s)")
+
+    return times, recall_values, precision_values, retrieved_docs, list(worker_stats.values())
@@ -0,0 +1,122 @@
+import mmap
+import os
+
+import numpy
+from numpy import ndarray
+
+
+def offsets_path(path: str) -> str:
+    """
+    Returns the offsets file of a passage blob.
+
+    Args:
+        path (str): The blob file.
+
+    Returns:
+        str: The path of the .npy offsets file.
+    """
+    return path + ".offsets.npy"
+
+
+def write_passages(blob: ndarray, offsets: ndarray, path: str):
+    """
+    Writes packed passages, as returned by `dataset_loader.pack_strings`, to a blob file and its offsets file.
+
+    Both files are written under temporary names and renamed, the blob last, so a store never opens a blob whose
+    offsets are missing or partial.
+
+    Args:
+        blob (numpy.ndarray): The uint8 UTF-8 blob.
+        offsets (numpy.ndarray): The (passages + 1) int64 byte offsets of every passage in the blob.
+        path (str): The blob file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with open(offsets_path(path) + ".tmp", "wb") as f:
+        numpy.save(f, numpy.asarray(offsets, dtype=numpy.int64))
+    with open(path + ".tmp", "wb") as f:
+        f.write(memoryview(numpy.ascontiguousarray(blob, dtype=numpy.uint8)))
+
+    os.replace(offsets_path(path) + ".tmp", offsets_path(path))
+    os.replace(path + ".tmp", path)
+
+
+class PassageStore:
+    """
+    Read-only passages packed in a UTF-8 blob file, memory-mapped and looked up by position.
+
+    The blob and its offsets are mapped rather than read, so the store costs no heap memory, opens instantly and
+    every process mapping the same files shares one page-cached copy, including forked workers. Looking up a
+    passage decodes its bytes straight from the mapping; `get_bytes` returns them without any copy.
+
+    Args:
+        path (str): The blob file written by `write_passages`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = numpy.load(offsets_path(path), mmap_mode="r")
+        # Indexing a memoryview yields Python ints without creating NumPy scalars, which dominates small lookups
+        self._offsets = memoryview(self.offsets).cast("B").cast("q")
+
+        with open(path, "rb") as f:
+            # An empty file cannot be mapped
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        self._buffer = memoryview(self._mmap if self._mmap is not None else b"")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _bounds(self, doc_id: int) -> tuple[int, int]:
+        n = len(self._offsets) - 1
+        if not -n <= doc_id < n:
+            raise IndexError(f"passage id {doc_id} out of range for a store of {n} passages")
+        # Negative ids count from the end, like list indices
+        if doc_id < 0:
+            doc_id += n
+        return self._offsets[doc_id], self._offsets[doc_id + 1]
+
+    def get_bytes(self, doc_id: int) -> memoryview:
+        """
+        Returns the UTF-8 bytes of a passage as a view of the mapping, without copying them.
+
+        Args:
+            doc_id (int): The passage position.
+
+        Returns:
+            memoryview: The passage bytes. The view is only valid while the store is open.
+        """
+        start, end = self._bounds(doc_id)
+        return self._buffer[start:end]
+
+    def __getitem__(self, doc_id: int) -> str:
+        start, end = self._bounds(doc_id)
+        return str(self._buffer[start:end], "utf-8")
+
+    def get(self, doc_ids: list[int]) -> list[str]:
+        """
+        Returns the passages with the given positions.
+
+        Args:
+            doc_ids (list[int]): The passage positions.
+
+        Returns:
+            list[str]: The passages, in the order of `doc_ids`.
+
+        Raises:
+            IndexError: If a position is outside the store.
+        """
+        docs = []
+        for doc_id in doc_ids:
+            start, end = self._bounds(doc_id)
+            docs.append(str(self._buffer[start:end], "utf-8"))
+        return docs
+
+    def close(self):
+        """
+        Unmaps the blob. Views returned by `get_bytes` must be released first.
+        """
+        self._buffer.release()
+        self._offsets.release()
+        if self._mmap is not None:
+            self._mmap.close()
@@ -1,7 +1,28 @@
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Charts are drawn on their own Agg figures, without pyplot's global state, so they can render off the main
+# thread and never open a window
+CHART_DIR = "img/charts"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="charts")
+_pending: dict[str, Future] = {}
+_pending_lock = threading.Lock()
+
+
+def _save(fig: Figure, filename: str):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    # Written under a unique temporary name and renamed, so readers never see a partial file
+    tmp_path = f"{filename}.{threading.get_ident()}.tmp.png"
+    FigureCanvasAgg(fig).print_png(tmp_path)
+    os.replace(tmp_path, filename)
 
 
 def plot_and_save_graph(
@@ -15,7 +36,7 @@ def plot_and_save_graph(
     filename: str,
     labels: tuple = ("BM25", "DPR", "Reranking"),
     path: str = "img",
-):
+) -> str:
     """
     Plots two lines on a graph and saves it as an image file.
 
@@ -32,25 +53,26 @@ def plot_and_save_graph(
         path (str, optional): The path to save the image file. Defaults to "img".
 
     Returns:
-        None
+        str: The path of the saved image.
     """
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    ax.plot(x, y1, label=f"{labels[0]} {ylabel}", color="blue")
+    ax.plot(x, y2, label=f"{labels[1]} {ylabel}", color="orange")
+    ax.plot(x, y3, label=f"{labels[2]} {ylabel}", color="green")
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.legend()
 
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    plt.figure(figsize=(10, 5))
-    plt.plot(x, y1, label=f"{labels[0]} {ylabel}", color="blue")
-    plt.plot(x, y2, label=f"{labels[1]} {ylabel}", color="orange")
-    plt.plot(x, y3, label=f"{labels[2]} {ylabel}", color="green")
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.title(title)
-    plt.legend()
-    plt.savefig(f"{path}/{filename}.png")
-    plt.show()
+    filename = f"{path}/{filename}.png"
+    _save(fig, filename)
+    return filename
 
 
-def plot_comparison(x1, x2, label1: str, label2: str, title: str, filename: str):
+def plot_comparison(
+    x1, x2, label1: str, label2: str, title: str, filename: str, labels: tuple = ("BM25", "DPR", "Reranking")
+):
     """
     Plot a comparison bar chart between two sets of values.
 
@@ -61,12 +83,12 @@ def plot_comparison(x1, x2, label1: str, label2: str, title: str, filename: str)
         label2 (str): Label for the second set.
         title (str): Title of the chart.
         filename (str): Filename to save the chart.
+        labels (tuple, optional): The names of the three models. Defaults to ("BM25", "DPR", "Reranking").
 
     Returns:
         str: The filename of the saved chart.
 
     """
-    labels = ["BM25", "DPR", "Reranking"]
     x1_vals = [x1[0][0], x1[1][0], x1[2][0]]
     x2_vals = []
     if x2 is not None:
@@ -75,7 +97,8 @@ def plot_comparison(x1, x2, label1: str, label2: str, title: str, filename: str)
     x = np.arange(len(labels))
     width = 0.35
 
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.add_subplot()
     ax.bar(x - width / 2, x1_vals, width, label=label1)
     if x2 is not None:
         ax.bar(x + width / 2, x2_vals, width, label=label2)
@@ -86,8 +109,64 @@ def plot_comparison(x1, x2, label1: str, label2: str, title: str, filename: str)
     ax.set_xticklabels(labels)
     ax.legend()
 
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.close()
+    fig.tight_layout()
+    _save(fig, filename)
 
     return filename
+
+
+def chart_filename(*inputs) -> str:
+    """
+    Returns the cache file of a chart, named after the hash of everything it is drawn from.
+
+    Args:
+        *inputs: The chart inputs: values, labels and title. They must be JSON serializable.
+
+    Returns:
+        str: The path of the chart under `CHART_DIR`.
+    """
+    content = json.dumps(inputs, ensure_ascii=False, default=float).encode("utf-8")
+    return os.path.join(CHART_DIR, hashlib.blake2b(content, digest_size=16).hexdigest() + ".png")
+
+
+def render_comparison(
+    x1, x2, label1: str, label2: str, title: str, labels: tuple = ("BM25", "DPR", "Reranking")
+) -> Future:
+    """
+    Renders a `plot_comparison` chart in the background chart thread, reusing the file of an identical chart.
+
+    Charts are cached by the content of their inputs under unique filenames, so concurrent requests never
+    overwrite each other's files, and identical requests in flight share one rendering.
+
+    Args:
+        x1 (list): List of values for the first set.
+        x2 (list): List of values for the second set.
+        label1 (str): Label for the first set.
+        label2 (str): Label for the second set.
+        title (str): Title of the chart.
+        labels (tuple, optional): The names of the three models. Defaults to ("BM25", "DPR", "Reranking").
+
+    Returns:
+        Future: Resolves to the filename of the chart.
+    """
+    x1_vals = [x1[0][0], x1[1][0], x1[2][0]]
+    x2_vals = None if x2 is None else [x2[0][0], x2[1][0], x2[2][0]]
+    filename = chart_filename("comparison", x1_vals, x2_vals, label1, label2, title, list(labels))
+
+    with _pending_lock:
+        if filename in _pending:
+            return _pending[filename]
+        if os.path.exists(filename):
+            future = Future()
+            future.set_result(filename)
+            return future
+
+        future = _executor.submit(plot_comparison, x1, x2, label1, label2, title, filename, labels)
+        _pending[filename] = future
+
+    def done(_):
+        with _pending_lock:
+            _pending.pop(filename, None)
+
+    future.add_done_callback(done)
+    return future
@@ -0,0 +1,283 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+METRIC_NAME = "sri_stage_duration_seconds"
+
+# Tracing is off unless SRI_TRACE is set or `enable` is called. While off, `span` returns a shared no-op context
+# manager, so an instrumented stage only pays for one function call and one flag check
+_enabled = os.environ.get("SRI_TRACE", "") not in ("", "0")
+_sample_rate = float(os.environ.get("SRI_TRACE_SAMPLE_RATE", "1"))
+
+_histograms: dict[str, "Histogram"] = {}
+_histograms_lock = threading.Lock()
+_local = threading.local()
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """
+    A latency histogram with fixed buckets, in the layout of a Prometheus histogram.
+
+    Args:
+        buckets (tuple[float, ...], optional): The ascending upper bounds of the buckets, in seconds. Values above
+            the last one fall in an implicit +Inf bucket. Defaults to `BUCKETS`.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """
+        Records a duration.
+
+        Args:
+            value (float): The duration in seconds.
+        """
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by linear interpolation inside its bucket, like Prometheus' `histogram_quantile`.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The estimated duration in seconds, or 0 if nothing was recorded. Quantiles falling in the +Inf
+            bucket are reported as the last finite bound.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if bucket == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[bucket - 1] if bucket else 0.0
+                return lower + (self.buckets[bucket] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def snapshot(self) -> dict:
+        """
+        Returns the count, total, mean and estimated percentiles of the recorded durations.
+
+        Returns:
+            dict: The summary, with durations in seconds.
+        """
+        with self._lock:
+            count, total = self.count, self.sum
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class _Span:
+    __slots__ = ("name", "start", "sampled")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        depth = getattr(_local, "depth", 0)
+        if depth == 0:
+            # Sampling is decided per outermost span, so a sampled request records all of its stages
+            _local.sampled = _sample_rate >= 1 or random.random() < _sample_rate
+        _local.depth = depth + 1
+        self.sampled = _local.sampled
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        elapsed = time.perf_counter() - self.start
+        _local.depth -= 1
+        if self.sampled:
+            histogram(self.name).observe(elapsed)
+
+
+def span(name: str):
+    """
+    Times a stage of the pipeline into the histogram of its name, when tracing is enabled.
+
+    Spans are plain context managers rather than decorators, so they add no frames to the stacks seen by cProfile
+    or py-spy. Spans opened inside another span of the same thread belong to the same sampled request.
+
+    Args:
+        name (str): The stage name, e.g. "bm25.score".
+
+    Returns:
+        A context manager timing its block.
+    """
+    if not _enabled:
+        return _NOOP
+    return _Span(name)
+
+
+def histogram(name: str) -> Histogram:
+    """
+    Returns the histogram of a stage, creating it on first use.
+
+    Args:
+        name (str): The stage name.
+
+    Returns:
+        Histogram: The histogram of the stage.
+    """
+    hist = _histograms.get(name)
+    if hist is None:
+        with _histograms_lock:
+            hist = _histograms.setdefault(name, Histogram())
+    return hist
+
+
+def enable(sample_rate: float = 1.0):
+    """
+    Turns tracing on.
+
+    Args:
+        sample_rate (float, optional): The fraction of requests (outermost spans) that are recorded. Defaults to 1.
+    """
+    global _enabled, _sample_rate
+    _sample_rate = sample_rate
+    _enabled = True
+
+
+def disable():
+    """
+    Turns tracing off. Recorded histograms are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """
+    Returns whether tracing is on.
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Discards every recorded histogram.
+    """
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def stats() -> dict[str, dict]:
+    """
+    Returns the summary of every traced stage.
+
+    Returns:
+        dict[str, dict]: The `Histogram.snapshot` of every stage, by stage name.
+    """
+    return {name: hist.snapshot() for name, hist in sorted(_histograms.items())}
+
+
+def prometheus_text(metric: str = METRIC_NAME) -> str:
+    """
+    Renders the stage histograms in the Prometheus text exposition format.
+
+    Args:
+        metric (str, optional): The metric name; stages are told apart by a `stage` label. Defaults to
+            `METRIC_NAME`.
+
+    Returns:
+        str: The exposition text.
+    """
+    lines = [
+        f"# HELP {metric} Duration of the retrieval pipeline stages.",
+        f"# TYPE {metric} histogram",
+    ]
+    for name, hist in sorted(_histograms.items()):
+        with hist._lock:
+            counts, count, total = list(hist.counts), hist.count, hist.sum
+
+        cumulative = 0
+        for bound, bucket_count in zip((*hist.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{stage="{name}"}} {total}')
+        lines.append(f'{metric}_count{{stage="{name}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def print_stats():
+    """
+    Prints the summary of every traced stage as a table, in milliseconds.
+    """
+    print(f"{'stage':<24}{'count':>9}{'mean (ms)':>12}{'p50 (ms)':>11}{'p95 (ms)':>11}{'p99 (ms)':>11}")
+    for name, s in stats().items():
+        print(
+            f"{name:<24}{s['count']:>9}{s['mean'] * 1000:>12.3f}{s['p50'] * 1000:>11.3f}"
+            f"{s['p95'] * 1000:>11.3f}{s['p99'] * 1000:>11.3f}"
+        )
+
+
+@contextmanager
+def profile(path: str | None = None, sort: str = "cumulative", limit: int = 30):
+    """
+    Profiles a block with cProfile.
+
+    cProfile is deterministic and slows Python code down; for production-like numbers, run with tracing off and
+    sample the process from outside with `py-spy record --pid <pid>` instead.
+
+    Args:
+        path (str, optional): Write the raw stats to this file, for `pstats` or snakeviz. If None, the slowest
+            functions are printed instead.
+        sort (str, optional): The `pstats` sort key of the printed table. Defaults to "cumulative".
+        limit (int, optional): The number of printed functions. Defaults to 30.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
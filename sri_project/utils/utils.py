@@ -1,38 +1,137 @@
+from sri_project.models.analyzers import Analyzer, ensure_nltk_resources
 from sri_project.models.bm25 import init_bm25
+from sri_project.models.document_store import DocumentStore
 from sri_project.models.dpr import create_index
-from sri_project.utils.dataset_loader import corpus
+from sri_project.models.dpr_models import preload_models
+from sri_project.models.embedding_store import DEFAULT_STORE_DIR, load_or_create_index
+from sri_project.models.sharded import ShardPool
+from sri_project.utils import dataset_loader
+from sri_project.utils.tracing import span
 
 
-def get_retrieved_docs(retrieved_docs: list[int]) -> list[str]:
+def get_retrieved_docs(retrieved_docs: list[int], store: DocumentStore | None = None) -> list[str]:
     """
     Retrieves the documents from the corpus based on the given list of document IDs.
 
     Args:
         retrieved_docs (list[int]): A list of document IDs.
+        store (DocumentStore | None): The document store the IDs belong to. If None, the IDs are positions
+            in the dataset corpus.
 
     Returns:
         list[str]: A list of retrieved documents.
 
     """
-    docs = []
-    for doc_id in retrieved_docs:
-        docs.append(corpus[doc_id])
-    return docs
+    with span("docs.lookup"):
+        if store is not None:
+            return store.get(retrieved_docs)
 
+        # Decoded straight from the memory-mapped corpus blob, shared by every process
+        return dataset_loader.corpus_store().get(retrieved_docs)
 
-def initialize_indexes(corpus):
+
+def initialize_indexes(
+    corpus,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+    index_type: str = "flat",
+    index_params: dict | None = None,
+    analyzer: Analyzer | str | None = None,
+):
     """
     Initializes the BM25 and DPR indexes for the given corpus.
 
     Parameters:
     corpus (list): A list of documents representing the corpus.
+    store_dir (str | None): The directory of the persistent embedding store. Passage embeddings and the
+        DPR index are loaded from it and only new or changed passages are encoded. If None, the whole
+        corpus is encoded in memory.
+    index_type (str): The type of DPR index, one of "flat", "ivf_flat", "ivf_pq" or "hnsw". Defaults to "flat".
+    index_params (dict | None): Build parameters of the DPR index, see `faiss_index.build_index`, plus the
+        `rescore` factor of compressed storage, see `embedding_store.load_or_create_index`.
+    analyzer (Analyzer | str | None): The BM25 analyzer or tokenizer name, see `bm25.init_bm25`.
 
     Returns:
     tuple: A tuple containing the BM25 index and the DPR index.
     """
 
-    bm25 = init_bm25(corpus)
+    bm25 = init_bm25(corpus, analyzer=analyzer)
 
-    dpr_index = create_index(corpus)
+    index_params = index_params or {}
+    if store_dir is None:
+        dpr_index = create_index(corpus, index_type, **index_params)
+    else:
+        dpr_index = load_or_create_index(corpus, store_dir, index_type=index_type, **index_params)
 
     return bm25, dpr_index
+
+
+def initialize_document_store(
+    corpus,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+    index_type: str = "flat",
+    index_params: dict | None = None,
+    analyzer: Analyzer | str | None = None,
+    compaction_interval: float | None = 30.0,
+) -> DocumentStore:
+    """
+    Initializes a document store over the given corpus, whose BM25 and DPR indexes accept incremental updates.
+
+    Parameters:
+    corpus (list): A list of documents representing the corpus. Their positions become their store IDs.
+    store_dir (str | None): The directory of the persistent embedding store, see `initialize_indexes`.
+    index_type (str): The type of DPR index, one of "flat", "ivf_flat", "ivf_pq" or "hnsw". Defaults to "flat".
+    index_params (dict | None): Build parameters of the DPR index, see `faiss_index.build_index`.
+    analyzer (Analyzer | str | None): The BM25 analyzer or tokenizer name, see `bm25.init_bm25`.
+    compaction_interval (float | None): The seconds between background compaction checks. If None, the
+        store is only compacted on explicit `compact` calls.
+
+    Returns:
+    DocumentStore: The store, with `bm25` and `dpr_index` usable wherever the static indexes are.
+    """
+    store = DocumentStore.from_corpus(corpus, store_dir, index_type, analyzer, **(index_params or {}))
+    if compaction_interval is not None:
+        store.start_compaction(compaction_interval)
+    return store
+
+
+def initialize_sharded_indexes(
+    corpus,
+    num_shards: int,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+    index_type: str = "flat",
+    index_params: dict | None = None,
+    analyzer: Analyzer | str | None = None,
+) -> ShardPool:
+    """
+    Initializes BM25 and DPR indexes split into shards served by worker processes.
+
+    Parameters:
+    corpus (list): A list of documents representing the corpus.
+    num_shards (int): The number of shards and worker processes.
+    store_dir (str | None): The directory of the persistent embedding store, see `initialize_indexes`.
+    index_type (str): The type of DPR index of every shard. Defaults to "flat".
+    index_params (dict | None): Build parameters of the DPR index, see `faiss_index.build_index`.
+    analyzer (Analyzer | str | None): The BM25 analyzer or tokenizer name, see `bm25.init_bm25`.
+
+    Returns:
+    ShardPool: The shard workers, with `bm25` and `dpr_index` usable wherever the single-process indexes are.
+    """
+    return ShardPool(corpus, num_shards, store_dir, index_type, analyzer, **(index_params or {}))
+
+
+def preload(models: bool = True, nltk: bool = True, dataset: bool = True):
+    """
+    Loads the lazily initialized resources now, instead of on first use.
+
+    Parameters:
+    models (bool): Load the DPR tokenizers and encoders. Defaults to True.
+    nltk (bool): Make sure the NLTK tokenizer data is installed. Defaults to True.
+    dataset (bool): Load the dataset CSV and map the corpus blob. Defaults to True.
+    """
+    if nltk:
+        ensure_nltk_resources()
+    if dataset:
+        dataset_loader.load_dataset()
+        dataset_loader.corpus_store()
+    if models:
+        preload_models()
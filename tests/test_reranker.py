@@ -0,0 +1,44 @@
+import faiss
+import numpy
+import pytest
+import torch
+
+from sri_project.models.bm25 import init_bm25
+from sri_project.models.reranker import Reranker
+
+WORDS = ["river", "bank", "money", "loan", "water", "fish", "boat", "interest", "rate", "shore"]
+
+
+@pytest.fixture(scope="module")
+def indexes():
+    rng = numpy.random.default_rng(0)
+    corpus = [" ".join(rng.choice(WORDS, size=12)) for _ in range(60)]
+    embeddings = rng.standard_normal((len(corpus), 16)).astype(numpy.float32)
+    dpr_index = faiss.IndexFlatIP(embeddings.shape[1])
+    dpr_index.add(embeddings)
+    return init_bm25(corpus, analyzer="regex", workers=1), dpr_index
+
+
+def query_encoder(query: str) -> torch.Tensor:
+    rng = numpy.random.default_rng(len(query))
+    return torch.from_numpy(rng.standard_normal((1, 16)).astype(numpy.float32))
+
+
+def test_rerank_returns_k_passages(indexes):
+    bm25, dpr_index = indexes
+    reranker = Reranker(bm25, dpr_index, query_encoder=query_encoder)
+
+    ids, scores = reranker.rerank("river bank loan", 10)
+
+    assert len(ids) == 10
+    assert len(set(ids)) == 10
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_threshold_filters_candidates(indexes):
+    bm25, dpr_index = indexes
+    unfiltered = Reranker(bm25, dpr_index, query_encoder=query_encoder).rerank("river bank loan", 10)[0]
+    filtered = Reranker(bm25, dpr_index, threshold=1.1, query_encoder=query_encoder).rerank("river bank loan", 10)[0]
+
+    assert len(unfiltered) == 10
+    assert filtered == []
@@ -0,0 +1,76 @@
+import numpy
+import pytest
+
+from sri_project.models import sharded
+from sri_project.models.bm25 import bm25_retrieve, init_bm25
+from sri_project.models.faiss_index import build_index
+from sri_project.models.sharded import ShardPool
+
+WORDS = ["river", "bank", "money", "loan", "water", "fish", "boat", "interest", "rate", "shore"]
+
+QUERIES = ["river bank", "the money loan rate", "fish", "water water boat", "common", "unknown words"]
+
+
+def fake_encode_passages(passages: list[str]) -> numpy.ndarray:
+    # Distinct deterministic vectors, so the tests run without the DPR encoders
+    rng = numpy.random.default_rng(len(passages))
+    return rng.standard_normal((len(passages), 16)).astype(numpy.float32)
+
+
+@pytest.fixture(scope="module")
+def corpus() -> list[str]:
+    rng = numpy.random.default_rng(0)
+    passages = [" ".join(rng.choice(WORDS, size=rng.integers(3, 15))) for _ in range(40)]
+    # "common" is in most passages, so its IDF is negative and floored. The copies tie on every query and
+    # land in different shards, so merging has to keep the tie order of a single index
+    passages = [f"{passage} common" if i % 4 else passage for i, passage in enumerate(passages)]
+    return passages + passages[:5]
+
+
+@pytest.fixture(scope="module")
+def pool(corpus):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(sharded, "encode_passages", fake_encode_passages)
+        with ShardPool(corpus, num_shards=4, analyzer="regex") as pool:
+            yield pool
+
+
+def test_bm25_matches_single_index(corpus, pool):
+    bm25 = init_bm25(corpus, analyzer="regex", workers=1)
+    # "common" is in over half the passages, so its IDF is floored with the average IDF of the whole corpus,
+    # which every shard has to agree on
+    assert numpy.diff(bm25.indptr)[bm25.vocab["common"]] > len(corpus) / 2
+
+    for query in QUERIES:
+        for k in (1, 5, 20, len(corpus) + 5):
+            ids, scores = bm25_retrieve(query, bm25, k)
+            sharded_ids, sharded_scores = bm25_retrieve(query, pool.bm25, k)
+            assert sharded_ids == ids
+            assert numpy.allclose(sharded_scores, scores, rtol=0, atol=1e-12)
+
+
+def test_dpr_matches_single_index(corpus, pool):
+    embeddings = fake_encode_passages(corpus)
+    index = build_index(embeddings, "flat")
+    queries = numpy.random.default_rng(1).standard_normal((8, 16)).astype(numpy.float32)
+
+    for k in (1, 10, len(corpus) + 5):
+        D, ids = index.search(queries, k)
+        sharded_D, sharded_ids = pool.dpr_index.search(queries, k)
+        assert numpy.array_equal(sharded_ids, ids)
+        assert numpy.allclose(sharded_D, D)
+
+    doc_ids = numpy.array([0, len(corpus) - 1, 11, 12, 23, 7])
+    assert numpy.array_equal(pool.dpr_index.reconstruct_batch(doc_ids), embeddings[doc_ids])
+
+
+def test_shards_capped_at_one_per_passage(corpus, monkeypatch):
+    monkeypatch.setattr(sharded, "encode_passages", fake_encode_passages)
+    passages = corpus[:3]
+
+    with ShardPool(passages, num_shards=8, analyzer="regex") as pool:
+        assert pool.num_shards == 3
+        assert pool.bounds.tolist() == [0, 1, 2, 3]
+        bm25 = init_bm25(passages, analyzer="regex", workers=1)
+        for query in QUERIES:
+            assert bm25_retrieve(query, pool.bm25, 5) == bm25_retrieve(query, bm25, 5)